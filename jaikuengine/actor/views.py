@@ -94,22 +94,23 @@ def actor_history(request, nick=None, format='html'):
   per_page = ENTRIES_PER_PAGE
   offset, prev = util.page_offset(request)
 
+  inbox = 'inbox/%s/%s' % (view.nick, privacy)
   if privacy == 'public':
     if user_is_private:
-      inbox = []
+      fetch = lambda limit, offset: []
     else:
-      inbox = api.inbox_get_actor_public(request.user, view.nick,
-                                         limit=(per_page + 1), offset=offset)
+      fetch = lambda limit, offset: api.inbox_get_actor_public(
+          request.user, view.nick, limit=limit, offset=offset)
   elif privacy == 'contacts':
-    inbox = api.inbox_get_actor_contacts(request.user, view.nick,
-                                         limit=(per_page + 1), offset=offset)
+    fetch = lambda limit, offset: api.inbox_get_actor_contacts(
+        request.user, view.nick, limit=limit, offset=offset)
   elif privacy == 'private':
-    inbox = api.inbox_get_actor_private(request.user, view.nick,
-                                        limit=(per_page + 1), offset=offset)
+    fetch = lambda limit, offset: api.inbox_get_actor_private(
+        request.user, view.nick, limit=limit, offset=offset)
 
   actor_streams = api.stream_get_actor_safe(request.user, view.nick)
 
-  entries, more = _get_inbox_entries(request, inbox)
+  entries, more = _get_inbox_entries(request, inbox, fetch, offset)
   contacts, channels, streams, entries = _assemble_inbox_data(request,
                                                               entries,
                                                               actor_streams,
@@ -230,13 +231,12 @@ def actor_overview(request, nick, format='html'):
   per_page = ENTRIES_PER_PAGE
   offset, prev = util.page_offset(request)
 
-  inbox = api.inbox_get_actor_overview(request.user,  
-                                       view.nick,
-                                       limit=(per_page + 1), 
-                                       offset=offset)
+  inbox = 'inbox/%s/overview' % view.nick
+  fetch = lambda limit, offset: api.inbox_get_actor_overview(
+      request.user, view.nick, limit=limit, offset=offset)
 
   actor_streams = api.stream_get_actor(request.user, view.nick)
-  entries, more = _get_inbox_entries(request, inbox,
+  entries, more = _get_inbox_entries(request, inbox, fetch, offset,
                                      view.extra.get('comments_hide', 0))
   contacts, channels, streams, entries = _assemble_inbox_data(request,
                                                               entries,
@@ -776,7 +776,7 @@ def _get_sidebar_streams(actor_streams, streams, request_user=None):
           )
   return result
 
-def _get_inbox_entries(request, inbox, hide_comments=False):
-  entries = api.entry_get_entries(request.user, inbox, hide_comments)
-  per_page = ENTRIES_PER_PAGE - (len(inbox) - len(entries))
-  return util.page_entries(request, entries, per_page)
+def _get_inbox_entries(request, inbox, fetch, offset, hide_comments=False):
+  return api.entry_get_page(request.user, inbox, ENTRIES_PER_PAGE,
+                            offset=offset, fetch=fetch,
+                            hide_comments=hide_comments)
@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import logging
+import threading
+import time
 import xmlrpclib
 from oauth import oauth
+import simplejson
 
 from django.conf import settings
 
@@ -25,6 +29,7 @@ from common import legacy
 from common import oauth_util
 from common import profile
 from common import util
+from common.protocol import push
 from common.protocol import xmpp
 from common.protocol import sms
 from common.test import base
@@ -310,6 +315,69 @@ class SmsPostTest(SmsTestCase):
     self.assertEqual(entry_ref.title(), message)
 
 
+class PushTest(base.FixturesTestCase):
+  inbox = 'inbox/popular@example.com/overview'
+
+  def setUp(self):
+    super(PushTest, self).setUp()
+    self.overrides = test_util.override(PUSH_ENABLED=True,
+                                        API_DISABLE_VERIFICATION=True)
+    self.push_connection = push.PushConnection()
+
+  def tearDown(self):
+    self.overrides.reset()
+    super(PushTest, self).tearDown()
+
+  def get(self, **params):
+    response = self.client.get('/api/push', params)
+    return simplejson.loads(response.content)
+
+  def test_fanout_wakes_watched_inboxes(self):
+    unwatched = 'inbox/unpopular@example.com/overview'
+    self.push_connection.watch(self.inbox)
+    cursor = self.push_connection.cursor(self.inbox)
+    unwatched_cursor = self.push_connection.cursor(unwatched)
+
+    popular_ref = api.actor_get(api.ROOT, 'popular')
+    api.post(popular_ref, nick='popular', message='wake up')
+    test_util.exhaust_queue_any()
+
+    self.assertNotEqual(self.push_connection.cursor(self.inbox), cursor)
+    self.assertEqual(self.push_connection.cursor(unwatched), unwatched_cursor)
+
+  def test_answers_right_away(self):
+    since_time = api.utcnow() - datetime.timedelta(days=1)
+    popular_ref = api.actor_get(api.ROOT, 'popular')
+    api.post(popular_ref, nick='popular', message='already there')
+    test_util.exhaust_queue_any()
+
+    start = time.time()
+    rv = self.get(nick='popular', since_time=str(since_time))
+    self.assert_(time.time() - start < 1)
+    self.assertEqual(rv['status'], 'ok', str(rv))
+    self.assert_(rv['rv']['entries'])
+
+  def test_wait(self):
+    since_time = api.utcnow() + datetime.timedelta(days=1)
+    push_connection = self.push_connection
+    inbox = self.inbox
+    def _send():
+      time.sleep(0.2)
+      push_connection.send_message([inbox], 'test')
+    threading.Thread(target=_send).start()
+
+    start = time.time()
+    rv = self.get(nick='popular', since_time=str(since_time), timeout=5)
+    self.assert_(time.time() - start < 5)
+    self.assertEqual(rv['status'], 'ok', str(rv))
+    self.assertEqual(rv['rv']['entries'], [])
+
+  def test_timeout(self):
+    since_time = api.utcnow() + datetime.timedelta(days=1)
+    rv = self.get(nick='popular', since_time=str(since_time), timeout=0.1)
+    self.assertEqual(rv['status'], 'ok', str(rv))
+    self.assertEqual(rv['rv']['entries'], [])
+
 class XmlRpcTest(base.FixturesTestCase):
   def setUp(self):
     super(XmlRpcTest, self).setUp()
@@ -397,6 +465,23 @@ class XmlRpcTest(base.FixturesTestCase):
     response = self.client.post('/api/xmlrpc', xml, 'text/xml')
     self.assertContains(response, 'Parameter not found')
 
+  def test_xmlrpc_multicall(self):
+    self.overrides = test_util.override(API_ALLOW_LEGACY_AUTH=True)
+    popular_ref = api.actor_get(api.ROOT, 'popular')
+    personal_key = legacy.generate_personal_key(popular_ref)
+    params = {'user': 'popular',
+              'personal_key': personal_key,
+              'nick': 'popular'}
+    calls = [{'methodName': 'actor_get', 'params': [params]},
+             {'methodName': 'actor_get', 'params': [{'nick': 'popular'}]},
+             ]
+    xml = xmlrpclib.dumps((calls,), 'system.multicall')
+    response = self.client.post('/api/xmlrpc', xml, 'text/xml')
+    rv = xmlrpclib.loads(response.content)[0][0]
+    self.assertEqual(len(rv), 2)
+    self.assertEqual(rv[0][0]['actor']['nick'], 'popular@example.com')
+    self.assertTrue('faultCode' in rv[1])
+
   def test_get_request(self):
     response = self.client.get('/api/xmlrpc')
     self.assertContains(response, 'XML-RPC message must be an HTTP-POST request')
@@ -28,6 +28,7 @@ urlpatterns = patterns('',
     (r'^docs$', 'api.views.api_docs'),
     (r'^docs/(?P<doc>\w+)$', 'api.views.api_doc'),
     (r'^json', 'api.views.api_call'),
+    (r'^push', 'api.views.api_push'),
     (r'^loaddata', 'api.views.api_loaddata'),
     (r'^cleardata', 'api.views.api_cleardata'),
     (r'^request_token', 'api.views.api_request_token'),
@@ -21,6 +21,8 @@ from django import template
 from django.conf import settings
 from django.core import serializers
 from django.template import loader
+from django.utils import cache
+from django.utils import text
 
 import simplejson
 
@@ -41,6 +43,7 @@ from common import user
 from common import util
 from common import validate
 from common import views as common_views
+from common.protocol import push
 from common.protocol import xmpp
 from common.protocol import sms as sms_protocol
 
@@ -251,30 +254,41 @@ def api_access_token(request):
 
 
 # Interface
+
+# The maximum number of method invocations allowed in a single batch call
+MAX_BATCH_CALLS = 20
+
+# Methods that accept a version and answer If-None-Match with a 304
+VERSIONED_METHODS = ('entry_get_actor_overview_since',)
+
 def api_call(request, format="json"):
   """ the public api
 
   attempts to validate a request as a valid oauth request then
   builds the appropriate api_user object and tries to dispatch
   to the provided method
+
+  if ``json_params`` holds a list rather than a dict the request is treated
+  as a batch: every item in the list is a dict with a ``method`` and that
+  method's parameters, the calls are run in order as the same api_user and
+  the result is a list holding one response per call
+
+  ``fields`` optionally limits the response to a comma separated list of
+  dotted paths into ``rv``, e.g. ``entries.uuid,entries.extra.title``
   """
   servertime = api.utcnow()
+  fields = None
   try:
     kwargs = oauth_util.get_method_kwargs(request)
     json_params = kwargs.pop('json_params', None)
+    batch = None
     if json_params:
       parsed = simplejson.loads(json_params)
-      # Turn the keys from unicode to str so that they can be used as method
-      # parameters.
-      kwargs.update(
-          dict([(str(k), v) for k, v in parsed.iteritems()]))
-    method = kwargs.pop('method', '').replace('.', '_')
-    if method == 'presence_send':
-      method = 'post'
-
-    if not method:
-      raise exception.ApiNoMethod('No method specified')
-
+      if isinstance(parsed, list):
+        batch = parsed
+      else:
+        kwargs.update(_kwargs_from_json(parsed))
+    fields = parse_fields(kwargs.pop('fields', None))
 
     # Allows us to turn off authentication for testing purposes
     if not settings.API_DISABLE_VERIFICATION:
@@ -282,20 +296,82 @@ def api_call(request, format="json"):
     else:
       api_user = api.ROOT
 
-    method_ref = api.PublicApi.get_method(method, api_user)
-    if not method_ref:
-      raise exception.ApiInvalidMethod('Invalid method: %s' % method)
+    if batch is not None:
+      rv = _call_api_batch(api_user, batch)
+      return render_api_response(rv, format, servertime=servertime,
+                                 fields=fields, request=request)
+
+    method = kwargs.pop('method', '')
+    if_none_match = None
+    if method.replace('.', '_') in VERSIONED_METHODS:
+      if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '').strip('"')
+      if if_none_match and not kwargs.get('version'):
+        kwargs['version'] = if_none_match
+    rv = _call_api_method(api_user, method, kwargs)
+
+    version = None
+    if isinstance(rv, api.ResultWrapper):
+      version = rv.kw.get('version')
+    if version and version == if_none_match:
+      response = http.HttpResponseNotModified()
+    else:
+      response = render_api_response(rv, format, servertime=servertime,
+                                     fields=fields, request=request)
+    if version:
+      response['ETag'] = '"%s"' % version
+    return response
+  except oauth_util.OAuthError, e:
+    exc = exception.ApiOAuth(e.message)
+    return render_api_response(exc, format)
+  except exception.ApiException, e:
+    return render_api_response(e, format)
+  except TypeError, e:
+    exc = exception.ApiInvalidArguments(str(e))
+    return render_api_response(exc, format)
+  except:
+    exception.handle_exception(request)
+    return render_api_response(request.errors[0], format)
+
+  # some error happened
+  return render_api_response(request.errors[0], format)
+
+def api_push(request, format="json"):
+  """ long-poll for new entries in an actor's overview
 
+  takes the parameters of entry_get_actor_overview_since plus an optional
+  ``timeout`` in seconds, answers right away if there is something new and
+  otherwise holds on to the request until fanout adds an entry to the
+  overview or the timeout runs out, whichever comes first
+  """
+  servertime = api.utcnow()
+  try:
+    kwargs = oauth_util.get_method_kwargs(request)
+    kwargs.pop('method', None)
+    try:
+      timeout = float(kwargs.pop('timeout', settings.PUSH_MAX_WAIT))
+    except ValueError:
+      raise exception.ApiInvalidArguments('Invalid timeout')
+    timeout = max(0, min(timeout, settings.PUSH_MAX_WAIT))
+
+    if not settings.API_DISABLE_VERIFICATION:
+      api_user = request.user
+    else:
+      api_user = api.ROOT
     if not api_user:
       raise exception.ApiException('Invalid API user')
 
-    if getattr(api_user, 'legacy', None) and method == 'post':
-      kwargs['nick'] = api_user.nick
-
-    rv = method_ref(api_user, **kwargs)
-    if rv is None:
-      raise exception.ApiException('method %s returned None'%(method))
-    return render_api_response(rv, format, servertime=servertime)
+    inbox = 'inbox/%s/overview' % clean.nick(kwargs.get('nick', ''))
+    push_connection = push.PushConnection()
+    # take the cursor before looking so that nothing slips in between
+    cursor = push_connection.cursor(inbox)
+    rv = api.entry_get_actor_overview_since(api_user, **kwargs)
+    if not rv and settings.PUSH_ENABLED and timeout:
+      push_connection.watch(inbox)
+      push_connection.wait(inbox, cursor, timeout)
+      servertime = api.utcnow()
+      rv = api.entry_get_actor_overview_since(api_user, **kwargs)
+    return render_api_response(rv, format, servertime=servertime,
+                               request=request)
   except oauth_util.OAuthError, e:
     exc = exception.ApiOAuth(e.message)
     return render_api_response(exc, format)
@@ -308,8 +384,100 @@ def api_call(request, format="json"):
     exception.handle_exception(request)
     return render_api_response(request.errors[0], format)
 
-  # some error happened
-  return render_api_response(request.errors[0], format)
+def parse_fields(fields):
+  """Turns 'entries.uuid,entries.extra.title,actor.nick' into the nested
+  dict expected by ResultWrapper.to_api:
+
+    {'entries': {'uuid': {}, 'extra': {'title': {}}}, 'actor': {'nick': {}}}
+
+  an empty dict means the whole value, None means no selection at all
+  """
+  if not fields:
+    return None
+  o = {}
+  for path in fields.split(','):
+    parts = [p.strip() for p in path.split('.') if p.strip()]
+    if not parts:
+      continue
+    node = o
+    for i, part in enumerate(parts):
+      if part in node and not node[part]:
+        # an earlier, shorter path already asked for all of this
+        break
+      if i == len(parts) - 1:
+        node[part] = {}
+      else:
+        node = node.setdefault(part, {})
+  return o or None
+
+def _kwargs_from_json(parsed):
+  # Turn the keys from unicode to str so that they can be used as method
+  # parameters.
+  return dict([(str(k), v) for k, v in parsed.iteritems()])
+
+def _call_api_method(api_user, method, kwargs):
+  method = method.replace('.', '_')
+  if method == 'presence_send':
+    method = 'post'
+
+  if not method:
+    raise exception.ApiNoMethod('No method specified')
+
+  method_ref = api.PublicApi.get_method(method, api_user)
+  if not method_ref:
+    raise exception.ApiInvalidMethod('Invalid method: %s' % method)
+
+  if not api_user:
+    raise exception.ApiException('Invalid API user')
+
+  if getattr(api_user, 'legacy', None) and method == 'post':
+    kwargs['nick'] = api_user.nick
+
+  rv = method_ref(api_user, **kwargs)
+  if rv is None:
+    raise exception.ApiException('method %s returned None'%(method))
+  return rv
+
+def _call_api_batch(api_user, calls):
+  """ runs each call in order, collecting a response for each of them
+
+  the calls share the authentication done for the enclosing request and,
+  as they are all made during the same request, the CachingModel cache, so
+  entities fetched by one call are not fetched again by the next.
+  an error in one call is reported in its slot and does not stop the others
+  """
+  if not api_user:
+    raise exception.ApiException('Invalid API user')
+  if not calls:
+    raise exception.ApiNoMethod('No method specified')
+  if len(calls) > MAX_BATCH_CALLS:
+    raise exception.ApiInvalidArguments(
+        'Too many calls in batch, the maximum is %d' % MAX_BATCH_CALLS)
+
+  o = []
+  for call in calls:
+    try:
+      if not isinstance(call, dict):
+        raise exception.ApiInvalidArguments(
+            'Each call in a batch must be an object')
+      kwargs = _kwargs_from_json(call)
+      method = kwargs.pop('method', '')
+      if not isinstance(method, basestring):
+        raise exception.ApiInvalidMethod('Invalid method: %r' % (method,))
+      fields = kwargs.pop('fields', None)
+      if fields is not None and not isinstance(fields, basestring):
+        raise exception.ApiInvalidArguments('fields must be a string')
+      fields = parse_fields(fields)
+      rv = _call_api_method(api_user, method, kwargs)
+      o.append(_api_response_dict(rv, fields=fields))
+    except exception.ApiException, e:
+      o.append(_api_response_dict(e))
+    except exception.ValidationError, e:
+      o.append(_api_response_dict(e))
+    except (TypeError, UnicodeError), e:
+      # a bad argument name or an argument the method doesn't take
+      o.append(_api_response_dict(exception.ApiInvalidArguments(str(e))))
+  return api.PrimitiveResultWrapper(o)
 
 def api_xmlrpc(request):
   return _XML_RPC_DISPATCHER.dispatch(request)
@@ -434,8 +602,12 @@ def api_task_queue(request):
     return http.HttpResponse('')
 
   try:
-    actor_ref = api.actor_get(api.ROOT, task_ref.actor)
-    method_ref = api.PublicApi.get_method(task_ref.action)
+    # maintenance tasks run as root and may call root methods
+    if task_ref.actor == api.ROOT.nick:
+      actor_ref = api.ROOT
+    else:
+      actor_ref = api.actor_get(api.ROOT, task_ref.actor)
+    method_ref = api.PublicApi.get_method(task_ref.action, actor_ref)
     method_ref(actor_ref, _task_ref=task_ref, *task_ref.args, **task_ref.kw)
   except exception.Error:
     logging.exception('Unexpected error while processing queue:')
@@ -462,7 +634,7 @@ def _model_to_dict(rv):
   return o
 
 
-def render_api_response(rv, format="json", servertime=None):
+def _api_response_dict(rv, servertime=None, fields=None):
   if isinstance(rv, exception.ApiException):
     o = {"status": "error"}
     o.update(rv.to_dict())
@@ -471,9 +643,24 @@ def render_api_response(rv, format="json", servertime=None):
   else:
     o = {"status": "ok"}
     # TODO make this into something real
-    rv = {"rv": rv.to_api()}
+    rv = {"rv": rv.to_api(fields=fields)}
     o.update(rv)
     if servertime:
       o['servertime'] = str(servertime)
+  return o
 
-  return http.HttpResponse(simplejson.dumps(o))
+def render_api_response(rv, format="json", servertime=None, fields=None,
+                        request=None):
+  o = _api_response_dict(rv, servertime=servertime, fields=fields)
+  content = simplejson.dumps(o, separators=(',', ':'))
+
+  if (settings.API_GZIP_ENABLED
+      and request
+      and len(content) >= settings.API_GZIP_MIN_LENGTH
+      and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')):
+    response = http.HttpResponse(text.compress_string(content))
+    response['Content-Encoding'] = 'gzip'
+    cache.patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+  return http.HttpResponse(content)
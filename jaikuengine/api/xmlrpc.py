@@ -87,6 +87,10 @@ class XmlRpcDispatcher(object):
       self._dispatcher.register_function(
           name=name,
           function=XmlRpcDispatcher._wrap_api_call(method))
+    # system.multicall runs a list of {'methodName': ..., 'params': [...]}
+    # in one request, every call is still authenticated with its own params
+    # and a fault in one of them is returned in its slot
+    self._dispatcher.register_multicall_functions()
 
   def dispatch(self, request):
     return http.HttpResponse(content=self._dispatch(request),
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+usage: collapse_profiles.py [options] PROFILE [PROFILE ...]
+
+Merges profiles in the collapsed stack format, one 'frame;frame;frame weight'
+per line, into the input of flamegraph.pl:
+
+  collapse_profiles.py profile1.txt profile2.txt | flamegraph.pl > out.svg
+
+A PROFILE is a file, '-' for stdin, or the url of a view's profile on
+/_monitor/profile/<view>, which needs the cookie of an admin session.
+"""
+
+import optparse
+import sys
+import urllib2
+
+parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[0])
+parser.add_option('-c', '--cookie', action='store', dest='cookie',
+                  help='cookie header to send along when fetching urls')
+parser.add_option('-m', '--min', action='store', type='int',
+                  dest='min_weight',
+                  help='leave out stacks lighter than this')
+parser.add_option('-p', '--prefix', action='store', dest='prefix',
+                  help='only keep stacks going through frames that start '
+                       'with this, e.g. common/api.py')
+parser.add_option('-o', '--out', action='store', dest='output_file',
+                  help='file to write to instead of stdout')
+parser.set_defaults(min_weight=1)
+
+
+def read(source, cookie=None):
+  if source == '-':
+    return sys.stdin.read()
+  if source.startswith('http://') or source.startswith('https://'):
+    headers = {}
+    if cookie:
+      headers['Cookie'] = cookie
+    return urllib2.urlopen(urllib2.Request(source, None, headers)).read()
+  f = open(source)
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+def parse(text, into=None):
+  """ adds the stacks in text to into """
+  if into is None:
+    into = {}
+  for line in text.splitlines():
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      stack, weight = line.rsplit(' ', 1)
+      weight = int(weight)
+    except ValueError:
+      sys.stderr.write('skipping %r\n' % line)
+      continue
+    into[stack] = into.get(stack, 0) + weight
+  return into
+
+def keep(stack, prefix):
+  """ the part of stack from the first frame starting with prefix """
+  if not prefix:
+    return stack
+  frames = stack.split(';')
+  for i, frame in enumerate(frames):
+    if frame.startswith(prefix):
+      return ';'.join(frames[i:])
+  return None
+
+def main(options, args):
+  if not args:
+    parser.error('need at least one profile')
+
+  stacks = {}
+  for source in args:
+    parse(read(source, options.cookie), stacks)
+
+  merged = {}
+  for stack, weight in stacks.iteritems():
+    stack = keep(stack, options.prefix)
+    if stack:
+      merged[stack] = merged.get(stack, 0) + weight
+
+  out = sys.stdout
+  if options.output_file:
+    out = open(options.output_file, 'w')
+  for stack, weight in sorted(merged.iteritems()):
+    if weight >= options.min_weight:
+      out.write('%s %d\n' % (stack, weight))
+  if out is not sys.stdout:
+    out.close()
+
+if __name__ == '__main__':
+  (options, args) = parser.parse_args()
+  main(options, args)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+usage: compare_benchmarks.py [options] old.json new.json
+
+Diffs two runs of the fanout or read benchmarks, the files holding the
+JSON lines they write to FANOUT_BENCHMARK_OUTPUT or READ_BENCHMARK_OUTPUT.
+Runs are paired by benchmark and dataset, the last run of each pair in a
+file is the one compared.
+
+Exits with 1 if anything grew by more than --threshold percent.
+"""
+
+import optparse
+import sys
+
+import simplejson
+
+parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[0])
+parser.add_option('-t', '--threshold', action='store', type='float',
+                  dest='threshold',
+                  help='percent growth reported as a regression')
+parser.add_option('-a', '--all', action='store_true', dest='show_all',
+                  help='also show values that did not change')
+parser.set_defaults(threshold=10.0, show_all=False)
+
+# metadata rather than measurements
+IGNORED = ('time', 'graph', 'dataset', 'iterations')
+
+
+def run_key(report):
+  dataset = report.get('graph', report.get('dataset', {}))
+  return '%s %s' % (report.get('benchmark'),
+                    simplejson.dumps(dataset, sort_keys=True))
+
+def load(filename):
+  runs = {}
+  for line in open(filename):
+    line = line.strip()
+    if not line:
+      continue
+    report = simplejson.loads(line)
+    runs[run_key(report)] = report
+  return runs
+
+def flatten(o, prefix=''):
+  out = {}
+  for k, v in o.iteritems():
+    if k in IGNORED:
+      continue
+    path = prefix and '%s.%s' % (prefix, k) or k
+    if isinstance(v, dict):
+      out.update(flatten(v, path))
+    elif isinstance(v, (int, long, float)):
+      out[path] = v
+  return out
+
+def compare(old, new, threshold, show_all=False):
+  """ returns the rows to print and whether anything regressed """
+  old = flatten(old)
+  new = flatten(new)
+  rows = []
+  regressed = False
+  for path in sorted(set(old) | set(new)):
+    a = old.get(path)
+    b = new.get(path)
+    if a is None or b is None:
+      rows.append((path, a, b, None))
+      continue
+    if a == b and not show_all:
+      continue
+    change = a and (b - a) * 100.0 / a or None
+    if change is not None and change > threshold:
+      regressed = True
+    rows.append((path, a, b, change))
+  return rows, regressed
+
+def _format(v):
+  if v is None:
+    return '-'
+  if isinstance(v, float):
+    return '%.2f' % v
+  return str(v)
+
+def main(options, args):
+  if len(args) != 2:
+    parser.error('need an old and a new file')
+
+  old_runs = load(args[0])
+  new_runs = load(args[1])
+  regressed = False
+  for key in sorted(set(old_runs) & set(new_runs)):
+    rows, run_regressed = compare(old_runs[key], new_runs[key],
+                                  options.threshold, options.show_all)
+    regressed = regressed or run_regressed
+    print key
+    for path, a, b, change in rows:
+      flag = ''
+      if change is not None and change > options.threshold:
+        flag = ' !'
+      change = change is not None and '%+.1f%%' % change or '-'
+      print '  %-60s %12s %12s %8s%s' % (path, _format(a), _format(b),
+                                         change, flag)
+  for key in sorted(set(old_runs) ^ set(new_runs)):
+    print '%s: only in one of the runs' % key
+  return regressed and 1 or 0
+
+if __name__ == '__main__':
+  (options, args) = parser.parse_args()
+  sys.exit(main(options, args))
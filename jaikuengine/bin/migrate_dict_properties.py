@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import getpass
+import logging
+import optparse
+import sys
+
+sys.path.append(".")
+sys.path.append("./vendor")
+
+from appengine_django import InstallAppengineHelperForDjango
+InstallAppengineHelperForDjango()
+
+from google.appengine.api import datastore
+from google.appengine.api.datastore_types import Blob
+from google.appengine.ext.remote_api import remote_api_stub
+
+from common import properties
+
+# every kind with a DictProperty and the names of those properties
+KINDS = {'Presence': ['extra'],
+         'PresenceHistory': ['history'],
+         'Stream': ['extra'],
+         'StreamEntry': ['extra'],
+         'Subscription': ['extra'],
+         'Task': ['kw'],
+         }
+
+class DictPropertyMigrator(object):
+  """Rewrites DictProperty values still stored as legacy pickles in the
+  current codec, see properties.dumps_dict.
+
+  Works on the raw entities so that only the blobs change and entities
+  already migrated are left alone, running it again merely picks up what
+  was written as a pickle since. Values JSON can't carry stay pickles, they
+  are logged and counted apart rather than written back unchanged.
+
+  Make sure to run it from the top jaikuengine directory. The following
+  command would migrate a local testing instance:
+  './bin/migrate_dict_properties.py -w -s localhost:8080'
+  """
+
+  def __init__(self, do_write):
+    self._do_write = do_write
+
+  def get_query(self, kind, last_key=None):
+    q = datastore.Query(kind)
+    if last_key:
+      q['__key__ >'] = last_key
+    q.Order('__key__')
+    return q
+
+  def migrate(self, entity, names):
+    """Returns whether any of the names of entity were migrated, and the
+    names still holding a pickle because their value can't be JSON, those
+    are left as they are rather than put again.
+    """
+    changed = False
+    stuck = []
+    for name in names:
+      value = entity.get(name)
+      if value is None or not properties.is_legacy_dict(str(value)):
+        continue
+      new = properties.dumps_dict(properties.loads_dict(str(value)))
+      if properties.is_legacy_dict(new):
+        stuck.append(name)
+        continue
+      entity[name] = Blob(new)
+      changed = True
+    return changed, stuck
+
+  def run(self, kinds, batch_size=100):
+    for kind in kinds:
+      entities = self.get_query(kind).Get(batch_size)
+      processed = migrated = unmigratable = 0
+      while entities:
+        to_put = []
+        for entity in entities:
+          changed, stuck = self.migrate(entity, KINDS[kind])
+          if changed:
+            to_put.append(entity)
+          if stuck:
+            unmigratable += 1
+            logging.warning("%s: %s can't be migrated: %s", kind,
+                            entity.key().id_or_name(),
+                            ", ".join(stuck))
+        if to_put and self._do_write:
+          datastore.Put(to_put)
+        processed += len(entities)
+        migrated += len(to_put)
+        logging.info("%s: %d processed, %d %s, %d can't be migrated", kind,
+                     processed, migrated,
+                     self._do_write and "migrated" or "would be migrated",
+                     unmigratable)
+        entities = self.get_query(kind, entities[-1].key()).Get(batch_size)
+
+
+def auth_function():
+  return (raw_input("Username: "), getpass.getpass("Password:"))
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("-b", "--batch_size", dest="batch_size", default=100,
+                    help="number of entities to fetch in a single query")
+  parser.add_option("-k", "--kind", dest="kinds", action="append",
+                    help="only migrate this kind, may be repeated, one of "
+                         + ", ".join(sorted(KINDS)))
+  parser.add_option("-w", "--write", dest="write", action="store_true",
+                    default=False, help="write results back to data store")
+  parser.add_option("-a", "--app_id", dest="app_id",
+                    help="the app_id of your app, as declared in app.yaml")
+  parser.add_option("-s", "--servername", dest="servername",
+                    help="the hostname your app is deployed on. Defaults to"
+                         "<app_id>.appspot.com")
+  (options, args) = parser.parse_args()
+  kinds = options.kinds or sorted(KINDS)
+  for kind in kinds:
+    if kind not in KINDS:
+      parser.error("unknown kind %s" % kind)
+
+  logging.getLogger().setLevel(logging.INFO)
+  remote_api_stub.ConfigureRemoteDatastore(app_id=options.app_id,
+                                           path='/remote_api',
+                                           auth_func=auth_function,
+                                           servername=options.servername)
+
+  DictPropertyMigrator(options.write).run(kinds, int(options.batch_size))
+
+if __name__ == "__main__":
+  main()
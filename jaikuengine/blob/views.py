@@ -23,18 +23,78 @@ from common.display import prep_stream_dict, prep_entry_list, prep_entry, prep_c
 from common import decorator
 from common import exception
 from common import api
+from common import imagecache
 
 
+def _parse_range(header, length):
+  """Parses a single byte range, returns (first, last) byte, None to send
+  the whole image and False if the range is past its end."""
+  if not header or not header.startswith('bytes=') or ',' in header:
+    return None
+  first, sep, last = header[len('bytes='):].strip().partition('-')
+  try:
+    if not first:
+      # the last n bytes
+      first, last = max(length - int(last), 0), length - 1
+    elif not last:
+      first, last = int(first), length - 1
+    else:
+      first, last = int(first), int(last)
+  except ValueError:
+    return None
+  if first > last:
+    return None
+  if first >= length:
+    return False
+  return first, min(last, length - 1)
+
+def _etag_matches(header, etag):
+  if not header:
+    return False
+  tags = [t.strip() for t in header.split(',')]
+  return '*' in tags or etag in tags
+
 @decorator.cache_forever
 def blob_image_jpg(request, nick, path):
   try:
-    img = api.image_get(request.user, nick, path, format='jpg')
+    keyname = 'image/%s/%s.jpg' % (nick, path)
+    img = imagecache.get(
+        keyname, lambda: api.image_get(request.user, nick, path, format='jpg'))
     if not img:
       return http.HttpResponseNotFound()
 
+    if _etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), img.etag):
+      response = http.HttpResponseNotModified()
+      response['ETag'] = img.etag
+      return response
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range or if_range == img.etag:
+      byte_range = _parse_range(request.META.get('HTTP_RANGE'), img.length)
+
+    content = img.content
+    if content is None and byte_range is not False:
+      img_ref = api.image_get(request.user, nick, path, format='jpg')
+      if not img_ref:
+        return http.HttpResponseNotFound()
+      content = str(img_ref.content)
+
     content_type = "image/jpg"
-    response = http.HttpResponse(content_type=content_type)
-    response.write(img.content)
+    if byte_range is False:
+      response = http.HttpResponse(status=416, content_type=content_type)
+      response['Content-Range'] = 'bytes */%d' % img.length
+    elif byte_range:
+      first, last = byte_range
+      response = http.HttpResponse(status=206, content_type=content_type)
+      response['Content-Range'] = 'bytes %d-%d/%d' % (first, last,
+                                                      img.length)
+      response.write(content[first:last + 1])
+    else:
+      response = http.HttpResponse(content_type=content_type)
+      response.write(content)
+    response['ETag'] = img.etag
+    response['Accept-Ranges'] = 'bytes'
     return response
   except exception.ApiException, e:
     logging.info("exc %s", e)
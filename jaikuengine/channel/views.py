@@ -179,31 +179,22 @@ def channel_history(request, nick, format='html'):
   offset, prev = util.page_offset(request)
 
   if privacy == 'public':
-    inbox = api.inbox_get_actor_public(
-        request.user,
-        view.nick,
-        limit=(per_page + 1),
-        offset=offset)
+    fetch = lambda limit, offset: api.inbox_get_actor_public(
+        request.user, view.nick, limit=limit, offset=offset)
   elif privacy == 'contacts':
-    inbox = api.inbox_get_actor_contacts(
-        request.user,
-        view.nick,
-        limit=(per_page + 1),
-        offset=offset)
+    fetch = lambda limit, offset: api.inbox_get_actor_contacts(
+        request.user, view.nick, limit=limit, offset=offset)
   elif privacy == 'private':
-    inbox = api.inbox_get_actor_private(
-        api.ROOT,
-        view.nick,
-        limit=(per_page + 1),
-        offset=offset)
+    fetch = lambda limit, offset: api.inbox_get_actor_private(
+        api.ROOT, view.nick, limit=limit, offset=offset)
 
   # START inbox generation chaos
   # TODO(termie): refacccttttooorrrrr
 
-  entries = api.entry_get_entries(request.user, inbox)
-  # clear out deleted entries
-  per_page = per_page - (len(inbox) - len(entries))
-  entries, more = util.page_entries(request, entries, per_page)
+  # deleted and hidden entries are refilled by entry_get_page
+  entries, more = api.entry_get_page(
+      request.user, 'inbox/%s/%s' % (view.nick, privacy), per_page,
+      offset=offset, fetch=fetch)
 
   stream_keys = [e.stream for e in entries]
   actor_streams = api.stream_get_actor(request.user, view.nick)
@@ -13,10 +13,15 @@
 # limitations under the License.
 
 import base64
+import bisect
+import calendar
 import datetime
 import logging
+import math
 import random
 import re
+import time
+import zlib
 try:
   import cPickle as pickle
 except ImportError:
@@ -34,9 +39,10 @@ from google.appengine.api import images
 from google.appengine.api.labs import taskqueue
 
 from common.models import Stream, StreamEntry, InboxEntry, Actor, Relation
+from common.models import InboxBucket
 from common.models import Subscription, Invite, OAuthConsumer, OAuthRequestToken
 from common.models import OAuthAccessToken, Image, Activation
-from common.models import KeyValue, Presence
+from common.models import KeyValue, Presence, PresenceHistory
 from common.models import AbuseReport
 from common.models import Task
 from common.models import PRIVACY_PRIVATE, PRIVACY_CONTACTS, PRIVACY_PUBLIC
@@ -45,10 +51,12 @@ from common import clean
 from common import clock
 from common import context_processors
 from common import exception
+from common import imagecache
 from common import imageutil
 from common import mail
 from common import memcache
 from common import models
+from common import monitor
 from common import normalize
 from common import patterns
 from common import properties
@@ -56,6 +64,7 @@ from common import throttle
 from common import util
 from common import validate
 from common.protocol import pshb
+from common.protocol import push
 from common.protocol import sms
 from common.protocol import xmpp
 
@@ -96,6 +105,46 @@ MAX_FOLLOWERS_PER_INBOX = 100
 # The maximum number of followers we can notify per task iteration
 MAX_NOTIFICATIONS_PER_TASK = 100
 
+# How long to remember the last write to an inbox, see _touch_inboxes
+INBOX_MARKER_TIMEOUT = 60 * 60 * 24
+
+# How often to retry moving an inbox marker forward before giving up on it
+INBOX_MARKER_RETRIES = 3
+
+# How much time an InboxBucket covers, in seconds
+INBOX_BUCKET_SECONDS = 60 * 60 * 24
+
+# How many buckets, newest first, a read of an inbox gets at once
+INBOX_BUCKET_SPAN = 7
+
+# The most entries kept in a bucket, older ones are dropped beyond that
+INBOX_BUCKET_MAX_ENTRIES = 5000
+
+# How long to remember the privacy generation of an actor and whom their
+# contacts are, see _inbox_invisible
+VISIBILITY_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Past this many followers we stop keeping track of whom they let see what
+# they keep to their contacts
+VISIBILITY_MAX_CONTACT_OWNERS = 1000
+
+# How many InboxEntry rows a task of inbox_restamp updates at a time
+INBOX_RESTAMP_BATCH = 100
+
+# The most batches of inbox keys entry_get_page fetches for one page
+PAGE_MAX_FETCHES = 3
+
+# How far one page moves the share of entries entry_get_page expects to
+# keep for an inbox, and the least share it plans for
+PAGE_RATIO_WEIGHT = 0.3
+PAGE_RATIO_FLOOR = 0.2
+
+# How long presence updates are buffered before they go to history, seconds
+PRESENCE_FLUSH_DELAY = 60
+
+# How often to retry updating the presence buffer in memcache
+PRESENCE_BUFFER_RETRIES = 3
+
 # The first notification type to handle
 FIRST_NOTIFICATION_TYPE = 'im'
 
@@ -780,6 +829,7 @@ def actor_add_contact(api_user, owner, target):
                        target=target_ref.nick,
                        )
     rel_ref.put()
+    _contact_owners_forget(target_ref.nick)
   else:
     rel_ref = existing_rel_ref
 
@@ -1178,6 +1228,7 @@ def actor_remove_contact(api_user, owner, target):
         'Cannot remove a relationship that does not exist')
 
   rel.delete()
+  _contact_owners_forget(target_ref.nick)
 
   # Decrease the counts for each
   owner_ref.extra.setdefault('contact_count', 1)
@@ -1224,6 +1275,7 @@ def actor_update_intermediate_password(api_user, nick, password):
 def avatar_clear_actor(api_user, nick):
   actor_ref = actor_get(ROOT, nick)
   actor_ref.extra['icon'] = util.DEFAULT_AVATAR_PATH
+  actor_ref.extra.pop('icon_pending', None)
   actor_ref.avatar_updated_at = utcnow()
   actor_ref.put()
   return True
@@ -1235,26 +1287,97 @@ def avatar_set_actor(api_user, nick, path):
 
   actor_ref = actor_get(ROOT, nick)
   actor_ref.extra['icon'] = path
+  if _avatar_pending(path):
+    # avatar_resize shows it once the sizes exist
+    actor_ref.extra['icon_pending'] = True
+  else:
+    actor_ref.extra.pop('icon_pending', None)
   actor_ref.avatar_updated_at = utcnow()
   actor_ref.put()
 
+  if actor_ref.extra.get('icon_pending') and not _avatar_pending(path):
+    # avatar_resize finished between our look and the put, while the actor
+    # still had the old icon, so showing the new one is up to us
+    actor_ref.extra.pop('icon_pending', None)
+    actor_ref.put()
+
   return True
 
+def _avatar_pending(path):
+  """Whether the sizes of an uploaded avatar are still being made."""
+  match = patterns.AVATAR_PARTIAL_PATH_COMPILED.match(path)
+  if not match.group('nick'):
+    return False
+  nick, name = match.group('nick'), match.group('path')
+  # a list of keys skips the per request cache, the sizes may have been
+  # stored since we last looked
+  keyname = 'image/%s/%s_t.jpg' % (nick, name)
+  if Image.get_by_key_name([keyname])[0]:
+    return False
+  return not image_get(ROOT, nick, '%s_t' % name)
+
 @throttled(minute=5, hour=30)
 @owner_required
 @catch_image_error
 def avatar_upload(api_user, nick, content):
-  """ accept uploaded binary content, save an original and
-  make a few smaller sizes, assign the proper fields to the user
+  """ accept uploaded binary content and save it as the original, the
+  smaller sizes are made by avatar_resize in a task. Until they exist the
+  avatar is shown as the default one, see avatar_set_actor.
+  """
+  nick = clean.nick(nick)
+
+  # the dimensions are read from the header, so this is cheap, but it
+  # refuses anything that isn't an image before we store it
+  images.Image(content).width
+
+  path_uuid = util.generate_uuid()
+  path = '%s/avatar_%s' % (nick, path_uuid)
+  image_set(api_user,
+            nick,
+            path='avatar_%s_original' % path_uuid,
+            content=content,
+            format='jpg',
+            size='original')
+
+  task_ref = Task(actor=ROOT.nick,
+                  action='avatar_resize',
+                  action_id=path,
+                  progress='',
+                  args=[],
+                  kw={'nick': nick, 'path': path})
+  try:
+    task_ref.add_to_queue()
+  except taskqueue.Error:
+    exception.log_exception()
+    avatar_resize(ROOT, nick, path)
+
+  # TODO(termie): this returns somewhat differently than background_upload below,
+  return path
+
+@admin_required
+@catch_image_error
+def avatar_resize(api_user, nick, path, _task_ref=None):
+  """Makes the AVATAR_IMAGE_SIZES of an uploaded avatar from its original
+  and stores them in one put, then shows the avatar if it is still the one
+  the actor is using.
   """
   nick = clean.nick(nick)
-  resized = {'original': content}
+  original_ref = Image.get_by_key_name('image/%s_original.jpg' % path)
+  if not original_ref:
+    logging.warning('avatar_resize: no original for %s', path)
+    return False
+  content = original_ref.content
 
-  # Crop to a square
-  jpeg = images.crop(content,
-                     0.0, 0.0, 1.0, 1.0,
-                     output_encoding=images.JPEG)
-  original_size = imageutil.size_from_jpeg(jpeg)
+  # Crop to a square, the size is read from the header of JPEG, PNG and
+  # GIF images, anything else is converted to a JPEG first to find it
+  header = imageutil.image_header(buffer(content))
+  if header:
+    original_size = header[1:]
+  else:
+    jpeg = images.crop(content,
+                       0.0, 0.0, 1.0, 1.0,
+                       output_encoding=images.JPEG)
+    original_size = imageutil.size_from_jpeg(jpeg)
   if original_size and original_size[0] != original_size[1]:
     dimension = min(original_size)
     crop_to = _crop_to_square(original_size, (dimension, dimension))
@@ -1262,27 +1385,34 @@ def avatar_upload(api_user, nick, content):
                           *crop_to)
 
   # note: we only support JPEG format at the moment
-  for size, dimensions in AVATAR_IMAGE_SIZES.items():
-    resized[size] = images.resize(content, output_encoding=images.JPEG,
-                                  *dimensions)
-
-  path_uuid = util.generate_uuid()
+  resize_async = getattr(images, 'resize_async', None)
+  if resize_async:
+    rpcs = [(size, resize_async(content, output_encoding=images.JPEG,
+                                *dimensions))
+            for size, dimensions in AVATAR_IMAGE_SIZES.items()]
+    resized = [(size, rpc.get_result()) for size, rpc in rpcs]
+  else:
+    resized = [(size, images.resize(content, output_encoding=images.JPEG,
+                                    *dimensions))
+               for size, dimensions in AVATAR_IMAGE_SIZES.items()]
 
-  # XXX begin transaction
-  for img_size, img_data in resized.iteritems():
-    path = 'avatar_%s_%s' % (path_uuid, img_size)
-
-    # TODO: Check for hash collisions before uploading (!!)
-    img_ref = image_set(api_user,
-                        nick,
-                        path=path,
-                        content=img_data,
-                        format='jpg',
-                        size=img_size)
-  # XXX end transaction
+  # TODO: Check for hash collisions before uploading (!!)
+  image_refs = [Image(key_name='image/%s_%s.jpg' % (path, size),
+                      actor='actor/%s' % nick,
+                      content=db.Blob(img_data),
+                      size=size)
+                for size, img_data in resized]
+  db.put(image_refs)
+  for image_ref in image_refs:
+    image_ref._remove_from_cache()
+    imagecache.forget_missing(image_ref.key().name())
 
-  # TODO(termie): this returns somewhat differently than background_upload below,
-  return '%s/avatar_%s' % (nick, path_uuid)
+  actor_ref = actor_get(ROOT, nick)
+  if (actor_ref.extra.get('icon') == path
+      and actor_ref.extra.pop('icon_pending', None)):
+    actor_ref.avatar_updated_at = utcnow()
+    actor_ref.put()
+  return True
 
 #######
 #######
@@ -1936,7 +2066,11 @@ def entry_get_entries_dict(api_user, entries, hide_comments=False):
   if not entries:
     return out
 
+  # whatever the inbox already knows we can't see
+  invisible = getattr(entries, 'invisible', ())
   for entry in set(entries):
+    if entry in invisible:
+      continue
     entry_ref = entry_get_safe(api_user, entry)
     if entry_ref:
       if not hide_comments:
@@ -1946,11 +2080,105 @@ def entry_get_entries_dict(api_user, entries, hide_comments=False):
 
   return out
 
-def entry_get_inbox_since(api_user, inbox, limit=30, since_time=None):
+def entry_get_page(api_user, inbox, per_page, offset=None, fetch=None,
+                   hide_comments=False):
+  """Returns a page of per_page entries of inbox on or before offset that
+  api_user can see, and the offset of the next page, None on the last one.
+
+  The keys are over-fetched by the share of entries this inbox has been
+  losing to deletion and privacy, and a page that still comes up short is
+  refilled from where its last batch ended, up to PAGE_MAX_FETCHES
+  batches. Every batch fetches one key more than it looks at, the offset
+  of the next batch or page is when that one was created so that it
+  doesn't repeat what this one showed. fetch(limit, offset) returns the
+  keys, by default from inbox_get_entries.
+  """
+  if fetch is None:
+    fetch = lambda limit, offset: inbox_get_entries(api_user, inbox,
+                                                    limit=limit,
+                                                    offset=offset)
+  ratio_key = 'page_ratio/%s' % inbox
+  ratio = memcache.client.get(ratio_key) or 1.0
+
+  want = per_page + 1
+  start = offset
+  entries = []
+  seen = set()
+  fetched = 0
+  resume = None
+  for i in range(PAGE_MAX_FETCHES):
+    missing = want - len(entries)
+    # one key more than the batch, where the next batch or page picks up
+    limit = clean.limit(
+        math.ceil(missing / max(ratio, PAGE_RATIO_FLOOR)) + 1)
+    keys = fetch(limit, offset)
+    batch = [k for k in keys[:limit - 1] if k not in seen]
+    seen.update(batch)
+    fetched += len(batch)
+    entries += entry_get_entries(
+        api_user,
+        InboxKeys(batch, getattr(keys, 'invisible', None)),
+        hide_comments)
+
+    resume = None
+    if len(keys) < limit:
+      # the end of the inbox
+      break
+    # when the key after the batch was created
+    resume = getattr(keys, 'last', None)
+    if not batch and resume and resume == offset:
+      # more entries at this one instant than a batch holds, the rest of
+      # them are skipped rather than ending the paging here
+      resume -= datetime.timedelta(microseconds=1)
+    if len(entries) >= want or not resume:
+      break
+    offset = resume
+
+  if fetched:
+    observed = len(entries) / float(fetched)
+    ratio = ratio * (1 - PAGE_RATIO_WEIGHT) + observed * PAGE_RATIO_WEIGHT
+    memcache.client.set(ratio_key, ratio)
+
+  if len(entries) > per_page:
+    entries, resume = entries[:per_page], entries[per_page].created_at
+  elif not resume:
+    return entries, None
+  # otherwise out of batches, the next page picks up where we stopped looking
+  if resume == start:
+    # a whole page at the instant we started from, move past it
+    resume -= datetime.timedelta(microseconds=1)
+  return entries, util.page_cursor(resume)
+
+def entry_get_inbox_since(api_user, inbox, limit=30, since_time=None,
+                          version=None):
+  """Returns the entries of an inbox on or after since_time.
+
+  Polls that the inbox change marker can answer on its own never touch the
+  datastore: when nothing has been written to the inbox since since_time,
+  or since the complete response that handed out `version`, the result is
+  empty. The returned version is only set for complete responses.
+  """
+  limit = clean.limit(limit)
+  if since_time is not None:
+    since_time = clean.datetime(since_time)
+
+  # read the marker before the query, a write racing with us only makes
+  # the version we hand out stale, which costs the client one more fetch
+  marker = _inbox_marker(inbox)
+  current = None
+  if marker is not None:
+    current = _inbox_version(marker, limit, since_time)
+    if version and version == current:
+      return ResultWrapper([], entries=[], version=current)
+    if since_time is not None and _datetime_to_usec(since_time) > marker:
+      return ResultWrapper([], entries=[], version=current)
+
   inbox = inbox_get_entries_since(
       api_user, inbox, limit=limit, since_time=since_time)
   entries = entry_get_entries(api_user, inbox)
-  return ResultWrapper(entries, entries=entries)
+  if current is None or len(inbox) >= limit:
+    return ResultWrapper(entries, entries=entries)
+  return ResultWrapper(entries, entries=entries, version=current)
 
 def entry_get_inbox(api_user, inbox, limit=30, offset=None):
   inbox = inbox_get_entries(api_user, inbox, limit=limit, offset=offset)
@@ -1983,7 +2211,8 @@ def entry_get_actor_overview(api_user, nick, limit=30, offset=None):
   return entry_get_inbox(api_user, inbox, limit=limit, offset=offset)
 
 @owner_required
-def entry_get_actor_overview_since(api_user, nick, limit=30, since_time=None):
+def entry_get_actor_overview_since(api_user, nick, limit=30, since_time=None,
+                                   version=None):
   """Returns stream entries for a user's overview on or after a certain time.
 
   This is a useful call if you are trying to periodically poll to keep
@@ -2063,6 +2292,7 @@ def entry_remove(api_user, entry):
   if entry_ref.entry:
     raise exception.ApiException("Cannot call entry_remove on a comment")
   entry_ref.mark_as_deleted()
+  _queue_inbox_restamp({'stream': entry_ref.stream, 'uuid': entry_ref.uuid})
 
 @delete_required
 @owner_required_by_entry
@@ -2082,6 +2312,8 @@ def entry_remove_comment(api_user, comment):
   entry_ref.put()
   comment_ref.mark_as_deleted()
   # XXX end transaction
+  _queue_inbox_restamp({'stream': comment_ref.stream,
+                        'uuid': comment_ref.uuid})
 
 #######
 #######
@@ -2177,7 +2409,11 @@ def image_get(api_user, nick, path, format='jpg'):
   
   # LEGACY COMPAT
   if not image_ref:
-    actor_ref = actor_get(ROOT, nick)
+    try:
+      actor_ref = actor_get(ROOT, nick)
+    except exception.ApiNotFound:
+      # nobody by that nick, so no image either
+      return None
     image_ref = Image.get_by_key_name(keyname,
                                       parent=actor_ref.key())
   return image_ref
@@ -2191,7 +2427,8 @@ def image_get_all_keys(api_user, nick, size):
 @public_owner_or_contact
 def image_set(api_user, nick, path, content, format='jpg', size=None):
   nick = clean.nick(nick)
-  params = {'key_name': 'image/%s/%s.%s' % (nick, path, format),
+  keyname = 'image/%s/%s.%s' % (nick, path, format)
+  params = {'key_name': keyname,
             'actor': 'actor/%s' % nick,
             'content': db.Blob(content),
             }
@@ -2200,6 +2437,7 @@ def image_set(api_user, nick, path, content, format='jpg', size=None):
 
   image_ref = Image(**params)
   image_ref.put()
+  imagecache.forget_missing(keyname)
   return image_ref
 
 #######
@@ -2221,6 +2459,10 @@ def inbox_copy_entries(api_user, target, nick, limit=5):
     if inbox_item not in entry.inbox:
       entry.inbox.append(inbox_item)
     entry.put()
+    if settings.INBOX_BACKEND != 'index':
+      _bucket_append([inbox_item], entry.stream_type,
+                     entry.stream_entry_keyname(), entry.created_at)
+  _touch_inboxes(['inbox/%s/overview' % nick])
   return
 
 @public_owner_or_contact
@@ -2253,29 +2495,47 @@ def inbox_get_actor_public(api_user, nick, limit=5, offset=None,
 def inbox_get_entries(api_user, inbox, limit=30, offset=None, 
                       stream_type=None):
   limit = clean.limit(limit)
-  query = InboxEntry.Query().filter('inbox =', inbox).order('-created_at')
   if offset is not None:
     offset = clean.datetime(offset)
+  if settings.INBOX_BACKEND == 'bucket':
+    rv = _bucket_get_entries(inbox, limit, offset=offset,
+                             stream_type=stream_type)
+    if rv is not None:
+      return rv
+
+  query = InboxEntry.Query().filter('inbox =', inbox).order('-created_at')
+  if offset is not None:
     query.filter('created_at <=', offset)
   if stream_type is not None:
     query.filter('stream_type =', stream_type)
 
   results = query.fetch(limit=limit)
-  return [x.stream_entry_keyname() for x in results]
+  return InboxKeys([x.stream_entry_keyname() for x in results],
+                   _inbox_invisible(api_user, results),
+                   last=results and results[-1].created_at or None)
 
 def inbox_get_entries_since(api_user, inbox, limit=30, since_time=None, 
                             stream_type=None):
   limit = clean.limit(limit)
-  query = InboxEntry.Query().filter('inbox =', inbox).order('created_at')
   if since_time is not None:
     since_time = clean.datetime(since_time)
+  if settings.INBOX_BACKEND == 'bucket':
+    rv = _bucket_get_entries_since(inbox, limit, since_time=since_time,
+                                   stream_type=stream_type)
+    if rv is not None:
+      return rv
+
+  query = InboxEntry.Query().filter('inbox =', inbox).order('created_at')
+  if since_time is not None:
     query.filter('created_at >=', since_time)
 
   if stream_type is not None:
     query.filter('stream_type =', stream_type)
 
   results = query.fetch(limit=limit)
-  return [x.stream_entry_keyname() for x in results]
+  return InboxKeys([x.stream_entry_keyname() for x in results],
+                   _inbox_invisible(api_user, results),
+                   last=results and results[-1].created_at or None)
 
 def inbox_get_explore(api_user, limit=30, offset=None):
   inbox = 'inbox/%s/explore' % ROOT.nick
@@ -2292,6 +2552,100 @@ def inbox_get_all_for_entry(api_user, stream, uuid, entry=None):
     inboxes += inbox_entry.inbox
   return inboxes
 
+@admin_required
+def inbox_check_buckets(api_user, inbox, limit=100, repair=False):
+  """Compares the newest entries of an inbox in the InboxEntry index with
+  its buckets, within the buckets a read would look at.
+
+  Returns the entry keys the buckets are missing and the ones only they
+  have, with repair the missing ones are added to the buckets.
+  """
+  limit = clean.limit(limit, 1000)
+  if _bucket_excluded(inbox):
+    return {'checked': 0, 'missing': [], 'extra': []}
+  query = InboxEntry.Query().filter('inbox =', inbox).order('-created_at')
+  indexed = [(_datetime_to_usec(x.created_at), x.stream_type,
+              x.stream_entry_keyname()) for x in query.fetch(limit)]
+
+  newest = _bucket_index(utcnow())
+  oldest = newest - INBOX_BUCKET_SPAN + 1
+  since = oldest * INBOX_BUCKET_SECONDS * 1000000
+  if len(indexed) == limit:
+    # entries created at the same time as the last one may have been cut
+    since = max(since, indexed[-1][0] + 1)
+  bucketed = []
+  for bucket_ref in _bucket_get(inbox, range(oldest, newest + 1)):
+    bucketed += _bucket_unpack(bucket_ref)
+
+  indexed = set([x for x in indexed if x[0] >= since])
+  bucketed = set([x for x in bucketed if x[0] >= since])
+  missing = sorted(indexed - bucketed)
+  if repair:
+    for item in missing:
+      db.run_in_transaction(_bucket_append_one, inbox,
+                            item[0] / (INBOX_BUCKET_SECONDS * 1000000), item)
+  return {'checked': len(indexed),
+          'missing': [x[2] for x in missing],
+          'extra': [x[2] for x in sorted(bucketed - indexed)],
+          }
+
+@admin_required
+def inbox_restamp(api_user, owner=None, stream=None, uuid=None,
+                  _task_ref=None):
+  """Stamps the InboxEntry rows of owner with their current visibility
+  after a privacy change, or those of the entry stream/uuid as deleted.
+
+  Does INBOX_RESTAMP_BATCH rows at a time, a task queues itself again for
+  the rest. Returns how many rows it updated.
+  """
+  query = InboxEntry.all()
+  if owner:
+    query.filter('owner =', owner)
+  else:
+    query.filter('stream =', stream)
+    query.filter('uuid =', uuid)
+  if _task_ref and _task_ref.progress:
+    query.filter('__key__ >', db.Key(_task_ref.progress))
+  query.order('__key__')
+  results = query.fetch(INBOX_RESTAMP_BATCH)
+
+  for inbox_ref in results:
+    if owner:
+      # comments go by the entry they are on
+      stamp = _visibility_stamp(inbox_ref.entry
+                                or inbox_ref.stream_entry_keyname())
+      inbox_ref.visibility = stamp.get('visibility')
+      inbox_ref.generation = stamp.get('generation')
+    else:
+      inbox_ref.deleted = True
+  if results:
+    db.put(results)
+    # what these inboxes show has changed, polls must not be answered from
+    # the markers they had before
+    _touch_inboxes(set([inbox for inbox_ref in results
+                        for inbox in inbox_ref.inbox]))
+
+  if _task_ref and len(results) == INBOX_RESTAMP_BATCH:
+    _task_ref.progress = str(results[-1].key())
+    try:
+      _task_ref.add_to_queue()
+    except taskqueue.Error:
+      exception.log_exception()
+  return PrimitiveResultWrapper(len(results))
+
+def _queue_inbox_restamp(kw):
+  task_ref = Task(actor=ROOT.nick,
+                  action='inbox_restamp',
+                  action_id='%s/%s' % ('/'.join(sorted(kw.values())),
+                                       util.generate_uuid()),
+                  progress='',
+                  args=[],
+                  kw=kw)
+  try:
+    task_ref.add_to_queue()
+  except taskqueue.Error:
+    exception.log_exception()
+
 #######
 #######
 #######
@@ -2805,9 +3159,7 @@ def presence_get(api_user, nick, at_time=None):
                                 'description': latest_post.extra['title'],
                                 'since': latest_post.created_at}})
   else:
-    presence = Presence.gql(
-        u"WHERE actor = :1 AND updated_at <= :2 ORDER BY updated_at DESC",
-        nick, at_time).get()
+    presence = _presence_history_get(nick, clean.datetime(at_time))
   return ResultWrapper(presence, presence=presence)
 
 def presence_get_safe(api_user, nick, at_time=None):
@@ -2889,12 +3241,128 @@ def presence_set(api_user, nick, **kw):
             'key_name': 'presence/%s/current' % nick}
   presence = Presence(**params)
   presence.put()
-  # TODO(tyler): Clean this so an API call doesn't fill the DB.
-  params['key_name'] = 'presence/%s/history/%s' % (nick, updated_at)
-  presence_history = Presence(**params)
-  presence_history.put()
+  _presence_history_append(nick, updated_at, uuid, extra)
   return ResultWrapper(presence, presence=presence)
 
+@admin_required
+def presence_flush_history(api_user, nick, _task_ref=None):
+  """Writes the presence updates buffered by presence_set to history."""
+  nick = clean.nick(nick)
+  key = _presence_buffer_key(nick)
+  buffered = memcache.client.get(key)
+  if not buffered:
+    return PrimitiveResultWrapper(0)
+
+  _presence_history_write(nick, buffered)
+
+  # drop what we wrote but keep whatever was buffered in the meantime
+  written = set([uuid for updated_at, uuid, extra in buffered])
+  for i in range(PRESENCE_BUFFER_RETRIES):
+    current = memcache.client.get_multi([key], for_cas=True).get(key)
+    if current is None:
+      break
+    rest = [x for x in current if x[1] not in written]
+    if not memcache.client.cas_multi({key: rest}):
+      if rest:
+        # buffered while we wrote, the requests that did so found a flush
+        # on its way and left them to us
+        _presence_queue_flush(nick, rest[-1][1])
+      break
+  return PrimitiveResultWrapper(len(buffered))
+
+def _presence_buffer_key(nick):
+  return 'presence_buffer/%s' % nick
+
+def _presence_history_bucket(updated_at):
+  return datetime.datetime(updated_at.year, updated_at.month, updated_at.day)
+
+def _presence_history_append(nick, updated_at, uuid, extra):
+  """ buffers a presence update for presence_flush_history
+
+  The buffer lives in memcache, the first update in an empty buffer queues
+  the flush. If memcache is too busy to take the update it is written
+  straight through.
+  """
+  key = _presence_buffer_key(nick)
+  update = (updated_at, uuid, extra)
+  for i in range(PRESENCE_BUFFER_RETRIES):
+    buffered = memcache.client.get_multi([key], for_cas=True).get(key)
+    if buffered is None:
+      if not memcache.client.add(key, [update]):
+        continue
+    elif memcache.client.cas_multi({key: buffered + [update]}):
+      continue
+
+    # also requeue a buffer whose flush seems to have gone missing
+    stale = datetime.timedelta(seconds=2 * PRESENCE_FLUSH_DELAY)
+    if not buffered or utcnow() - buffered[0][0] > stale:
+      _presence_queue_flush(nick, uuid)
+    return
+
+  _presence_history_write(nick, [update])
+
+def _presence_queue_flush(nick, uuid):
+  task_ref = Task(actor=ROOT.nick,
+                  action='presence_flush_history',
+                  action_id='%s/%s' % (nick, uuid),
+                  progress='',
+                  args=[],
+                  kw={'nick': nick})
+  try:
+    task_ref.add_to_queue(countdown=PRESENCE_FLUSH_DELAY)
+  except taskqueue.Error:
+    exception.log_exception()
+
+def _presence_history_write(nick, updates):
+  """ merges the updates into their history chunks, one transaction per
+  chunk so that a flush and a write-through never undo each other """
+  buckets = {}
+  for update in updates:
+    bucket = _presence_history_bucket(update[0])
+    buckets.setdefault(bucket, []).append(update)
+
+  for bucket, bucket_updates in buckets.iteritems():
+    db.run_in_transaction(_presence_history_write_one, nick, bucket,
+                          bucket_updates)
+
+def _presence_history_write_one(nick, bucket, updates):
+  key_name = PresenceHistory.key_from(actor=nick, bucket=bucket)
+  # a list of keys skips the per request cache, we need the stored copy
+  chunk = PresenceHistory.get_by_key_name([key_name])[0]
+  if not chunk:
+    chunk = PresenceHistory(actor=nick, bucket=bucket)
+  chunk.add_updates(updates)
+  chunk.put()
+
+def _presence_history_get(nick, at_time):
+  """ the presence of nick as of at_time, from history and the buffer """
+  candidates = []
+  buffered = memcache.client.get(_presence_buffer_key(nick)) or []
+  for updated_at, uuid, extra in buffered:
+    if updated_at <= at_time:
+      candidates.append(Presence(
+          actor=nick, updated_at=updated_at, uuid=uuid, extra=extra,
+          key_name='presence/%s/history/%s' % (nick, updated_at)))
+
+  # the chunk that covers at_time may only have later updates
+  query = PresenceHistory.gql(
+      u"WHERE actor = :1 AND bucket <= :2 ORDER BY bucket DESC",
+      nick, at_time)
+  for chunk in query.fetch(2):
+    presence = chunk.presence_at(at_time)
+    if presence:
+      candidates.append(presence)
+      break
+
+  if not candidates:
+    # from before history was kept in chunks
+    return Presence.gql(
+        u"WHERE actor = :1 AND updated_at <= :2 ORDER BY updated_at DESC",
+        nick, at_time).get()
+
+  candidates.sort(key=lambda x: x.updated_at)
+  return candidates[-1]
+
 
 #######
 #######
@@ -3158,6 +3626,7 @@ def settings_change_privacy(api_user, nick, privacy):
   # XXX start transaction
   actor_ref = actor_get(api_user, nick)
   actor_ref.privacy = privacy
+  _visibility_bump_generation(actor_ref)
   actor_ref.put()
 
   # update all the related streams and subscriptions
@@ -3167,6 +3636,7 @@ def settings_change_privacy(api_user, nick, privacy):
       s.read = privacy
       s.put()
   # XXX end transaction
+  _queue_inbox_restamp({'owner': actor_ref.nick})
 
 @owner_required
 def settings_hide_comments(api_user, hide_comments, nick):
@@ -3610,7 +4080,10 @@ class PublicApi(object):
                      }
 
   root_methods = {"user_authenticate": user_authenticate,
-                  "task_process_actor": task_process_actor
+                  "task_process_actor": task_process_actor,
+                  "presence_flush_history": presence_flush_history,
+                  "inbox_restamp": inbox_restamp,
+                  "avatar_resize": avatar_resize,
                   }
 
 
@@ -3641,13 +4114,18 @@ class ResultWrapper(object):
   def __len__(self):
     return len(self.raw)
 
-  def to_api(self):
+  def to_api(self, fields=None):
     o = {}
     for k, v in self.kw.iteritems():
+      sub_fields = None
+      if fields:
+        if k not in fields:
+          continue
+        sub_fields = fields[k] or None
       if v is None:
         o[k] = {}
       else:
-        o[k] = models._to_api(v)
+        o[k] = models._to_api(v, sub_fields)
     return o
 
   def __eq__(self, other):
@@ -3669,20 +4147,83 @@ class PrimitiveResultWrapper(object):
   def __init__(self, primitive):
     self.value = primitive
   
-  def to_api(self):
+  def to_api(self, fields=None):
+    if fields:
+      return models._to_api(self.value, fields)
     return self.value
 
   
 
 # BACKEND
+def _fanout_trace_key(action_id):
+  return 'fanout_trace/%s' % action_id
+
+def _fanout_trace_set(task_ref, lags=None):
+  trace = {'actor': task_ref.actor,
+           'action': task_ref.action,
+           'progress': task_ref.progress,
+           'created_at': task_ref.created_at,
+           'timings': task_ref.timings,
+           'lags': lags,
+           }
+  memcache.client.set(_fanout_trace_key(task_ref.action_id), trace,
+                      time=settings.FANOUT_TRACE_TIMEOUT)
+
+@admin_required
+def fanout_trace_get(api_user, uuid):
+  """ the stage timings of the task that added the entry with uuid, None
+  once they have expired from memcache """
+  return memcache.client.get(_fanout_trace_key(uuid))
+
+
 class Task(object):
-  def __init__(self, actor, action, action_id, progress, args, kw):
+  """A queued api call, resumed at its progress by api_task_queue.
+
+  created_at is when the task was first made and timings holds, for every
+  stage it went through, when the stage started, when its first and last
+  hop finished and how many hops it took, all as seconds since the epoch.
+  Both travel with the task from hop to hop.
+  """
+  def __init__(self, actor, action, action_id, progress, args, kw,
+               created_at=None, timings=None):
     self.actor = actor
     self.action = action
     self.action_id = action_id
     self.progress = progress
     self.args = args
     self.kw = kw
+    self.created_at = created_at or time.time()
+    self.timings = timings or {}
+
+  def stage_started(self, stage):
+    self.timings.setdefault(stage, {'start': time.time(), 'first': None,
+                                    'finish': None, 'hops': 0})
+
+  def stage_finished(self, stage):
+    self.stage_started(stage)
+    now = time.time()
+    timing = self.timings[stage]
+    timing['first'] = timing['first'] or now
+    timing['finish'] = now
+    timing['hops'] += 1
+
+  def lags(self, stages):
+    """ seconds from the creation of the task to the given stages finishing
+
+    stages maps a stage to the name of its lag, or to a pair of names for
+    the lag to its first and to its last hop finishing.
+    """
+    o = {}
+    for stage, name in stages.iteritems():
+      timing = self.timings.get(stage)
+      if not timing or not timing['finish']:
+        continue
+      if isinstance(name, tuple):
+        o[name[0]] = timing['first'] - self.created_at
+        o[name[1]] = timing['finish'] - self.created_at
+      else:
+        o[name] = timing['finish'] - self.created_at
+    return o
   
   @classmethod
   def from_request(cls, request):
@@ -3692,18 +4233,25 @@ class Task(object):
     progress = request.POST.get('progress')
     json_args = request.POST.get('args')
     json_kw = request.POST.get('kw')
+    created_at = request.POST.get('created_at')
+    json_timings = request.POST.get('timings')
 
     args = simplejson.loads(json_args)
     kw = dict((str(k), v) for (k, v) in simplejson.loads(json_kw).iteritems())
+    # tasks queued before we started timing them have neither
+    created_at = created_at and float(created_at) or None
+    timings = json_timings and simplejson.loads(json_timings) or None
 
     return cls(actor=actor,
                action=action,
                action_id=action_id,
                progress=progress,
                args=args,
-               kw=kw)
+               kw=kw,
+               created_at=created_at,
+               timings=timings)
 
-  def add_to_queue(self):
+  def add_to_queue(self, countdown=None):
     json_args = simplejson.dumps(self.args)
     json_kw = simplejson.dumps(self.kw)
     params = {'actor': self.actor,
@@ -3711,11 +4259,13 @@ class Task(object):
               'action_id': self.action_id,
               'progress': self.progress,
               'args': json_args,
-              'kw': json_kw}
+              'kw': json_kw,
+              'created_at': repr(self.created_at),
+              'timings': simplejson.dumps(self.timings)}
     name = '%(actor)s/%(action)s/%(action_id)s/%(progress)s' % params
     logging.debug('Queueing task: base64(%s)', name)
     name = base64.b64encode(name).strip('=')
-    taskqueue.add(name=name, params=params)
+    taskqueue.add(name=name, params=params, countdown=countdown)
   
 class TaskSpec(object):
   """An abstraction for dealing with multi-stage actions across requests.
@@ -3724,7 +4274,11 @@ class TaskSpec(object):
   by the task queue moves iterates through them.
   """
   _lock_iteration = False
+  _current_stage = None
   stages = None
+  # whether to keep the timings of every task in memcache for
+  # fanout_trace_get
+  trace = False
 
   def __init__(self, task_ref, **kw):
     self.task_ref = task_ref
@@ -3746,9 +4300,13 @@ class TaskSpec(object):
   def update_task(self, progress):
     self._lock_iteration = False
     try:
+      if self._current_stage:
+        self.task_ref.stage_finished(self._current_stage)
       # Update the task's progress and add it to the queue
       self.task_ref.progress = progress
       self.task_ref.add_to_queue()
+      if self.trace:
+        _fanout_trace_set(self.task_ref)
     except exception.Error:
       exception.log_exception()
 
@@ -3805,7 +4363,14 @@ class TaskSpec(object):
     if not next_goal:
       logging.warning('Called next goal and got nothing')
       self.finish()
-    return next_goal()
+    self._current_stage = getattr(next_goal, 'stage', None) or 'initial'
+    self.task_ref.stage_started(self._current_stage)
+    start = time.time()
+    try:
+      return next_goal()
+    finally:
+      monitor.observe('task-stage-ms', (time.time() - start) * 1000,
+                      key=self._current_stage)
 
 class Goal(object):
   stage = None
@@ -3884,6 +4449,7 @@ class AddEntryInboxes(Goal):
                                              self.entry_ref)
 
     # More followers! Over and over. Like a monkey with a miniature cymbal.
+    start = time.time()
     follower_inboxes, more = _who_cares_web(new_entry_ref, 
                                             progress=self.stage_progress,
                                             skip=initial_inboxes)
@@ -3891,9 +4457,29 @@ class AddEntryInboxes(Goal):
     last_inbox = _paged_add_inbox(follower_inboxes,
                                   self.new_stream_ref,
                                   new_entry_ref)
+    monitor.incr('fanout-pages')
+    monitor.incr('fanout-inboxes', len(follower_inboxes))
+
+    elapsed_ms = (time.time() - start) * 1000
+    if elapsed_ms > settings.FANOUT_SLOW_PAGE_MS:
+      monitor.incr('fanout-slow-pages')
+      logging.warning('Slow fanout page for %s: %d ms for %d inboxes '
+                      'after %r up to %r',
+                      entry_keyname, elapsed_ms, len(follower_inboxes),
+                      self.stage_progress or None, last_inbox)
 
     self.bump(next_progress=(more and last_inbox))
 
+    # Wake up the clients long-polling the inboxes we just wrote to, the first
+    # time through that includes the initial inboxes, too
+    if settings.PUSH_ENABLED:
+      inboxes = follower_inboxes
+      if not self.stage_progress:
+        inboxes = initial_inboxes + follower_inboxes
+      push_connection = push.PushConnection()
+      push_connection.send_message(push_connection.filter_watched(inboxes),
+                                   entry_keyname)
+
     return new_entry_ref
 
 class AddEntryNotify(Goal):
@@ -4049,6 +4635,22 @@ class AddEntryTaskSpec(TaskSpec):
             AddEntryNotifyEmail,
             EndGoal
             ]
+  trace = True
+
+  # the stage after which the entry reached whatever the lag is named for,
+  # the inboxes stage gives a lag to the first and to the last inbox
+  lag_stages = {'inboxes': ('first_inbox', 'last_inbox'),
+                'notify_im': 'im',
+                'firehose_pshb': 'pshb',
+                'notify_sms': 'sms',
+                'notify_email': 'email',
+                }
+
+  def finish(self):
+    lags = self.task_ref.lags(self.lag_stages)
+    for name, seconds in lags.iteritems():
+      monitor.observe('fanout-lag-ms', seconds * 1000, key=name)
+    _fanout_trace_set(self.task_ref, lags)
 
 
 # new squeuel
@@ -4385,9 +4987,355 @@ def _add_inbox(stream_ref, entry_ref, inboxes, shard):
             }
   if entry_ref.entry:
     values['entry'] = entry_ref.entry
+  values.update(_visibility_stamp(entry_ref.entry or entry_ref.key().name()))
   inbox_ref = InboxEntry(**values)
   inbox_ref.put()
+  if settings.INBOX_BACKEND != 'index':
+    _bucket_append(inboxes, stream_ref.type, entry_ref.key().name(),
+                   entry_ref.created_at)
+  _touch_inboxes(inboxes)
   return inbox_ref
+
+class InboxKeys(list):
+  """The entry keys of an inbox, along with the ones among them that the
+  visibility stamps already rule out for the reader, which
+  entry_get_entries then skips without fetching them, and when the last of
+  them was created, where the next batch picks up.
+  """
+  def __init__(self, keys, invisible=None, last=None):
+    super(InboxKeys, self).__init__(keys)
+    self.invisible = invisible or set()
+    self.last = last
+
+def _visibility_class(read):
+  if read >= PRIVACY_PUBLIC:
+    return 'public'
+  if read >= PRIVACY_CONTACTS:
+    return 'contacts'
+  return 'private'
+
+def _visibility_stamp(entry):
+  """ the visibility of entry for the InboxEntry rows of it or of comments
+  on it, from the privacy of its stream """
+  stream_ref = stream_get_safe(ROOT, entry.rsplit('/', 1)[0])
+  if not stream_ref:
+    return {}
+  generation = _visibility_generations([stream_ref.owner]).get(
+      stream_ref.owner)
+  return {'visibility': _visibility_class(stream_ref.read),
+          'owner': stream_ref.owner,
+          'generation': generation,
+          }
+
+def _visibility_generation_key(nick):
+  return 'visibility_generation/%s' % nick
+
+def _visibility_generations(nicks):
+  """ how often each of nicks has changed their privacy, stamps from an
+  older generation can't be trusted """
+  keys = dict([(_visibility_generation_key(nick), nick)
+               for nick in set(nicks)])
+  cached = memcache.client.get_multi(keys.keys())
+  o = dict([(keys[k], v) for k, v in cached.iteritems()])
+
+  missing = [nick for nick in keys.values() if nick not in o]
+  if missing:
+    fill = {}
+    for nick, actor_ref in actor_get_actors(ROOT, missing).iteritems():
+      if actor_ref:
+        o[nick] = actor_ref.extra.get('visibility_generation', 0)
+        fill[_visibility_generation_key(nick)] = o[nick]
+    memcache.client.set_multi(fill, time=VISIBILITY_CACHE_TIMEOUT)
+  return o
+
+def _visibility_bump_generation(actor_ref):
+  """ call before putting actor_ref after changing its privacy """
+  generation = actor_ref.extra.get('visibility_generation', 0) + 1
+  actor_ref.extra['visibility_generation'] = generation
+  memcache.client.set(_visibility_generation_key(actor_ref.nick), generation,
+                      time=VISIBILITY_CACHE_TIMEOUT)
+
+def _contact_owners_key(nick, version):
+  return 'contact_owners/%s/%s' % (nick, version)
+
+def _contact_owners_version_key(nick):
+  return 'contact_owners_version/%s' % nick
+
+def _contact_owners_version(nick):
+  """ the version the contact owners of nick are cached under, a fill that
+  races a change of contacts goes to the version before and is never read """
+  key = _contact_owners_version_key(nick)
+  version = memcache.client.get(key)
+  if version is None:
+    # starting from the time keeps clear of what an evicted version left
+    memcache.client.add(key, int(time.time()))
+    version = memcache.client.get(key)
+  return version
+
+def _contact_owners_forget(nick):
+  memcache.client.incr(_contact_owners_version_key(nick))
+
+def _contact_owners(nick):
+  """ the actors that have nick as a contact and so let nick see what they
+  keep to their contacts, None when there are too many to keep around """
+  version = _contact_owners_version(nick)
+  key = _contact_owners_key(nick, version)
+  owners = None
+  if version is not None:
+    owners = memcache.client.get(key)
+  if owners is None:
+    query = Relation.gql('WHERE target = :1 AND relation = :2',
+                         nick,
+                         'contact')
+    results = query.fetch(VISIBILITY_MAX_CONTACT_OWNERS + 1)
+    owners = [x.owner for x in results]
+    if len(owners) > VISIBILITY_MAX_CONTACT_OWNERS:
+      owners = False
+    if version is not None:
+      memcache.client.add(key, owners, time=VISIBILITY_CACHE_TIMEOUT)
+  if owners is False:
+    return None
+  return set(owners)
+
+def _inbox_invisible(api_user, inbox_refs):
+  """The entry keys of inbox_refs that api_user can't see going by their
+  visibility stamps alone.
+
+  Only rules out what the stamps say for sure, deleted entries and
+  private or contacts only ones of actors that haven't changed their
+  privacy since, everything else is left to entry_get.
+  """
+  if has_access(api_user, ADMIN_ACCESS):
+    return set()
+  nick = api_user and api_user.nick
+
+  o = set()
+  restricted = []
+  for inbox_ref in inbox_refs:
+    if inbox_ref.deleted:
+      o.add(inbox_ref.stream_entry_keyname())
+      continue
+    if inbox_ref.visibility in (None, 'public'):
+      continue
+    # owners, channel admins and the author of a comment may see it anyway
+    if (inbox_ref.owner == nick or util.is_channel_nick(inbox_ref.owner)
+        or util.get_user_from_topic(inbox_ref.stream) == nick):
+      continue
+    restricted.append(inbox_ref)
+  if not restricted:
+    return o
+
+  generations = _visibility_generations([x.owner for x in restricted])
+  contact_owners = None
+  if nick and [x for x in restricted if x.visibility == 'contacts']:
+    contact_owners = _contact_owners(nick)
+  elif not nick:
+    contact_owners = set()
+  for inbox_ref in restricted:
+    if inbox_ref.generation != generations.get(inbox_ref.owner):
+      continue
+    if inbox_ref.visibility == 'contacts':
+      if contact_owners is None or inbox_ref.owner in contact_owners:
+        continue
+    o.add(inbox_ref.stream_entry_keyname())
+  return o
+
+def _bucket_index(created_at):
+  return _datetime_to_usec(created_at) / (INBOX_BUCKET_SECONDS * 1000000)
+
+def _bucket_unpack(bucket_ref):
+  """ the (usec, stream_type, entry) tuples of a bucket, oldest first """
+  if not bucket_ref or not bucket_ref.entries:
+    return []
+  o = []
+  for line in bucket_ref.entries.split('\n'):
+    usec, stream_type, entry = line.split('\t', 2)
+    o.append((int(usec), stream_type, entry))
+  return o
+
+def _bucket_pack(items):
+  return '\n'.join(['%d\t%s\t%s' % x for x in items])
+
+def _bucket_excluded(inbox):
+  """ whether the inbox is left to the index, see INBOX_BUCKET_EXCLUDE """
+  return inbox in settings.INBOX_BUCKET_EXCLUDE
+
+def _bucket_merge(bucket_ref, item):
+  """ adds the item to the bucket, False if it was there already """
+  items = _bucket_unpack(bucket_ref)
+
+  # retried tasks add the same entries again
+  i = bisect.bisect_left(items, item)
+  if i < len(items) and items[i] == item:
+    return False
+  items.insert(i, item)
+  if len(items) > INBOX_BUCKET_MAX_ENTRIES:
+    items = items[-INBOX_BUCKET_MAX_ENTRIES:]
+    bucket_ref.truncated = True
+  bucket_ref.entries = _bucket_pack(items)
+  return True
+
+def _bucket_append_one(inbox, bucket, item):
+  key_name = InboxBucket.key_from(inbox=inbox, bucket=bucket)
+  # a list of keys skips the per request cache, we need the stored copy
+  bucket_ref = InboxBucket.get_by_key_name([key_name])[0]
+  if not bucket_ref:
+    bucket_ref = InboxBucket(inbox=inbox, bucket=bucket)
+  if _bucket_merge(bucket_ref, item):
+    bucket_ref.put()
+
+def _bucket_append(inboxes, stream_type, entry, created_at):
+  """Adds the entry to the bucket of created_at of each of the inboxes, one
+  transaction per bucket so that entries fanned out to the same inbox at
+  the same moment don't overwrite each other.
+
+  A failed transaction raises, the fanout task is retried and merging skips
+  what made it the first time. Inboxes every post goes to would contend on
+  their bucket all the time, the ones in INBOX_BUCKET_EXCLUDE are left to
+  the index.
+  """
+  item = (_datetime_to_usec(created_at), stream_type, entry)
+  bucket = _bucket_index(created_at)
+  for inbox in sorted(set(inboxes)):
+    if _bucket_excluded(inbox):
+      continue
+    db.run_in_transaction(_bucket_append_one, inbox, bucket, item)
+
+def _bucket_complete(bucket):
+  """Whether every entry of the bucket was appended to it, which only holds
+  for the buckets that begin at or after INBOX_BUCKET_START.
+  """
+  start = settings.INBOX_BUCKET_START
+  if start is None:
+    return False
+  return bucket * INBOX_BUCKET_SECONDS * 1000000 >= _datetime_to_usec(start)
+
+def _bucket_get(inbox, buckets):
+  """ the buckets of the inbox in the order given, None where missing """
+  key_names = [InboxBucket.key_from(inbox=inbox, bucket=b) for b in buckets]
+  return InboxBucket.get_by_key_name(key_names)
+
+def _bucket_get_entries(inbox, limit, offset=None, stream_type=None):
+  """The newest limit entries of the inbox created at or before offset,
+  newest first, from a single get of the buckets before offset.
+
+  Returns None when the buckets can't tell, when they hold fewer entries
+  than that or a truncated bucket or one that may be missing entries, see
+  _bucket_complete, was needed.
+  """
+  if _bucket_excluded(inbox):
+    monitor.incr('inbox-bucket-reads', key='fallback', label='result')
+    return None
+  newest = _bucket_index(offset or utcnow())
+  buckets = range(newest, newest - INBOX_BUCKET_SPAN, -1)
+  until = offset and _datetime_to_usec(offset)
+  o = []
+  for bucket, bucket_ref in zip(buckets, _bucket_get(inbox, buckets)):
+    if not _bucket_complete(bucket):
+      break
+    items = _bucket_unpack(bucket_ref)
+    items.reverse()
+    for usec, item_type, entry in items:
+      if until and usec > until:
+        continue
+      if stream_type is not None and item_type != stream_type:
+        continue
+      o.append(entry)
+      if len(o) >= limit:
+        monitor.incr('inbox-bucket-reads', key='hit', label='result')
+        return InboxKeys(o, last=_usec_to_datetime(usec))
+    if bucket_ref and bucket_ref.truncated:
+      break
+  monitor.incr('inbox-bucket-reads', key='fallback', label='result')
+  return None
+
+def _bucket_get_entries_since(inbox, limit, since_time=None,
+                              stream_type=None):
+  """The oldest limit entries of the inbox created at or after since_time,
+  oldest first, or None when that reaches further back than the buckets
+  a read looks at or into one that may be missing entries.
+  """
+  newest = _bucket_index(utcnow())
+  oldest = newest - INBOX_BUCKET_SPAN + 1
+  if (_bucket_excluded(inbox) or since_time is None
+      or _bucket_index(since_time) < oldest
+      or not _bucket_complete(_bucket_index(since_time))):
+    monitor.incr('inbox-bucket-reads', key='fallback', label='result')
+    return None
+
+  since = _datetime_to_usec(since_time)
+  buckets = range(_bucket_index(since_time), newest + 1)
+  o = []
+  for bucket_ref in _bucket_get(inbox, buckets):
+    if bucket_ref and bucket_ref.truncated:
+      monitor.incr('inbox-bucket-reads', key='fallback', label='result')
+      return None
+    for usec, item_type, entry in _bucket_unpack(bucket_ref):
+      if usec < since:
+        continue
+      if stream_type is not None and item_type != stream_type:
+        continue
+      o.append(entry)
+      if len(o) >= limit:
+        break
+    if len(o) >= limit:
+      break
+  monitor.incr('inbox-bucket-reads', key='hit', label='result')
+  return o
+
+def _inbox_marker_key(inbox):
+  return 'inbox_marker/%s' % inbox
+
+def _datetime_to_usec(value):
+  return calendar.timegm(value.timetuple()) * 1000000 + value.microsecond
+
+def _usec_to_datetime(usec):
+  return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=usec)
+
+def _inbox_version(marker, limit, since_time):
+  # a version only stands for the exact query it answered
+  query = '%s/%s' % (limit, since_time)
+  return '%x-%x' % (marker, zlib.crc32(query) & 0xffffffff)
+
+def _inbox_marker(inbox):
+  """ the last write to the inbox in microseconds, None if unknown """
+  return memcache.client.get(_inbox_marker_key(inbox))
+
+def _touch_inboxes(inboxes):
+  """ moves the change markers of the inboxes forward
+
+  A marker is the time of the last write to its inbox and never goes
+  backwards: every write moves it to max(now, marker + 1), so it also works
+  as a version. Since entries are written after they are created nothing in
+  the inbox is newer than its marker. Markers we can't update consistently
+  are dropped, readers then fall back to the datastore.
+  """
+  if not inboxes:
+    return
+  now = _datetime_to_usec(utcnow())
+  keys = [_inbox_marker_key(inbox) for inbox in set(inboxes)]
+  for i in range(INBOX_MARKER_RETRIES):
+    current = memcache.client.get_multi(keys, for_cas=True)
+    missing = {}
+    changed = {}
+    for key in keys:
+      marker = current.get(key)
+      if marker is None:
+        missing[key] = now
+      else:
+        changed[key] = max(now, marker + 1)
+
+    failed = []
+    if missing:
+      failed += memcache.client.add_multi(missing, time=INBOX_MARKER_TIMEOUT)
+    if changed:
+      failed += memcache.client.cas_multi(changed, time=INBOX_MARKER_TIMEOUT)
+    if not failed:
+      return
+    keys = failed
+
+  logging.warning('dropping inbox markers: %s', keys)
+  memcache.client.delete_multi(keys)
  
 def _who_cares_web(entry_ref, progress=None, limit=None, skip=None):
   """ figure out who wants to see this on the web 
@@ -4874,9 +5822,14 @@ def _add_inboxes_for_entry(inboxes, stream_ref, entry_ref):
             }
   if entry_ref.entry:
     values['entry'] = entry_ref.entry
+  values.update(_visibility_stamp(entry_ref.entry or entry_ref.key().name()))
 
   inbox_entry = InboxEntry(**values)
   inbox_entry.put()
+  if settings.INBOX_BACKEND != 'index':
+    _bucket_append(inboxes, stream_ref.type, entry_ref.key().name(),
+                   entry_ref.created_at)
+  _touch_inboxes(inboxes)
   return inbox_entry
 
 def _notify_subscribers_for_entry(inboxes, actor_ref, stream_ref,
@@ -0,0 +1,285 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Hot keys and slow query shapes, found at the RPC level.
+
+Hooks on the datastore and memcache services see every get, query and put,
+whether it comes from CachingModel, a db.Query, Actor.objects or the raw
+memcache client. Each call adds to two sketches for the current window of
+HOTKEYS_WINDOW seconds: the keys it touched, weighted by how often, and the
+shape of the query, weighted by its latency. Queries slower than
+SLOW_QUERY_MS are also logged.
+
+The sketches are Space-Saving heavy hitters, a fixed number of counters
+that keep the heaviest keys of any stream along with a bound on how far off
+each count may be. They are merged into memcache on flush() and shown on
+/_monitor/hotkeys.
+"""
+
+import heapq
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from google.appengine.api import apiproxy_stub_map
+
+KEYS = 'keys'
+QUERIES = 'queries'
+CAS_RETRIES = 3
+
+# our own bookkeeping, not something to report
+IGNORED_PREFIXES = ('hotkeys/', 'monitor/')
+
+_lock = threading.Lock()
+_sketches = {}
+_last_flush = 0.0
+_local = threading.local()
+
+
+class SpaceSaving(object):
+  """The heaviest keys of a stream in a fixed number of counters.
+
+  Every counter is [weight, error, count, max], error being how much of the
+  weight may belong to keys evicted before it, see Metwally, Agrawal and El
+  Abbadi, "Efficient Computation of Frequent and Top-k Elements in Data
+  Streams".
+
+  The lightest counter, the one to evict, is found with a heap of
+  (weight, key) pairs. Weights only ever grow, so an entry is at worst
+  lighter than its counter and gets pushed back with the current weight
+  when it turns up at the top.
+  """
+  def __init__(self, capacity, counters=None):
+    self.capacity = capacity
+    self.counters = counters or {}
+    self._heap = None
+
+  def _lightest(self):
+    """ pops the key of the lightest counter off the heap """
+    if self._heap is None:
+      self._heap = [(counter[0], key)
+                    for key, counter in self.counters.iteritems()]
+      heapq.heapify(self._heap)
+    while True:
+      weight, key = heapq.heappop(self._heap)
+      if self.counters[key][0] == weight:
+        return key
+      heapq.heappush(self._heap, (self.counters[key][0], key))
+
+  def add(self, key, weight=1, value=0):
+    counter = self.counters.get(key)
+    if counter is None:
+      error = 0
+      if len(self.counters) >= self.capacity:
+        error = self.counters.pop(self._lightest())[0]
+      counter = self.counters[key] = [error, error, 0, 0]
+      if self._heap is not None:
+        heapq.heappush(self._heap, (error + weight, key))
+    counter[0] += weight
+    counter[2] += 1
+    counter[3] = max(counter[3], value)
+
+  def floor(self):
+    """ the most a key without a counter can weigh, the lightest counter
+    once all of them are in use """
+    if len(self.counters) < self.capacity:
+      return 0
+    return min([counter[0] for counter in self.counters.itervalues()])
+
+  def merge(self, other):
+    # a key only one side kept may have weighed up to the other side's floor
+    # there, so it gets that as weight and as error
+    mine, theirs = self.floor(), other.floor()
+    for key in set(self.counters) | set(other.counters):
+      counter = self.counters.setdefault(key, [mine, mine, 0, 0])
+      weight, error, count, maximum = other.counters.get(
+          key, [theirs, theirs, 0, 0])
+      counter[0] += weight
+      counter[1] += error
+      counter[2] += count
+      counter[3] = max(counter[3], maximum)
+    if len(self.counters) > self.capacity:
+      self.counters = dict(self.top(self.capacity))
+    self._heap = None
+    return self
+
+  def top(self, k=None):
+    """ the k heaviest (key, counter) pairs, heaviest first """
+    rv = sorted(self.counters.iteritems(), key=lambda x: (-x[1][0], x[0]))
+    return rv[:k or len(rv)]
+
+
+def _window(now=None):
+  return int((now or time.time()) / settings.HOTKEYS_WINDOW)
+
+def _sketch(name):
+  if name not in _sketches:
+    _sketches[name] = SpaceSaving(settings.HOTKEYS_CAPACITY)
+  return _sketches[name]
+
+def record_key(key, latency_ms=0):
+  _lock.acquire()
+  try:
+    _sketch(KEYS).add(key, 1, latency_ms)
+  finally:
+    _lock.release()
+
+def record_query(shape, latency_ms, results=0):
+  if latency_ms > settings.SLOW_QUERY_MS:
+    logging.warning('Slow query: %s took %d ms for %d results',
+                    shape, latency_ms, results)
+  _lock.acquire()
+  try:
+    _sketch(QUERIES).add(shape, int(round(latency_ms)), latency_ms)
+  finally:
+    _lock.release()
+
+
+def _path(reference):
+  """ Kind/name/Kind/id of a datastore key """
+  o = []
+  for element in reference.path().element_list():
+    if element.has_name():
+      o.append('%s/%s' % (element.type(), element.name()))
+    else:
+      o.append('%s/%d' % (element.type(), element.id()))
+  return '/'.join(o)
+
+def query_shape(query):
+  """ what a datastore query looks for, without the values """
+  o = [query.kind() or '*']
+  if query.has_ancestor():
+    o.append('ancestor')
+  for f in query.filter_list():
+    for prop in f.property_list():
+      o.append('%s%s' % (prop.name(), _OPERATORS.get(f.op(), '?')))
+  for order in query.order_list():
+    o.append('%s%s' % (order.direction() == order.DESCENDING and '-' or '',
+                       order.property()))
+  return ' '.join(o)
+
+# datastore_pb.Query_Filter operators
+_OPERATORS = {1: '<', 2: '<=', 3: '>', 4: '>=', 5: '=', 6: ' IN', 7: ' EXISTS'}
+
+def _memcache_keys(call, request):
+  if call in ('Get', 'Delete'):
+    if call == 'Get':
+      return request.key_list()
+    return [item.key() for item in request.item_list()]
+  if call in ('Set', 'BatchIncrement'):
+    return [item.key() for item in request.item_list()]
+  if call == 'Increment':
+    return [request.key()]
+  return []
+
+def _pre_call(service, call, request, response):
+  if getattr(_local, 'paused', False):
+    return
+  if not hasattr(_local, 'started'):
+    _local.started = {}
+  _local.started[id(request)] = time.time()
+
+def _post_call(service, call, request, response):
+  started = getattr(_local, 'started', {}).pop(id(request), None)
+  if started is None:
+    return
+  latency_ms = (time.time() - started) * 1000
+  try:
+    if service == 'memcache':
+      for key in _memcache_keys(call, request):
+        if key.startswith(IGNORED_PREFIXES):
+          continue
+        record_key('memcache:%s' % key, latency_ms)
+    elif call == 'Get':
+      for reference in request.key_list():
+        record_key(_path(reference), latency_ms)
+    elif call == 'Put':
+      for entity in request.entity_list():
+        record_key(_path(entity.key()), latency_ms)
+    elif call == 'RunQuery':
+      record_query(query_shape(request), latency_ms,
+                   len(response.result_list()))
+  except Exception:
+    # not knowing some call beats failing the request
+    logging.exception('Failed to record %s.%s', service, call)
+
+def install_hooks():
+  for service in ('datastore_v3', 'memcache'):
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'hotkeys', _pre_call, service)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'hotkeys', _post_call, service)
+
+
+def _client():
+  # like common.monitor, skip the hit rate reporting of common.memcache
+  from common import memcache
+  return getattr(memcache.client, '_client', memcache.client)
+
+def _key(name, window):
+  return 'hotkeys/%s/%d' % (name, window)
+
+def _store(client, key, sketch):
+  for i in range(CAS_RETRIES):
+    current = client.get_multi([key], for_cas=True).get(key)
+    if current is None:
+      if client.add(key, sketch.counters,
+                    time=settings.HOTKEYS_WINDOW * settings.HOTKEYS_WINDOWS):
+        return True
+      continue
+    merged = SpaceSaving(settings.HOTKEYS_CAPACITY, current).merge(sketch)
+    if not client.cas_multi({key: merged.counters},
+                            time=settings.HOTKEYS_WINDOW
+                                 * settings.HOTKEYS_WINDOWS):
+      return True
+  return False
+
+def flush(force=False):
+  """ merges what this instance saw into the current window in memcache, at
+  most once every MONITOR_FLUSH_INTERVAL seconds unless forced """
+  global _last_flush
+  now = time.time()
+  if not force and now - _last_flush < settings.MONITOR_FLUSH_INTERVAL:
+    return
+
+  _lock.acquire()
+  try:
+    sketches = _sketches.copy()
+    _sketches.clear()
+    _last_flush = now
+  finally:
+    _lock.release()
+
+  window = _window(now)
+  _local.paused = True
+  try:
+    for name, sketch in sketches.iteritems():
+      if not _store(_client(), _key(name, window), sketch):
+        logging.warning('Dropped the %s sketch of window %d', name, window)
+  except Exception:
+    logging.exception('Failed to flush hot keys')
+  _local.paused = False
+
+def get(name, windows=1):
+  """ the sketch of the last windows windows merged """
+  current = _window()
+  keys = [_key(name, w) for w in range(current - windows + 1, current + 1)]
+  o = SpaceSaving(settings.HOTKEYS_CAPACITY)
+  for counters in _client().get_multi(keys).itervalues():
+    if counters:
+      o.merge(SpaceSaving(settings.HOTKEYS_CAPACITY, counters))
+  return o
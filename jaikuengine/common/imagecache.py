@@ -0,0 +1,155 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Image blobs for blob.views, served without touching the datastore.
+
+Images are never changed once written, a new avatar gets a new path, so
+whatever is read can be kept for as long as there is room for it. Every
+image gets an ETag, the md5 of its content, which is kept in memcache along
+with the content of images up to IMAGE_CACHE_MAX_BYTES, the sized avatars,
+and in an LRU of IMAGE_LRU_BYTES in each instance. A revalidation of any
+image, or a read of a small one, is answered from one of those.
+
+Paths that don't exist are remembered for IMAGE_NEGATIVE_TIMEOUT seconds,
+image_set forgets them as soon as they do.
+"""
+
+import hashlib
+import threading
+
+from django.conf import settings
+
+from common import memcache
+from common import monitor
+
+# cached in place of an image that doesn't exist
+MISSING = ''
+
+
+class CachedImage(object):
+  """What we know about an image: its etag and length, and its content if
+  it was small enough to keep.
+  """
+  def __init__(self, etag, length, content=None):
+    self.etag = etag
+    self.length = length
+    self.content = content
+
+
+class LRU(object):
+  """A least recently used cache that holds up to max_bytes of values."""
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self._lock = threading.Lock()
+    self._data = {}
+    self._tick = 0
+
+  def get(self, key):
+    self._lock.acquire()
+    try:
+      item = self._data.get(key)
+      if item is None:
+        return None
+      self._tick += 1
+      item[0] = self._tick
+      return item[1]
+    finally:
+      self._lock.release()
+
+  def set(self, key, value, size):
+    if size > self.max_bytes:
+      return
+    self._lock.acquire()
+    try:
+      old = self._data.pop(key, None)
+      if old is not None:
+        self.bytes -= old[2]
+      while self._data and self.bytes + size > self.max_bytes:
+        # eviction is linear but rare, the cache holds a few hundred avatars
+        oldest = min(self._data, key=lambda k: self._data[k][0])
+        self.bytes -= self._data.pop(oldest)[2]
+      self._tick += 1
+      self._data[key] = [self._tick, value, size]
+      self.bytes += size
+    finally:
+      self._lock.release()
+
+  def clear(self):
+    self._lock.acquire()
+    try:
+      self._data = {}
+      self.bytes = 0
+    finally:
+      self._lock.release()
+
+
+_local = LRU(settings.IMAGE_LRU_BYTES)
+
+
+def _cache_key(keyname):
+  return 'imagecache/%s' % keyname
+
+def etag_for(content):
+  return '"%s"' % hashlib.md5(content).hexdigest()
+
+def _wrap(image_ref):
+  if not image_ref:
+    return None
+  content = str(image_ref.content)
+  return CachedImage(etag_for(content), len(content), content)
+
+def get(keyname, load):
+  """Returns the CachedImage of the image keyname, None if there is no such
+  image. load() reads the Image from the datastore on a miss.
+
+  The content of a large image is only set when it was just read, on a
+  cache hit it has to be read again if it turns out to be needed.
+  """
+  cached = _local.get(keyname)
+  if cached is not None:
+    monitor.incr('image-lookups', key='local', label='source')
+    return cached
+
+  cache_key = _cache_key(keyname)
+  cached = memcache.client.get(cache_key)
+  if cached == MISSING:
+    monitor.incr('image-lookups', key='missing', label='source')
+    return None
+  if cached is not None:
+    monitor.incr('image-lookups', key='memcache', label='source')
+    if cached.content is not None:
+      _local.set(keyname, cached, cached.length)
+    return cached
+
+  monitor.incr('image-lookups', key='datastore', label='source')
+  cached = _wrap(load())
+  if cached is None:
+    memcache.client.set(cache_key, MISSING, settings.IMAGE_NEGATIVE_TIMEOUT)
+    return None
+  if cached.length <= settings.IMAGE_CACHE_MAX_BYTES:
+    memcache.client.set(cache_key, cached)
+    _local.set(keyname, cached, cached.length)
+  else:
+    memcache.client.set(cache_key, CachedImage(cached.etag, cached.length))
+  return cached
+
+def forget_missing(keyname):
+  """Called when an image is written, a path we had found missing may
+  exist now."""
+  memcache.client.delete(_cache_key(keyname))
+
+def flush_local():
+  _local.clear()
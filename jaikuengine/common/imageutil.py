@@ -17,62 +17,107 @@
 
 __author__ = 'mikie@google.com (Mika Raento)'
 
+import struct
+
+JPEG = 'jpeg'
+PNG = 'png'
+GIF = 'gif'
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+GIF_SIGNATURES = ('GIF87a', 'GIF89a')
+
+# Start Of Frame markers, 0xc0 - 0xcf except DHT, JPG and DAC
+JPEG_SOF = frozenset(range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+# markers without a length: TEM, RST0 - RST7, SOI
+JPEG_STANDALONE = frozenset([0x01] + range(0xd0, 0xd9))
+JPEG_SOS = 0xda
+
 def _debug(s):
   #print s
   pass
 
-def _read_2byte(img_data, pos):
-  return (ord(img_data[pos]) << 8) + ord(img_data[pos + 1])
+def _header_from_jpeg(img_data):
+  """Reads the size from the first Start Of Frame segment, baseline,
+  progressive, lossless or arithmetic coded.
 
-def _size_from_jpeg(img_data):
-  """A very crude JPEG reader so that we can get the image size"""
-  # JPEG format:
-  # 0xff 0xd8 (Start of Image)
-  # repeated
-  #   block marker (0xff 0x??)
-  #   length (?? ??) of block
-  #   length - 2 bytes data
-  #
-  # the image data block has marker 0xff 0xc0
-  # the image data format is:
-  #   ?? ?? length
-  #   1 byte precision
-  #   ?? ?? height
-  #   ?? ?? width
-  pos = 0
-  # SOI 0xff 0xd8
-  if (ord(img_data[pos]) != 0xff or ord(img_data[pos + 1]) != 0xd8):
-    _debug('SOI not found %u %u' % (ord(img_data[pos]), ord(img_data[pos + 1])))
-    return None
-  pos += 2
-  # start of stream
-  sos = False
-  while not sos:
-    # marker
-    if (ord(img_data[pos]) != 0xff):
-      _debug('marker not found at pos %d' % (pos))
+  JPEG format:
+    0xff 0xd8 (Start of Image)
+    repeated
+      block marker (0xff 0x??), possibly preceded by 0xff fill bytes
+      length (?? ??) of block, including itself
+      length - 2 bytes data
+  a SOF block is
+    ?? ?? length
+    1 byte precision
+    ?? ?? height
+    ?? ?? width
+  and the image data starts after the Start Of Scan block, by which point
+  we should have seen a SOF.
+  """
+  pos = 2
+  end = len(img_data)
+  while pos + 4 <= end:
+    if img_data[pos] != '\xff':
+      _debug('marker not found at pos %d' % pos)
+      return None
+    marker = ord(img_data[pos + 1])
+    if marker == 0xff:
+      # fill byte
+      pos += 1
+      continue
+    pos += 2
+    if marker in JPEG_STANDALONE:
+      continue
+    if marker == JPEG_SOS:
+      return None
+    if marker in JPEG_SOF:
+      if pos + 7 > end:
+        return None
+      height, width = struct.unpack_from('>HH', img_data, pos + 3)
+      return (width, height)
+    length, = struct.unpack_from('>H', img_data, pos)
+    if length < 2:
       return None
-    if (ord(img_data[pos + 1]) == 0xc0):
-      sos = True
-      pos += 2
+    pos += length
+  return None
+
+def _header_from_png(img_data):
+  """The IHDR chunk comes first: length, 'IHDR', width, height."""
+  if len(img_data) < 24 or img_data[12:16] != 'IHDR':
+    return None
+  return struct.unpack_from('>II', img_data, 16)
+
+def _header_from_gif(img_data):
+  """The logical screen descriptor follows the signature."""
+  if len(img_data) < 10:
+    return None
+  return struct.unpack_from('<HH', img_data, 6)
+
+def image_header(img_data):
+  """Get the format and dimensions of a JPEG, PNG or GIF image from its
+  header, returns (format, width, height) or None.
+
+  img_data can be a str or a buffer of one, it is not copied.
+  """
+  try:
+    if img_data[:2] == '\xff\xd8':
+      format, size = JPEG, _header_from_jpeg(img_data)
+    elif img_data[:8] == PNG_SIGNATURE:
+      format, size = PNG, _header_from_png(img_data)
+    elif img_data[:6] in GIF_SIGNATURES:
+      format, size = GIF, _header_from_gif(img_data)
     else:
-      pos += 2
-      len = _read_2byte(img_data, pos)
-      _debug('len %d' % len)
-      pos += len
-  pos += 3
-  _debug('h %x %x' % (ord(img_data[pos]), ord(img_data[pos+1])))
-  height = _read_2byte(img_data, pos)
-  pos += 2
-  width = _read_2byte(img_data, pos)
-  return (width, height)
+      return None
+  except struct.error:
+    return None
+  if not size:
+    return None
+  return (format, size[0], size[1])
 
 def size_from_jpeg(img_data):
   """Get the dimensions of an image from the jpeg data.
   """
-  # _size_from_jpeg may throw an exception if the data is malformed, we then
-  # return None
-  try:
-    return _size_from_jpeg(img_data)
-  except:
+  header = image_header(img_data)
+  if not header or header[0] != JPEG:
     return None
+  return header[1:]
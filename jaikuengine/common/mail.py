@@ -24,6 +24,7 @@ from django.core import mail
 from django.utils.http import urlquote
 
 from common import exception
+from common import monitor
 from common import util
 
 def is_allowed_to_send_email_to(email):
@@ -66,7 +67,9 @@ def send(to_email, subject, message, on_behalf=None, html_message=None):
     # uses the default email sender, see DEFAULT_FROM_EMAIL in settings.py
     # if on_behalf is None
     fail_silently = settings.MANAGE_PY
-    return email_message.send(fail_silently)
+    rv = email_message.send(fail_silently)
+    monitor.incr('notifications-sent', key='email', label='channel')
+    return rv
   else:
     log_blocked_send(on_behalf, to_email, subject, message)
     raise exception.ValidationError("Cannot send to that email address")
@@ -88,7 +91,9 @@ def mass_send(message_tuples):
   send_count = 0
   allowed, fake_send_count = filter_out_blocked_addresses(message_tuples)
   send_count += fake_send_count
-  send_count += mail.send_mass_mail(tuple(allowed))
+  sent = mail.send_mass_mail(tuple(allowed))
+  monitor.incr('notifications-sent', sent, key='email', label='channel')
+  send_count += sent
   return send_count
 
 
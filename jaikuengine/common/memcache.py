@@ -14,4 +14,36 @@
 
 from google.appengine.api import memcache
 
-client = memcache.Client()
+from common import monitor
+from common import profile
+
+class ProfiledClient(object):
+  """ a memcache client that shows up in profile traces and counts its
+  hit rate for monitoring """
+  def __init__(self, client):
+    self.__dict__['_client'] = client
+
+  def get(self, key, *args, **kw):
+    rv = self.__getattr__('get')(key, *args, **kw)
+    monitor.incr('memcache-lookups', key=rv is None and 'miss' or 'hit',
+                 label='result')
+    return rv
+
+  def get_multi(self, keys, *args, **kw):
+    rv = self.__getattr__('get_multi')(keys, *args, **kw)
+    hits = len([v for v in rv.itervalues() if v is not None])
+    monitor.incr('memcache-lookups', hits, key='hit', label='result')
+    monitor.incr('memcache-lookups', len(keys) - hits, key='miss',
+                 label='result')
+    return rv
+
+  def __getattr__(self, attr):
+    value = getattr(self._client, attr)
+    if not profile.is_enabled() or not callable(value):
+      return value
+    return profile.traced(value, 'memcache', 'memcache.%s' % attr)
+
+  def __setattr__(self, attr, value):
+    setattr(self._client, attr, value)
+
+client = ProfiledClient(memcache.Client())
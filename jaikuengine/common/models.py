@@ -22,6 +22,7 @@ from django.conf import settings
 from django.db import models as django_models
 import djangotoolbox.fields
 
+from common import monitor
 from common import profile
 from common import properties
 from common import util
@@ -64,28 +65,100 @@ def _get_actor_urlnick_from_nick(nick):
     nick = nick[1:]
   return nick
 
-def _to_api(v):
+def _to_api(v, fields=None):
+  """Converts v to something simplejson can dump.
+
+  fields - optional dict describing which keys to keep, each key maps to
+           the same kind of dict for its own value, an empty dict means
+           the whole value is wanted; None means everything
+  """
   if hasattr(v, 'to_api'):
-    v = v.to_api()
+    if fields:
+      v = v.to_api(fields=fields)
+    else:
+      v = v.to_api()
   elif isinstance(v, type([])):
-    v = [_to_api(x) for x in v]
+    v = [_to_api(x, fields) for x in v]
   elif isinstance(v, type({})):
-    v = dict([(key, _to_api(value)) for (key, value) in v.iteritems()])
+    if fields:
+      v = dict([(key, _to_api(value, fields[key] or None))
+                for (key, value) in v.iteritems()
+                if key in fields])
+    else:
+      v = dict([(key, _to_api(value)) for (key, value) in v.iteritems()])
   elif isinstance(v, datetime.datetime):
     v = str(v)
   return v
 
+def _datetime_to_api(v, fields=None):
+  if v is None:
+    return v
+  return str(v)
 
-# Base Models, Internal Only
+# Property and field types whose values simplejson can already handle
+_API_PLAIN_TYPES = ('StringProperty', 'IntegerProperty', 'FloatProperty',
+                    'BooleanProperty', 'TextProperty', 'StringListProperty',
+                    'CharField', 'IntegerField', 'BooleanField', 'FloatField',
+                    'TextField')
 
-class ApiMixinModel(models.Model):
-  def to_api(self):
+_API_DATETIME_TYPES = ('DateTimeProperty', 'DateTimeField')
+
+class ApiSerializer(object):
+  """Turns instances of one model class into their api representation.
+
+  It is built once per class from the declared properties so that to_api
+  does not need to look at properties() and test the type of every value
+  each time an entity is serialized.
+  """
+  def __init__(self, names, exclude=()):
+    self.converters = []
+    for name, kind in names:
+      if name in exclude:
+        continue
+      if kind in _API_PLAIN_TYPES:
+        convert = None
+      elif kind in _API_DATETIME_TYPES:
+        convert = _datetime_to_api
+      else:
+        convert = _to_api
+      self.converters.append((name, convert))
+
+  def __call__(self, instance, fields=None):
     o = {}
-    for prop in self.properties().keys():
-      value = getattr(self, prop)
-      o[prop] = _to_api(value)
+    for name, convert in self.converters:
+      sub_fields = None
+      if fields:
+        if name not in fields:
+          continue
+        sub_fields = fields[name] or None
+      value = getattr(instance, name)
+      if convert:
+        value = convert(value, sub_fields)
+      o[name] = value
     return o
 
+_api_serializers = {}
+def api_serializer(cls):
+  """Returns the ApiSerializer for a model class, building it if needed."""
+  serializer = _api_serializers.get(cls)
+  if serializer is None:
+    if hasattr(cls, 'properties'):
+      names = [(name, prop.__class__.__name__)
+               for name, prop in cls.properties().iteritems()]
+    else:
+      names = [(field.name, field.__class__.__name__)
+               for field in cls._meta.fields]
+    serializer = ApiSerializer(names, exclude=getattr(cls, 'api_exclude', ()))
+    _api_serializers[cls] = serializer
+  return serializer
+
+
+# Base Models, Internal Only
+
+class ApiMixinModel(models.Model):
+  def to_api(self, fields=None):
+    return api_serializer(self.__class__)(self, fields)
+
 class CachingModel(ApiMixinModel):
   """A simple caching layer for model objects: caches any item read with
   get_by_key_name and removes from the cache on put() and delete()
@@ -164,9 +237,11 @@ class CachingModel(ApiMixinModel):
         CachingModel._cache[clsname] = { }
       elif CachingModel._cache[clsname].has_key((key_names, parent)):
         profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_hit')
+        monitor.incr('cachingmodel-lookups', key='hit', label='result')
         return CachingModel._cache[clsname][(key_names, parent)]
 
       profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_miss')
+      monitor.incr('cachingmodel-lookups', key='miss', label='result')
       ret = super(CachingModel, cls).get_by_key_name(key_names, parent)
       CachingModel._get_count += 1
       CachingModel._cache[clsname][(key_names, parent)] = ret
@@ -312,6 +387,9 @@ class Actor(DjangoDeletedMarkerModel):
 
   key_template = 'actor/%(nick)s'
 
+  # never exported through the api
+  api_exclude = ('password', 'normalized_nick')
+
   def url(self, path="", request=None, mobile=False):
     """ returns a url, with optional path appended
     
@@ -330,24 +408,24 @@ class Actor(DjangoDeletedMarkerModel):
     return self.nick.split("@")[0]
     return _get_actor_urlnick_from_nick(self.nick)
 
-  def to_api(self):
-    rv = super(Actor, self).to_api()
-    del rv['password']
-    del rv['normalized_nick']
-    extra = {}
-    for k, v in rv['extra'].iteritems():
-      if k in ACTOR_ALLOWED_EXTRA:
-        extra[k] = v
-    rv['extra'] = extra
+  def to_api(self, fields=None):
+    rv = api_serializer(self.__class__)(self, fields)
+    if 'extra' in rv:
+      extra = {}
+      for k, v in rv['extra'].iteritems():
+        if k in ACTOR_ALLOWED_EXTRA:
+          extra[k] = v
+      rv['extra'] = extra
     return rv
 
-  def to_api_limited(self):
-    rv = self.to_api()
-    extra = {}
-    for k, v in rv['extra'].iteritems():
-      if k in ACTOR_LIMITED_EXTRA:
-        extra[k] = v
-    rv['extra'] = extra
+  def to_api_limited(self, fields=None):
+    rv = self.to_api(fields)
+    if 'extra' in rv:
+      extra = {}
+      for k, v in rv['extra'].iteritems():
+        if k in ACTOR_LIMITED_EXTRA:
+          extra[k] = v
+      rv['extra'] = extra
     return rv
 
   def is_channel(self):
@@ -388,6 +466,14 @@ class InboxEntry(CachingModel):
   uuid = models.StringProperty()
   shard = models.StringProperty()       # an identifier for this portion of
                                         # inboxes
+  # who may see the entry, stamped at fanout so readers can skip what they
+  # can't see before fetching it, see api._inbox_invisible. Unset on
+  # entries added before we started stamping
+  visibility = models.StringProperty(indexed=False) # public, contacts or
+                                                    # private
+  owner = models.StringProperty()       # ref - whose contacts may see it
+  generation = models.IntegerProperty(indexed=False) # of the owner's privacy
+  deleted = models.BooleanProperty(default=False, indexed=False)
 
   key_template = 'inboxentry/%(stream)s/%(uuid)s/%(shard)s'
 
@@ -395,6 +481,22 @@ class InboxEntry(CachingModel):
     """Returns the key name of the corresponding StreamEntry"""
     return "%s/%s" % (self.stream, self.uuid)
 
+class InboxBucket(CachingModel):
+  """The entries of an inbox created within one time bucket, packed into a
+  single entity.
+
+  An alternative to the InboxEntry index: reading the newest entries of an
+  inbox is one get and adding to it writes no index rows, see
+  api._bucket_append and settings.INBOX_BACKEND.
+  """
+  inbox = models.StringProperty(indexed=False)
+  bucket = models.IntegerProperty(indexed=False)
+  entries = models.TextProperty()       # "usec\tstream_type\tentry" lines,
+                                        # oldest first
+  truncated = models.BooleanProperty(default=False, indexed=False)
+
+  key_template = 'inboxbucket/%(inbox)s/%(bucket)s'
+
 class Invite(CachingModel):
   code = models.StringProperty() # the code for the invite
   email = models.StringProperty() # the email this invite went to
@@ -482,6 +584,73 @@ class Presence(CachingModel):
   # TODO(termie): can't do key_template here yet because we include 
   #               current and history keys :/
 
+class PresenceHistory(CachingModel):
+  """The presence updates of an actor during one span of time.
+
+  history:
+    updates - list of (updated_at, uuid, changed, removed) tuples in time
+              order, changed and removed only hold the extra keys that
+              differ from the previous update
+  """
+  actor = models.StringProperty()     # The actor whose presence this is
+  bucket = properties.DateTimeProperty()
+                                      # The start of the span of time
+  updated_at = properties.DateTimeProperty()
+                                      # The newest update in the chunk
+  history = properties.DictProperty()
+
+  key_template = 'presencehistory/%(actor)s/%(bucket)s'
+
+  def updates(self):
+    """ yields (updated_at, uuid, extra) for every update, oldest first """
+    extra = {}
+    for updated_at, uuid, changed, removed in self.history.get('updates', []):
+      extra = dict(extra)
+      extra.update(changed)
+      for k in removed:
+        extra.pop(k, None)
+      yield updated_at, uuid, extra
+
+  def add_updates(self, updates):
+    """ merges (updated_at, uuid, extra) updates into the chunk
+
+    Adding an update that is already there is a no-op so flushes can be
+    retried safely.
+    """
+    merged = dict((uuid, (updated_at, uuid, extra))
+                  for updated_at, uuid, extra in self.updates())
+    for updated_at, uuid, extra in updates:
+      merged[uuid] = (updated_at, uuid, extra)
+
+    compacted = []
+    previous = {}
+    for updated_at, uuid, extra in sorted(merged.values()):
+      changed = dict((k, v) for k, v in extra.iteritems()
+                     if k not in previous or previous[k] != v)
+      removed = [k for k in previous if k not in extra]
+      compacted.append((updated_at, uuid, changed, removed))
+      previous = extra
+    self.history = {'updates': compacted}
+    if compacted:
+      self.updated_at = compacted[-1][0]
+
+  def presence_at(self, at_time):
+    """ the presence as of at_time or None if the chunk starts later """
+    found = None
+    for updated_at, uuid, extra in self.updates():
+      if updated_at > at_time:
+        break
+      found = (updated_at, uuid, extra)
+    if not found:
+      return None
+    updated_at, uuid, extra = found
+    return Presence(actor=self.actor,
+                    updated_at=updated_at,
+                    uuid=uuid,
+                    extra=extra,
+                    key_name='presence/%s/history/%s' % (self.actor,
+                                                         updated_at))
+
 class Task(CachingModel):
   actor = models.StringProperty()     # ref - the owner of this queue item
   action = models.StringProperty()    # api call we are iterating through
@@ -13,8 +13,169 @@
 # limitations under the License.
 
 """ A library to export some stats that we can use for monitoring.
+
+Counters are cheap to bump: incr() and observe() only add to a dict in
+this instance, flush() moves the totals to memcache every
+MONITOR_FLUSH_INTERVAL seconds. Each flush adds to one of MONITOR_SHARDS
+copies of every counter so that instances rarely contend on a key, and
+collect() sums the shards back up for /_monitor.
+
+A counter is either plain, `name`, or one entry of a map,
+`name|label:key`, which export() shows as `name map:label key:value ...`.
+Histograms are maps of bucket upper bounds, labelled `le`.
 """
 
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from google.appengine.api import apiproxy_stub_map
+
+# upper bounds of the histogram buckets
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+NAMES_KEY = 'monitor/names'
+NAMES_RETRIES = 3
+
+_lock = threading.Lock()
+_pending = {}
+_last_flush = 0.0
+_local = threading.local()
+
+
+def _client():
+  # imported late, common.memcache reports its hit rate to us, and our own
+  # lookups skip that so that they don't skew it
+  from common import memcache
+  return getattr(memcache.client, '_client', memcache.client)
+
+def _shard_key(shard, counter):
+  return 'monitor/%d/%s' % (shard, counter)
+
+def incr(name, delta=1, key=None, label='key'):
+  """ counts delta more of name, or of key in the map name """
+  counter = name
+  if key is not None:
+    counter = '%s|%s:%s' % (name, label, key)
+  _lock.acquire()
+  try:
+    _pending[counter] = _pending.get(counter, 0) + delta
+  finally:
+    _lock.release()
+
+def bucket(value):
+  for bound in BUCKETS:
+    if value <= bound:
+      return str(bound)
+  return 'inf'
+
+def observe(name, value, key=None):
+  """ adds value to the histogram name, or to the histogram of key """
+  if key is not None:
+    name = '%s/%s' % (name, key)
+  incr(name, key=bucket(value), label='le')
+  incr('%s-count' % name)
+  incr('%s-sum' % name, int(round(value)))
+
+def flush(force=False):
+  """ moves the pending counts to memcache, at most once every
+  MONITOR_FLUSH_INTERVAL seconds unless forced """
+  global _last_flush
+  now = time.time()
+  if not force and now - _last_flush < settings.MONITOR_FLUSH_INTERVAL:
+    return
+
+  _lock.acquire()
+  try:
+    pending = _pending.copy()
+    _pending.clear()
+    _last_flush = now
+  finally:
+    _lock.release()
+
+  if not pending:
+    return
+
+  shard = random.randrange(settings.MONITOR_SHARDS)
+  mapping = dict([(_shard_key(shard, k), v) for k, v in pending.iteritems()])
+  try:
+    _client().offset_multi(mapping, initial_value=0)
+    _register(pending.keys())
+  except Exception:
+    # losing some counts beats failing the request
+    logging.exception('Failed to flush monitoring counters')
+
+def _register(counters):
+  """ adds the counters to the list that collect() reads """
+  client = _client()
+  for i in range(NAMES_RETRIES):
+    current = client.get_multi([NAMES_KEY], for_cas=True).get(NAMES_KEY)
+    if current is None:
+      if client.add(NAMES_KEY, sorted(counters)):
+        return
+      continue
+
+    missing = set(counters) - set(current)
+    if not missing:
+      return
+    if not client.cas_multi({NAMES_KEY: sorted(set(current) | missing)}):
+      return
+  logging.warning('Failed to register %d monitoring counters', len(counters))
+
+def collect():
+  """ the flushed counters, summed over their shards """
+  client = _client()
+  counters = client.get(NAMES_KEY) or []
+  shards = range(settings.MONITOR_SHARDS)
+  keys = [_shard_key(s, c) for c in counters for s in shards]
+  values = keys and client.get_multi(keys) or {}
+
+  o = {}
+  for c in counters:
+    o[c] = sum([values.get(_shard_key(s, c)) or 0 for s in shards])
+  return o
+
+def exported(counters=None):
+  """ the counters in the shape export() takes, maps holding both a hit and
+  a miss count also get a hit rate """
+  if counters is None:
+    counters = collect()
+
+  o = {}
+  maps = {}
+  for counter, value in counters.iteritems():
+    if '|' not in counter:
+      o[counter] = value
+      continue
+    name, rest = counter.split('|', 1)
+    label, key = rest.split(':', 1)
+    maps.setdefault(name, (label, {}))[1][key] = value
+
+  for name, (label, value) in maps.iteritems():
+    o[name] = (label, value)
+    if 'hit' in value and 'miss' in value:
+      total = value['hit'] + value['miss']
+      o['%s-hit-rate' % name] = total and float(value['hit']) / total or 0.0
+  return o
+
+def _datastore_hook(service, call, request, response):
+  _local.datastore_ops = getattr(_local, 'datastore_ops', 0) + 1
+
+def install_datastore_hook():
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'monitor', _datastore_hook, 'datastore_v3')
+
+def start_request():
+  _local.datastore_ops = 0
+
+def finish_request():
+  """ the datastore calls made since start_request() """
+  return getattr(_local, 'datastore_ops', 0)
+
+
 def export(values):
   o = []
   for k, v in sorted(values.items()):
@@ -44,7 +205,7 @@ class ExportedCallable(object):
     self.callable = callable
 
   def __str__(self):
-    return make_value(self.callable())
+    return str(build_value(self.callable()))
 
 def build_value(value):
   """ attempt to do some inference of types """
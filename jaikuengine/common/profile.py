@@ -12,75 +12,182 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+
+"""Per-request tracing of datastore, memcache and api calls.
+
+Every thread keeps its own stack of open spans, a span opened while another
+one is open becomes its child. Once the outermost span of a trace is
+finished the whole tree is handed to the exporter.
+
+Tracing is off unless start() or label() is called on the thread, which is
+what the tests and ProfileMiddleware do. In production the middleware
+traces a sample of requests, see PROFILE_SAMPLE_RATE and PROFILE_EXPORTER
+in settings.
+"""
+
 import logging
+import random
+import threading
 import time
 
+import simplejson
+
 from django import template
 from django.conf import settings
 from django.template import loader
 
 PROFILE_ALL_TESTS = False
 
-enabled = False
+default_label = 'default'
+general_label = 'general'
+
+_local = threading.local()
+
+def _state():
+  if not hasattr(_local, 'stack'):
+    _local.enabled = False
+    _local.label = general_label
+    _local.stack = []
+  return _local
+
 def start():
-  global enabled
-  enabled = True
+  _state().enabled = True
   return
 
 def stop():
-  global enabled
-  enabled = False
+  _state().enabled = False
   return
 
-def clear():
-  global storage
-  storage = []
+def is_enabled():
+  return _state().enabled
+
+def should_sample(rate):
+  return rate > 0 and random.random() < rate
+
+
+class Span(object):
+  """ a timed call, with the calls it made as children """
+
+  def __init__(self, name, tag='general', label=None, parent=None):
+    self.name = name
+    self.tag = tag
+    self.label = label
+    self.parent = parent
+    self.children = []
+    self.start_time = time.time()
+    self.time_ms = 0.0
+    if parent is not None:
+      parent.children.append(self)
+
+  def finish(self, time_ms=None):
+    if time_ms is None:
+      time_ms = round(time.time() - self.start_time, 5) * 1000
+    self.time_ms = time_ms
+
+  def walk(self, depth=0):
+    yield depth, self
+    for child in self.children:
+      for x in child.walk(depth + 1):
+        yield x
+
+  def rows(self):
+    """ the (label, tag, call, time_ms) rows we have always exported """
+    for depth, span in self.walk():
+      if span.tag == 'label':
+        continue
+      yield (span.label, span.tag, span.name, span.time_ms)
+
+  def to_dict(self):
+    return {'name': self.name,
+            'tag': self.tag,
+            'label': self.label,
+            'start': self.start_time,
+            'time_ms': self.time_ms,
+            'children': [x.to_dict() for x in self.children],
+            }
+
+def start_span(name, tag='general'):
+  """ opens a span under the current one, None while tracing is off """
+  state = _state()
+  if not state.enabled:
+    return None
+  parent = state.stack and state.stack[-1] or None
+  span = Span(name, tag=tag, label=state.label, parent=parent)
+  state.stack.append(span)
+  return span
+
+def finish_span(span, time_ms=None):
+  if span is None:
+    return
+  span.finish(time_ms)
+  stack = _state().stack
+  # also closes anything an exception left open underneath
+  if span in stack:
+    while stack.pop() is not span:
+      pass
+  if span.parent is None:
+    get_exporter().export(span)
+
+def traced(f, tag, name):
+  def _wrap(*args, **kw):
+    span = start_span(name, tag=tag)
+    try:
+      return f(*args, **kw)
+    finally:
+      finish_span(span)
+  _wrap.func_name = getattr(f, 'func_name', name)
+  return _wrap
 
-default_label = 'default'
-current_label = 'general'
 
 class Label(object):
-  """ convenience class for clearing a label """
+  """ a trace of its own, for profiling some specific call or whatever """
 
   name = None
   previous = None
+  span = None
 
   def __init__(self, name, previous=default_label):
     self.name = name
     self.previous = previous
 
   def start(self):
-    global current_label
-    current_label = self.name
+    state = _state()
+    state.label = self.name
     start()
+    self.span = start_span(self.name, tag='label')
 
   def stop(self):
-    global current_label
-    current_label = self.previous
+    """ finishes the trace and returns its root span """
+    finish_span(self.span)
+    _state().label = self.previous
     stop()
+    return self.span
 
 def label(name):
   """ for labeling a section of profile data to associate it with
       some specific call or whatever
   """
-  l = Label(name, current_label)
+  l = Label(name, _state().label)
   l.start()
   return l
 
 
-# deco
+def _class_func_key(call_class, call_name):
+  class_name = getattr(call_class,
+                       '__name__',
+                       getattr(call_class.__class__, '__name__')
+                       )
+  return "%s.%s" % (class_name, call_name)
+
 def _log_call(f, tag='general'):
   call_name = f.func_name
-    
+
   def _wrap(self, *args, **kw):
-    if enabled:
-      call_self = self
-      start_time = time.time()
-    rv = f(self, *args, **kw)
-    if enabled:
-      time_diff = round(time.time() - start_time, 5) * 1000
-      store_call(call_self, call_name, tag=tag, time_ms=time_diff)
-    return rv
+    span = start_span(_class_func_key(self, call_name), tag=tag)
+    try:
+      return f(self, *args, **kw)
+    finally:
+      finish_span(span)
   _wrap.func_name = call_name
 
   return _wrap
@@ -104,66 +211,181 @@ def profiled(f):
     stop()
   _wrap.func_name = f.func_name
   return _wrap
-  
-def _log_api_call(f, call_self, tag='api'):
-  call_name = f.func_name
-    
-  def _wrap(*args, **kw):
-    if enabled:
-      start_time = time.time()
-    rv = f(*args, **kw)
-    if enabled:
-      time_diff = round(time.time() - start_time, 5) * 1000
-      store_call(call_self, call_name, tag=tag, time_ms=time_diff)
-    return rv
-  _wrap.func_name = call_name
-
-  return _wrap
 
+_api_profiling_installed = False
+_api_originals = {}
 def install_api_profiling():
+  """ traces every function in common.api, tagged 'api', returns False if
+  that was already the case """
+  global _api_profiling_installed
+  if _api_profiling_installed:
+    return False
+  _api_profiling_installed = True
+
   from common import api
   for k in dir(api):
     f = getattr(api, k)
     if type(f) != type(log_call):
       continue
-    setattr(api, k, _log_api_call(f, api, tag='api')) 
+    _api_originals[k] = f
+    setattr(api, k, traced(f, 'api', _class_func_key(api, f.func_name)))
+  return True
+
+def uninstall_api_profiling():
+  """ puts back the functions install_api_profiling() replaced """
+  global _api_profiling_installed
+  if not _api_profiling_installed:
+    return
+  _api_profiling_installed = False
 
+  from common import api
+  for k, f in _api_originals.iteritems():
+    setattr(api, k, f)
+  _api_originals.clear()
+
+_template_profiling_installed = False
+_template_render = None
+def install_template_profiling():
+  """ traces every template render, tagged 'template', returns False if
+  that was already the case """
+  global _template_profiling_installed, _template_render
+  if _template_profiling_installed:
+    return False
+  _template_profiling_installed = True
+
+  render = _template_render = template.Template.render
+  def _render(self, context):
+    span = start_span('Template.render(%s)' % getattr(self, 'name', None),
+                      tag='template')
+    try:
+      return render(self, context)
+    finally:
+      finish_span(span)
+  template.Template.render = _render
+  return True
+
+def uninstall_template_profiling():
+  """ puts back the Template.render install_template_profiling() replaced """
+  global _template_profiling_installed, _template_render
+  if not _template_profiling_installed:
+    return
+  _template_profiling_installed = False
 
+  template.Template.render = _template_render
+  _template_render = None
 
-def flattened(header=False):
+def time_by_tag(span):
+  """ the time spent under each tag in a trace, a call nested in another
+  call with the same tag counts only once """
+  o = {}
+  def _walk(span, tags):
+    if span.tag not in tags:
+      o[span.tag] = o.get(span.tag, 0.0) + span.time_ms
+      tags = tags + (span.tag,)
+    for child in span.children:
+      _walk(child, tags)
+  _walk(span, ())
+  return o
+
+
+# An exporter is anything with an export(span) method, called with every
+# finished trace
+
+class MemoryExporter(object):
+  """ keeps the rows around for csv() and html(), for tests and the dev
+  server, only the last PROFILE_MEMORY_ROWS of them so that a long running
+  instance doesn't grow without bound
+  """
+  def export(self, span):
+    limit = getattr(settings, 'PROFILE_MEMORY_ROWS', 10000)
+    _storage_lock.acquire()
+    try:
+      storage.extend(span.rows())
+      if len(storage) > limit:
+        del storage[:len(storage) - limit]
+    finally:
+      _storage_lock.release()
+
+class StreamExporter(object):
+  """ writes every trace to a stream, or to the log if there is none """
+  def __init__(self, stream=None):
+    self.stream = stream
+
+  def write(self, text):
+    if self.stream is None:
+      logging.info('profile: %s', text)
+    else:
+      self.stream.write(text + '\n')
+
+class CsvExporter(StreamExporter):
+  def export(self, span):
+    self.write(_csv(span.rows()))
+
+class JsonLinesExporter(StreamExporter):
+  def export(self, span):
+    self.write(simplejson.dumps(span.to_dict(), separators=(',', ':')))
+
+EXPORTERS = {'memory': MemoryExporter,
+             'csv': CsvExporter,
+             'jsonlines': JsonLinesExporter,
+             }
+
+_exporter = None
+def get_exporter():
+  global _exporter
+  if _exporter is None:
+    _exporter = EXPORTERS[getattr(settings, 'PROFILE_EXPORTER', 'memory')]()
+  return _exporter
+
+def set_exporter(exporter):
+  """ takes the name of an exporter or an exporter, returns the old one """
+  global _exporter
+  old = _exporter
+  if isinstance(exporter, basestring):
+    exporter = EXPORTERS[exporter]()
+  _exporter = exporter
+  return old
+
+
+def flattened(header=False, spans=None):
   o = []
   if header:
-    o.append(('tag', 'call', 'time_ms'))
-  o.extend(storage)
+    o.append(('label', 'tag', 'call', 'time_ms'))
+  if spans is None:
+    o.extend(storage)
+  else:
+    for span in spans:
+      o.extend(span.rows())
 
   return o
 
-def csv(header=False):
-  rv = flattened(header)
-  csv = '\n'.join([','.join([str(cell) for cell in row]) for row in rv])
-  return csv
+def _csv(rows):
+  return '\n'.join([','.join([str(cell) for cell in row]) for row in rows])
 
- 
-def html():
+def csv(header=False, spans=None):
+  return _csv(flattened(header, spans))
+
+
+def html(spans=None):
   # our storage looks like:
   # label, tag, class_func_key, time_ms
 
   # assumes a single label for now
   o = {}
   total_ms = 0.0
-  for (label, tag, class_func_key, time_ms) in storage:
+  for (label, tag, class_func_key, time_ms) in flattened(spans=spans):
     o.setdefault(tag, {'sub': {}, 'time_ms': 0.0, 'count': 0})
 
     o[tag]['sub'].setdefault(class_func_key, {'each': [], 'time_ms': 0.0})
 
     o[tag]['sub'][class_func_key]['each'].append(time_ms)
     o[tag]['sub'][class_func_key]['time_ms'] += time_ms
-    
+
     o[tag]['time_ms'] += time_ms
     o[tag]['count'] += 1
 
     total_ms += time_ms
-  
+
   for tag in o:
     # sort the calls by name
     o[tag]['sub'] = sorted(o[tag]['sub'].iteritems(), key=lambda x: x[0])
@@ -172,21 +394,19 @@ def html():
   c = template.Context({'timing': o, 'total': total_ms})
   t = loader.get_template('common/templates/profiling.html')
   return t.render(c)
- 
 
-storage = []
-def store_call(call_class, call_name, tag='general', time_ms=0.0):
-  global current_label
-  global enabled
 
-  if not enabled:
-    return
+_storage_lock = threading.Lock()
+storage = []
 
-  class_name = getattr(call_class, 
-                       '__name__', 
-                       getattr(call_class.__class__, '__name__')
-                       )
-  call_class = class_name
-  class_func_key = "%s.%s" % (call_class, call_name)
+def clear():
+  _storage_lock.acquire()
+  try:
+    del storage[:]
+  finally:
+    _storage_lock.release()
 
-  storage.append((current_label, tag, class_func_key, time_ms))
+def store_call(call_class, call_name, tag='general', time_ms=0.0):
+  """ records a call that has already happened """
+  span = start_span(_class_func_key(call_class, call_name), tag=tag)
+  finish_span(span, time_ms)
@@ -21,9 +21,15 @@ try:
 except ImportError:
   import pickle
 
+import simplejson
+
+from django.conf import settings
+
 from google.appengine.ext import db
 from google.appengine.api.datastore_types import Blob
 
+from common import monitor
+
 DJANGO_DATE = "%Y-%m-%d"
 DJANGO_TIME = "%H:%M:%S"
 
@@ -59,8 +65,88 @@ class DateTimeProperty(db.DateTimeProperty):
     value = super(DateTimeProperty, self).validate(value)
     return value
 
+# The first byte of a DictProperty blob says how the rest is encoded, none
+# of these start a pickle so anything else is read as the legacy pickle
+DICT_JSON = '\x01'
+
+_JSON_SCALARS = (unicode, int, long, float, bool, type(None))
+
+def _is_json(value):
+  """ whether value comes back the same, up to str becoming unicode, from
+  a round trip through JSON """
+  t = type(value)
+  if t in _JSON_SCALARS:
+    return True
+  if t is str:
+    try:
+      value.decode('utf-8')
+      return True
+    except UnicodeDecodeError:
+      return False
+  if t is list:
+    for x in value:
+      if not _is_json(x):
+        return False
+    return True
+  if t is dict:
+    for k, v in value.iteritems():
+      if type(k) not in (str, unicode) or not _is_json(k) or not _is_json(v):
+        return False
+    return True
+  return False
+
+def dumps_dict(value):
+  """Encodes a dict as canonical JSON behind a version byte.
+
+  Values JSON can't carry as they are, datetimes, tuples, binary strings or
+  objects, fall back to the legacy pickle, as does DICT_PROPERTY_CODEC
+  'pickle' for rolling back to code that can only read that.
+  """
+  if settings.DICT_PROPERTY_CODEC == 'json' and _is_json(value):
+    o = simplejson.dumps(value, separators=(',', ':'), sort_keys=True,
+                         ensure_ascii=False)
+    if isinstance(o, unicode):
+      o = o.encode('utf-8')
+    return DICT_JSON + o
+  if settings.DICT_PROPERTY_CODEC == 'json':
+    monitor.incr('dictproperty-pickle-fallbacks')
+  return pickle.dumps(value, protocol=-1)
+
+def loads_dict(data):
+  """ decodes what dumps_dict wrote, or a legacy pickle """
+  if data[:1] == DICT_JSON:
+    return simplejson.loads(data[1:], encoding='utf-8')
+  return pickle.loads(data)
+
+def is_legacy_dict(data):
+  return data[:1] != DICT_JSON
+
+class _Encoded(object):
+  """ a DictProperty value as it came from the datastore, not decoded yet """
+  def __init__(self, data):
+    self.data = data
+
+
 class DictProperty(db.Property):
+  """A dict stored as a blob, see dumps_dict.
+
+  With DICT_PROPERTY_LAZY the blob of a loaded entity is only decoded when
+  the property is first read, so entities that get filtered out or put back
+  untouched never pay for it, and an untouched blob is written back as is
+  unless it is JSON while DICT_PROPERTY_CODEC is 'pickle'.
+  """
+  def __get__(self, model_instance, model_class):
+    if model_instance is None:
+      return self
+    value = getattr(model_instance, self._attr_name(), None)
+    if isinstance(value, _Encoded):
+      value = loads_dict(value.data)
+      setattr(model_instance, self._attr_name(), value)
+    return value
+
   def validate(self, value):
+    if isinstance(value, _Encoded):
+      return value
     value = super(DictProperty, self).validate(value)
     if not isinstance(value, dict):
       raise Exception("NOT A DICT %s" % value)
@@ -73,9 +159,18 @@ class DictProperty(db.Property):
     return Blob
 
   def get_value_for_datastore(self, model_instance):
+    value = getattr(model_instance, self._attr_name(), None)
+    if isinstance(value, _Encoded):
+      if settings.DICT_PROPERTY_CODEC == 'json' or is_legacy_dict(value.data):
+        return Blob(value.data)
+      # rolled back to the pickle codec, don't write back JSON the older
+      # code can't read
+      return Blob(dumps_dict(loads_dict(value.data)))
     value = super(DictProperty, self).get_value_for_datastore(model_instance)
-    return Blob(pickle.dumps(value, protocol=-1))
+    return Blob(dumps_dict(value))
 
   def make_value_from_datastore(self, model_instance):
     value = super(DictProperty, self).make_value_from_datastore(model_instance)
-    return pickle.loads(str(value))
+    if settings.DICT_PROPERTY_LAZY:
+      return _Encoded(str(value))
+    return loads_dict(str(value))
@@ -22,6 +22,7 @@ from google.appengine.api import urlfetch
 from django.conf import settings
 
 from common import exception
+from common import monitor
 from common.protocol import base
 
 class _DevRpc(object):
@@ -33,6 +34,7 @@ class PshbConnection(base.Connection):
     self.endpoint = endpoint
 
   def publish_async(self, urls):
+    monitor.incr('notifications-sent', len(urls), key='pshb', label='channel')
     if settings.MANAGE_PY:
       logging.info('pshb.publish(%s, %s)', self.endpoint, self.urls)
       return _DevRpc()
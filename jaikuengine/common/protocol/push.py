@@ -0,0 +1,55 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from django.conf import settings
+
+from common import component
+from common import memcache
+from common.protocol import base
+
+# How much longer than a long-poll we remember that an inbox is watched, a
+# client usually comes back for the next one within this time
+WATCH_SLACK = 10
+
+def _watch_key(inbox):
+  return 'push_watch/%s' % inbox
+
+class PushConnection(base.Connection):
+  """Wakes up long-polling clients, see components/dummy_push_service."""
+
+  def watch(self, inbox):
+    memcache.client.set(_watch_key(inbox), 1,
+                        time=settings.PUSH_MAX_WAIT + WATCH_SLACK)
+
+  def filter_watched(self, inboxes):
+    """ the inboxes somebody is currently long-polling """
+    if not inboxes:
+      return []
+    watched = memcache.client.get_multi([_watch_key(x) for x in inboxes])
+    return [x for x in inboxes if watched.get(_watch_key(x))]
+
+  def send_message(self, inboxes, message):
+    if not inboxes:
+      return
+    push_service = component.best['push_service']
+    push_service.send_message(inboxes, message)
+
+  def cursor(self, inbox):
+    push_service = component.best['push_service']
+    return push_service.cursor(inbox)
+
+  def wait(self, inbox, cursor, timeout):
+    push_service = component.best['push_service']
+    return push_service.wait(inbox, cursor, timeout)
@@ -19,6 +19,7 @@ from django.conf import settings
 from cleanliness import encoding
 
 from common import exception
+from common import monitor
 from common import throttle
 from common import component
 from common.protocol import base
@@ -55,6 +56,19 @@ class SmsConnection(base.Connection):
     return to_list
 
 
+  def apply_global_quota(self, to_list):
+    """ trims to_list to what is left of the global monthly sms limit """
+    granted = throttle.reserve(None,
+                               'sms_global_send',
+                               len(to_list),
+                               month=settings.THROTTLE_SMS_GLOBAL_MONTH)
+    if not granted:
+      raise exception.ApiThrottled('Too many attempts this month')
+    if granted < len(to_list):
+      logging.warning('Global SMS limit reached, dropping %d of %d targets',
+                      len(to_list) - granted, len(to_list))
+    return to_list[:granted]
+
   def send_message(self, to_list, message):
     if not to_list:
       return
@@ -65,16 +79,11 @@ class SmsConnection(base.Connection):
       exception.log_warning()
       return
 
-    # global monthly sms limit
-    # TODO(termie): this means that no messages will be sent if any
-    #               will go over the limit, is this really the behavior
-    #               we want?
-    for i in range(0, len(to_list)):
-      throttle.throttle(None, 
-                        'sms_global_send', 
-                        month=settings.THROTTLE_SMS_GLOBAL_MONTH)
-  
+    to_list = self.apply_global_quota(to_list)
+
     message = encoding.smart_str(message)
     sms_service = component.best['sms_service']
     sms_service.send_message(to_list, message)
+    monitor.incr('notifications-sent', len(to_list), key='sms',
+                 label='channel')
 
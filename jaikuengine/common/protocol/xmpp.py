@@ -20,6 +20,7 @@ from django.utils import html
 
 from cleanliness import encoding
 from common import component
+from common import monitor
 from common.protocol import base
 
 class JID(object):
@@ -90,3 +91,5 @@ class XmppConnection(base.Connection):
     xmpp_service.send_message([j.base() for j in to_jid_list],
                               body,
                               raw_xml=raw_xml)
+    monitor.incr('notifications-sent', len(to_jid_list), key='im',
+                 label='channel')
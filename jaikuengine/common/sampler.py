@@ -0,0 +1,257 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Whole-request profiles for production, aggregated per view.
+
+A sampled request is profiled with either a stack sampler, a thread that
+looks at the request's stack every PROFILER_INTERVAL seconds, or with
+cProfile. Either way the result is a set of collapsed stacks, frames joined
+by ';' with a weight, which is added to the running total for the view in
+memcache. bin/collapse_profiles.py merges those into the input of
+flamegraph.pl.
+
+Requests are picked at PROFILER_SAMPLE_RATE, or when they carry a token from
+/_monitor/profile/token in an X-Profile-Token header.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+  import cProfile
+  import pstats
+except ImportError:
+  cProfile = None
+
+from django.conf import settings
+
+from common import memcache
+from common import profile
+from common import util
+
+# only the heaviest stacks of a view are kept, and only as many of those as
+# fit in MAX_BYTES so the profile stays well under memcache's 1MB limit
+MAX_STACKS = 500
+MAX_BYTES = 900 * 1024
+MAX_DEPTH = 64
+# the pickled size of a stack beyond its characters, roughly
+STACK_OVERHEAD = 16
+CAS_RETRIES = 3
+NAMES_KEY = 'sampler/views'
+
+_names = {}
+
+
+def _name(filename, function):
+  """ filename:function, the filename relative to sys.path """
+  key = (filename, function)
+  if key not in _names:
+    for path in sys.path:
+      if path and filename.startswith(path + os.sep):
+        filename = filename[len(path) + 1:]
+        break
+    _names[key] = '%s:%s' % (filename, function)
+  return _names[key]
+
+
+class StackSampler(object):
+  """ samples the stack of the thread that started it from another thread """
+  def __init__(self, interval=None):
+    self.interval = interval or settings.PROFILER_INTERVAL
+    self.stacks = {}
+    self._thread_id = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    self._thread_id = threading.currentThread().ident
+    self._thread = threading.Thread(target=self._run)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def _run(self):
+    while not self._stop.isSet():
+      frame = sys._current_frames().get(self._thread_id)
+      if frame is not None:
+        self._sample(frame)
+      self._stop.wait(self.interval)
+
+  def _sample(self, frame):
+    o = []
+    while frame is not None and len(o) < MAX_DEPTH:
+      o.append(_name(frame.f_code.co_filename, frame.f_code.co_name))
+      frame = frame.f_back
+    stack = ';'.join(reversed(o))
+    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+  def stop(self):
+    """ returns the collapsed stacks, weighted by samples """
+    self._stop.set()
+    if self._thread:
+      self._thread.join()
+    return self.stacks
+
+
+class CProfileSampler(object):
+  """Runs cProfile over the request.
+
+  cProfile only knows who called whom, so the stacks it gives are pairs of
+  caller and callee weighted by the microseconds spent in the callee itself
+  when called from there.
+  """
+  def __init__(self):
+    self.profiler = cProfile.Profile()
+
+  def start(self):
+    self.profiler.enable()
+
+  def stop(self):
+    self.profiler.disable()
+    stats = pstats.Stats(self.profiler).stats
+    stacks = {}
+    for func, (cc, nc, tt, ct, callers) in stats.iteritems():
+      name = _func_name(func)
+      if not callers:
+        stacks[name] = stacks.get(name, 0) + int(tt * 1000000)
+        continue
+      for caller, caller_stats in callers.iteritems():
+        # the caller stats hold the callee's inline time for that caller
+        stack = '%s;%s' % (_func_name(caller), name)
+        stacks[stack] = stacks.get(stack, 0) + int(caller_stats[2] * 1000000)
+    return dict([(k, v) for k, v in stacks.iteritems() if v > 0])
+
+def _func_name(func):
+  filename, lineno, name = func
+  return _name(filename, name)
+
+
+SAMPLERS = {'stack': StackSampler,
+            'cprofile': CProfileSampler,
+            }
+
+def get_sampler(mode=None):
+  mode = mode or settings.PROFILER_MODE
+  if mode == 'cprofile' and cProfile is None:
+    mode = 'stack'
+  if mode == 'stack' and not hasattr(sys, '_current_frames'):
+    mode = 'cprofile'
+  return SAMPLERS[mode]()
+
+
+def make_token(expires=None):
+  """ a token for the X-Profile-Token header good until expires, an hour
+  from now if not given """
+  if expires is None:
+    expires = int(time.time()) + 60 * 60
+  return '%d:%s' % (expires, util.hash_generic('profile:%d' % expires))
+
+def check_token(token):
+  try:
+    expires, signature = token.split(':', 1)
+    expires = int(expires)
+  except (AttributeError, ValueError):
+    return False
+  if expires < time.time():
+    return False
+  return _equal(make_token(expires), token)
+
+def _equal(a, b):
+  """ compares two strings in time that doesn't depend on where they
+  differ, so that a signature can't be guessed a character at a time """
+  if len(a) != len(b):
+    return False
+  o = 0
+  for x, y in zip(a, b):
+    o |= ord(x) ^ ord(y)
+  return o == 0
+
+def should_profile(request):
+  if check_token(request.META.get('HTTP_X_PROFILE_TOKEN')):
+    return True
+  return profile.should_sample(settings.PROFILER_SAMPLE_RATE)
+
+
+def _key(view):
+  return 'sampler/view/%s' % view
+
+def merge(into, stacks):
+  for stack, weight in stacks.iteritems():
+    into[stack] = into.get(stack, 0) + weight
+  size = sum([len(stack) + STACK_OVERHEAD for stack in into])
+  if len(into) <= MAX_STACKS and size <= MAX_BYTES:
+    return into
+
+  # drop the lightest stacks until both limits are met
+  heaviest = sorted(into.iteritems(), key=lambda x: -x[1])
+  del heaviest[MAX_STACKS:]
+  size = sum([len(stack) + STACK_OVERHEAD for stack, weight in heaviest])
+  while heaviest and size > MAX_BYTES:
+    stack, weight = heaviest.pop()
+    size -= len(stack) + STACK_OVERHEAD
+  return dict(heaviest)
+
+def store(view, stacks):
+  """ adds stacks to the profile of view """
+  if not stacks:
+    return
+  key = _key(view)
+  client = memcache.client
+  for i in range(CAS_RETRIES):
+    current = client.get_multi([key], for_cas=True).get(key)
+    if current is None:
+      value = {'requests': 1, 'stacks': merge({}, stacks)}
+      if client.add(key, value):
+        break
+      continue
+    value = {'requests': current['requests'] + 1,
+             'stacks': merge(current['stacks'], stacks)}
+    if not client.cas_multi({key: value}):
+      break
+  else:
+    logging.warning('Dropped the profile of a request to %s', view)
+    return
+  _register(view)
+
+def _register(view):
+  client = memcache.client
+  for i in range(CAS_RETRIES):
+    current = client.get_multi([NAMES_KEY], for_cas=True).get(NAMES_KEY)
+    if current is None:
+      if client.add(NAMES_KEY, [view]):
+        return
+      continue
+    if view in current:
+      return
+    if not client.cas_multi({NAMES_KEY: sorted(current + [view])}):
+      return
+
+def views():
+  """ the views we have profiles for """
+  return memcache.client.get(NAMES_KEY) or []
+
+def get(view):
+  """ the profile of view, a dict of requests and stacks, or None """
+  return memcache.client.get(_key(view))
+
+def clear(view):
+  memcache.client.delete(_key(view))
+
+def collapsed(stacks):
+  """ the stacks in the format flamegraph.pl reads """
+  return '\n'.join(['%s %d' % (stack, weight)
+                    for stack, weight in sorted(stacks.iteritems())])
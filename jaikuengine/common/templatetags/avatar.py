@@ -73,6 +73,9 @@ def noncached_avatar(value, args):
 def avatar_url(value, arg="t"):
   size = arg
   icon = value.extra.get('icon', 'avatar_default')
+  if value.extra.get('icon_pending'):
+    # the sizes are still being made, see api.avatar_resize
+    icon = 'avatar_default'
 
   # TODO shard these
   # TODO cache these
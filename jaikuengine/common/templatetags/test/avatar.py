@@ -34,6 +34,16 @@ class AvatarTest(base.FixturesTestCase):
                 ' class="photo" alt="popular" width="50" height="50" />')
     self.assertEquals(expected, avatar.avatar(self.popular, "t"))
 
+  def test_avatar_url_pending(self):
+    self.popular.extra = {'icon': 'popular@example.com/avatar_new',
+                          'icon_pending': True}
+    self.assertEquals("http://localhost:8080/image/avatar_default_u.jpg",
+                      avatar.avatar_url(self.popular, "u"))
+    del self.popular.extra['icon_pending']
+    self.assertEquals(
+        "http://localhost:8080/image/popular%40example.com/avatar_new_u.jpg",
+        avatar.avatar_url(self.popular, "u"))
+
   @staticmethod
   def _raise_exception():
     raise Exception()
@@ -23,11 +23,13 @@ from django.conf import settings
 from django.core import mail
 
 from google.appengine.api import images
+from google.appengine.ext import db
 
 from common import api
 from common import clean
 from common import exception
 from common import mail as common_mail
+from common import memcache
 from common import models
 from common import oauth_util
 from common import profile
@@ -37,6 +39,8 @@ from common.protocol import sms
 from common.test import base
 from common.test import util as test_util
 
+from api import views as api_views
+
 
 class ApiIntegrationTest(base.FixturesTestCase):
   def setUp(self):
@@ -183,6 +187,62 @@ class ApiIntegrationTest(base.FixturesTestCase):
     rv = self.get('/api/json', params)
     self.assertEqual(rv['status'], 'ok', str(rv))
 
+  def test_json_batch(self):
+    settings.API_DISABLE_VERIFICATION = True
+
+    calls = [{'method': 'actor_get', 'nick': 'popular@example.com'},
+             {'method': 'INVALID_METHOD'},
+             {'method': 'entry_get_actor_overview',
+              'nick': 'popular@example.com',
+              'limit': 2},
+             {'method': ['actor_get']},
+             {'method': 'actor_get', 'nick': 'popular@example.com',
+              'fields': 5},
+             ]
+    rv = self.get('/api/json', {'json_params': simplejson.dumps(calls)})
+    self.assertEqual(rv['status'], 'ok', str(rv))
+    self.assertEqual(len(rv['rv']), 5)
+
+    self.assertEqual(rv['rv'][0]['status'], 'ok')
+    self.assertEqual(rv['rv'][0]['rv']['actor']['nick'], 'popular@example.com')
+    self.assertEqual(rv['rv'][1]['status'], 'error')
+    self.assertEqual(rv['rv'][1]['code'], exception.INVALID_METHOD)
+    self.assertEqual(rv['rv'][2]['status'], 'ok')
+    self.assertEqual(len(rv['rv'][2]['rv']['entries']), 2)
+    self.assertEqual(rv['rv'][3]['status'], 'error')
+    self.assertEqual(rv['rv'][3]['code'], exception.INVALID_METHOD)
+    self.assertEqual(rv['rv'][4]['status'], 'error')
+    self.assertEqual(rv['rv'][4]['code'], exception.INVALID_ARGUMENTS)
+
+  def test_json_batch_too_many_calls(self):
+    settings.API_DISABLE_VERIFICATION = True
+
+    calls = [{'method': 'actor_get', 'nick': 'popular@example.com'}]
+    calls = calls * (api_views.MAX_BATCH_CALLS + 1)
+    rv = self.get('/api/json', {'json_params': simplejson.dumps(calls)})
+    self.assertEqual(rv['status'], 'error')
+    self.assertEqual(rv['code'], exception.INVALID_ARGUMENTS)
+
+  def test_json_if_none_match(self):
+    settings.API_DISABLE_VERIFICATION = True
+
+    params = {'method': 'entry_get_actor_overview_since',
+              'nick': 'popular@example.com',
+              'since_time': str(self.now - datetime.timedelta(days=1))}
+    popular_ref = api.actor_get(api.ROOT, 'popular@example.com')
+    api.post(popular_ref, nick='popular@example.com', message='marker')
+    test_util.exhaust_queue_any()
+
+    response = self.client.get('/api/json', params)
+    etag = response['ETag']
+    rv = simplejson.loads(response.content)
+    self.assertEqual(rv['status'], 'ok', str(rv))
+    self.assertEqual('"%s"' % rv['rv']['version'], etag)
+
+    response = self.client.get('/api/json', params, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response['ETag'], etag)
+
   def test_presence_get_contacts(self):
     settings.API_DISABLE_VERIFICATION = True
 
@@ -1596,6 +1656,107 @@ class ApiUnitTestPresence(ApiUnitTest):
         self.public_actor, self.public_actor.nick, at_time = timestamp_after)
     self.assertEquals(presence_after, presence2)
 
+  def test_history_is_buffered(self):
+    nick = self.public_actor.nick
+    timestamp1 = datetime.datetime(2007, 01, 01, 02, 03, 04, 5)
+    timestamp2 = datetime.datetime(2007, 01, 01, 03, 03, 04, 5)
+    self._set(self.public_actor, nick, timestamp1, 'bar')
+    self._set(self.public_actor, nick, timestamp2, 'baz')
+
+    # only the current presence was written
+    self.assertEqual(models.Presence.gql('WHERE actor = :1', nick).count(), 1)
+    self.assertEqual(
+        models.PresenceHistory.gql('WHERE actor = :1', nick).count(), 0)
+    presence = api.presence_get(self.public_actor, nick, at_time=timestamp1)
+    self.assertEqual(presence.extra['status'], 'bar')
+
+    test_util.exhaust_queue_any()
+    self.assertFalse(memcache.client.get(api._presence_buffer_key(nick)))
+    chunks = list(models.PresenceHistory.gql('WHERE actor = :1', nick))
+    self.assertEqual(len(chunks), 1)
+    updates = chunks[0].history['updates']
+    self.assertEqual(len(updates), 2)
+    # the second update only keeps what changed
+    self.assertEqual(sorted(updates[1][2].keys()),
+                     ['senders_timestamp', 'status'])
+
+    presence = api.presence_get(self.public_actor, nick, at_time=timestamp1)
+    self.assertEqual(presence.extra['status'], 'bar')
+    self.assertEqual(presence.updated_at, timestamp1)
+    presence = api.presence_get(self.public_actor, nick, at_time=timestamp2)
+    self.assertEqual(presence.extra['status'], 'baz')
+
+  def test_history_across_chunks(self):
+    nick = self.public_actor.nick
+    timestamp1 = datetime.datetime(2007, 01, 01, 02, 03, 04, 5)
+    timestamp2 = datetime.datetime(2007, 01, 03, 02, 03, 04, 5)
+    timestamp_between = datetime.datetime(2007, 01, 03, 01, 00, 00)
+    self._set(self.public_actor, nick, timestamp1, 'bar')
+    self._set(self.public_actor, nick, timestamp2, 'baz')
+    test_util.exhaust_queue_any()
+
+    self.assertEqual(
+        models.PresenceHistory.gql('WHERE actor = :1', nick).count(), 2)
+    presence = api.presence_get(
+        self.public_actor, nick, at_time=timestamp_between)
+    self.assertEqual(presence.extra['status'], 'bar')
+
+  def test_history_flush_is_idempotent(self):
+    nick = self.public_actor.nick
+    timestamp1 = datetime.datetime(2007, 01, 01, 02, 03, 04, 5)
+    self._set(self.public_actor, nick, timestamp1, 'bar')
+    buffered = memcache.client.get(api._presence_buffer_key(nick))
+    api._presence_history_write(nick, buffered)
+    test_util.exhaust_queue_any()
+
+    chunk = models.PresenceHistory.gql('WHERE actor = :1', nick).get()
+    self.assertEqual(len(chunk.history['updates']), 1)
+
+  def test_flush_requeues_late_updates(self):
+    nick = self.public_actor.nick
+    timestamp1 = datetime.datetime(2007, 01, 01, 02, 03, 04, 5)
+    timestamp2 = datetime.datetime(2007, 01, 01, 02, 03, 05, 5)
+    self._set(self.public_actor, nick, timestamp1, 'bar')
+
+    # an update arrives while the flush is writing, it sees the buffer
+    # waiting for a flush and doesn't queue one
+    history_write = api._presence_history_write
+    def _write_with_update(nick, updates):
+      history_write(nick, updates)
+      self._set(self.public_actor, nick, timestamp2, 'baz')
+    queued = []
+    def _queue_flush(nick, uuid):
+      queued.append(uuid)
+    self.mox.stubs.Set(api, '_presence_history_write', _write_with_update)
+    self.mox.stubs.Set(api, '_presence_queue_flush', _queue_flush)
+    api.presence_flush_history(api.ROOT, nick)
+    self.mox.stubs.Set(api, '_presence_history_write', history_write)
+
+    buffered = memcache.client.get(api._presence_buffer_key(nick))
+    self.assertEqual([x[0] for x in buffered], [timestamp2])
+    # so the flush queues the next one
+    self.assertEqual(queued, [buffered[0][1]])
+
+  def test_history_write_reads_stored_chunk(self):
+    nick = self.public_actor.nick
+    timestamp1 = datetime.datetime(2007, 01, 01, 02, 03, 04, 5)
+    timestamp2 = datetime.datetime(2007, 01, 01, 03, 03, 04, 5)
+    extra = {'status': 'bar'}
+    api._presence_history_write(nick, [(timestamp1, 'first', extra)])
+    # the chunk sits in the per request cache now, as another write changes
+    # the stored copy
+    key_name = models.PresenceHistory.key_from(
+        actor=nick, bucket=api._presence_history_bucket(timestamp1))
+    models.PresenceHistory.get_by_key_name(key_name)
+    stored = models.PresenceHistory.get_by_key_name([key_name])[0]
+    stored.add_updates([(timestamp2, 'second', extra)])
+    db.put(stored)
+
+    api._presence_history_write(nick, [(timestamp2, 'third', extra)])
+    chunk = models.PresenceHistory.get_by_key_name([key_name])[0]
+    self.assertEqual([x[1] for x in chunk.history['updates']],
+                     ['first', 'second', 'third'])
+
   def test_permissions(self):
     private_actor = api.actor_get(api.ROOT, self.celebrity_nick)
     unpopular_actor = api.actor_get(api.ROOT, self.unpopular_nick)
@@ -1647,6 +1808,491 @@ class ApiUnitTestPresence(ApiUnitTest):
                                           timestamp_after)
     self.assertEquals(len(presences), 0)
 
+class ApiUnitTestPolling(ApiUnitTest):
+  def setUp(self):
+    super(ApiUnitTestPolling, self).setUp()
+    self.inbox = 'inbox/%s/overview' % self.popular_nick
+
+  def _post(self, message, seconds=0):
+    o = test_util.override_clock(api, seconds=seconds)
+    try:
+      entry_ref = api.post(self.popular, nick=self.popular_nick,
+                           message=message)
+      test_util.exhaust_queue_any()
+    finally:
+      o.reset()
+    return entry_ref
+
+  def _forbid_datastore(self):
+    def _fail(*args, **kw):
+      self.fail('polled the datastore')
+    self.mox.stubs.Set(api, 'inbox_get_entries_since', _fail)
+
+  def test_since_marker(self):
+    self._post('before')
+    since_time = api.utcnow() + datetime.timedelta(seconds=1)
+
+    self._forbid_datastore()
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time)
+    self.assertEqual(len(rv), 0)
+    self.assert_(rv.kw['version'])
+    self.mox.stubs.UnsetAll()
+
+    entry_ref = self._post('after', seconds=2)
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time)
+    self.assertEqual([x.keyname() for x in rv], [entry_ref.keyname()])
+
+  def test_version(self):
+    self._post('before')
+    since_time = api.utcnow() - datetime.timedelta(days=1)
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time)
+    self.assert_(len(rv))
+    version = rv.kw['version']
+
+    self._forbid_datastore()
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time,
+        version=version)
+    self.assertEqual(len(rv), 0)
+    self.assertEqual(rv.kw['version'], version)
+    self.mox.stubs.UnsetAll()
+
+    # a version only matches the query that produced it
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time, limit=10,
+        version=version)
+    self.assert_(len(rv))
+
+    self._post('after', seconds=2)
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time,
+        version=version)
+    self.assert_(len(rv))
+    self.assertNotEqual(rv.kw['version'], version)
+
+  def test_version_rpc_budget(self):
+    self._post('before')
+    since_time = api.utcnow() - datetime.timedelta(days=1)
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time)
+    version = rv.kw['version']
+
+    # a poll that the marker answers only pays for the ownership check
+    recorder = self.record_rpcs()
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=since_time,
+        version=version)
+    self.assertRpcBudget(recorder, queries=0, puts=0, datastore=2)
+
+  def test_truncated_has_no_version(self):
+    self._post('one')
+    self._post('two', seconds=1)
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, limit=1)
+    self.assertEqual(len(rv), 1)
+    self.assertFalse('version' in rv.kw)
+
+  def test_missing_marker(self):
+    entry_ref = self._post('before')
+    memcache.client.delete(api._inbox_marker_key(self.inbox))
+    rv = api.entry_get_actor_overview_since(
+        self.popular, self.popular_nick, since_time=entry_ref.created_at)
+    self.assertEqual([x.keyname() for x in rv], [entry_ref.keyname()])
+    self.assertFalse('version' in rv.kw)
+
+  def test_marker_moves_forward(self):
+    self._post('later', seconds=10)
+    marker = api._inbox_marker(self.inbox)
+    # an entry fanned out by a slower task doesn't move the marker back
+    self._post('earlier')
+    self.assert_(api._inbox_marker(self.inbox) > marker)
+
+
+class ApiUnitTestRpcBudget(ApiUnitTest):
+  # per entry: the entry, its stream and its owner
+  per_entry = 3
+
+  def test_overview(self):
+    recorder = self.record_rpcs()
+    rv = api.entry_get_actor_overview(self.popular, self.popular_nick)
+    recorder.stop()
+    self.assert_(len(rv))
+    self.assertRpcBudget(recorder, puts=0, queries=2,
+                         datastore=4 + self.per_entry * len(rv))
+
+  def test_channel(self):
+    recorder = self.record_rpcs()
+    rv = api.entry_get_inbox(self.popular, 'inbox/#popular@example.com/public')
+    recorder.stop()
+    self.assertRpcBudget(recorder, puts=0, queries=2,
+                         datastore=4 + self.per_entry * len(rv))
+
+
+class ApiUnitTestFanoutLag(ApiUnitTest):
+  def test_lags(self):
+    timings = {'inboxes': {'start': 101.0, 'first': 102.0, 'finish': 110.0,
+                           'hops': 3},
+               'notify_im': {'start': 111.0, 'first': 112.0, 'finish': 112.0,
+                             'hops': 1},
+               # started but never finished
+               'notify_sms': {'start': 113.0, 'first': None, 'finish': None,
+                              'hops': 0},
+               }
+    task_ref = api.Task(actor=self.popular_nick, action='post',
+                        action_id='1234', progress='', args=[], kw={},
+                        created_at=100.0, timings=timings)
+    self.assertEqual(task_ref.lags(api.AddEntryTaskSpec.lag_stages),
+                     {'first_inbox': 2.0, 'last_inbox': 10.0, 'im': 12.0})
+
+  def test_trace(self):
+    entry_ref = api.post(self.popular, nick=self.popular_nick,
+                         message='how long did this take')
+    test_util.exhaust_queue_any()
+
+    trace = api.fanout_trace_get(api.ROOT, entry_ref.uuid)
+    self.assertEqual(trace['action'], 'post')
+    # the timings made it across every hop of the task
+    for stage in ('initial', 'inboxes', 'notify_im', 'notify_email'):
+      self.assert_(trace['timings'][stage]['hops'] >= 1, stage)
+    self.assertEqual(
+        sorted(trace['lags'].keys()),
+        ['email', 'first_inbox', 'im', 'last_inbox', 'pshb', 'sms'])
+    for lag in trace['lags'].itervalues():
+      self.assert_(lag >= 0)
+
+    r = self.client.get('/_monitor/fanout/%s' % entry_ref.uuid)
+    self.assertEqual(simplejson.loads(r.content)['lags'], trace['lags'])
+
+    r = self.client.get('/_monitor/fanout/nosuchentry')
+    self.assertEqual(r.status_code, 404)
+
+  def test_trace_requires_admin(self):
+    self.assertRaises(exception.ApiException,
+                      api.fanout_trace_get, self.popular, '1234')
+
+
+class ApiUnitTestInboxBuckets(ApiUnitTest):
+  inbox = 'inbox/popular@example.com/overview'
+
+  def setUp(self):
+    super(ApiUnitTestInboxBuckets, self).setUp()
+    # dual writes began with today's bucket
+    today = api._bucket_index(api.utcnow()) * api.INBOX_BUCKET_SECONDS
+    self.override = test_util.override(
+        INBOX_BACKEND='dual',
+        INBOX_BUCKET_START=datetime.datetime.utcfromtimestamp(today))
+
+  def tearDown(self):
+    self.override.reset()
+    super(ApiUnitTestInboxBuckets, self).tearDown()
+
+  def _post(self, count):
+    for i in range(count):
+      api.post(self.popular, nick=self.popular_nick,
+               message='bucketed %d' % i)
+    test_util.exhaust_queue_any()
+
+  def test_dual_write(self):
+    self._post(3)
+    rv = api.inbox_check_buckets(api.ROOT, self.inbox)
+    self.assertEqual(rv['missing'], [])
+    self.assertEqual(rv['extra'], [])
+    self.assert_(rv['checked'] >= 3)
+
+  def test_reads_match_index(self):
+    self._post(3)
+    index = api.inbox_get_entries(api.ROOT, self.inbox, limit=3)
+    everything = api.inbox_get_entries(api.ROOT, self.inbox, limit=100)
+    o = test_util.override(INBOX_BACKEND='bucket')
+    try:
+      self.assertEqual(api._bucket_get_entries(self.inbox, 3), index)
+      self.assertEqual(api.inbox_get_entries(api.ROOT, self.inbox, limit=3),
+                       index)
+      # more than the buckets hold comes from the index
+      self.assertEqual(api._bucket_get_entries(self.inbox, 100), None)
+      self.assertEqual(
+          api.inbox_get_entries(api.ROOT, self.inbox, limit=100), everything)
+    finally:
+      o.reset()
+
+  def test_since(self):
+    since = api.utcnow()
+    self._post(2)
+    o = test_util.override(INBOX_BACKEND='bucket')
+    try:
+      rv = api.inbox_get_entries_since(api.ROOT, self.inbox, since_time=since)
+    finally:
+      o.reset()
+    self.assertEqual(
+        rv, api.inbox_get_entries_since(api.ROOT, self.inbox,
+                                        since_time=since))
+    self.assertEqual(len(rv), 2)
+
+  def test_append_is_idempotent(self):
+    now = api.utcnow()
+    for i in range(2):
+      api._bucket_append(['inbox/test'], 'presence', 'stream/test/1', now)
+    bucket_ref = api._bucket_get('inbox/test', [api._bucket_index(now)])[0]
+    self.assertEqual(len(api._bucket_unpack(bucket_ref)), 1)
+
+  def test_truncated(self):
+    self.mox.stubs.Set(api, 'INBOX_BUCKET_MAX_ENTRIES', 2)
+    now = api.utcnow()
+    for i in range(3):
+      api._bucket_append(['inbox/test'], 'presence', 'stream/test/%d' % i,
+                         now + datetime.timedelta(microseconds=i))
+    bucket_ref = api._bucket_get('inbox/test', [api._bucket_index(now)])[0]
+    self.assert_(bucket_ref.truncated)
+    self.assertEqual([x[2] for x in api._bucket_unpack(bucket_ref)],
+                     ['stream/test/1', 'stream/test/2'])
+    self.assertEqual(api._bucket_get_entries('inbox/test', 3), None)
+
+  def test_append_in_transactions(self):
+    now = api.utcnow()
+    inboxes = ['inbox/test%d' % i for i in range(3)]
+    run_in_transaction = db.run_in_transaction
+    transactions = []
+    def _record(function, *args):
+      transactions.append(args[0])
+      return run_in_transaction(function, *args)
+    self.mox.stubs.Set(db, 'run_in_transaction', _record)
+    api._bucket_append(inboxes, 'presence', 'stream/test/1', now)
+    self.assertEqual(transactions, inboxes)
+    for inbox in inboxes:
+      bucket_ref = api._bucket_get(inbox, [api._bucket_index(now)])[0]
+      self.assertEqual([x[2] for x in api._bucket_unpack(bucket_ref)],
+                       ['stream/test/1'])
+
+  def test_explore_is_excluded(self):
+    explore = 'inbox/%s/explore' % api.ROOT.nick
+    now = api.utcnow()
+    api._bucket_append([explore], 'presence', 'stream/test/1', now)
+    self.assertEqual(api._bucket_get(explore, [api._bucket_index(now)]),
+                     [None])
+    o = test_util.override(INBOX_BACKEND='bucket')
+    try:
+      self.assertEqual(api._bucket_get_entries(explore, 1), None)
+    finally:
+      o.reset()
+
+  def test_incomplete_falls_back(self):
+    since = api.utcnow()
+    self._post(2)
+    self.assertEqual(len(api._bucket_get_entries(self.inbox, 2)), 2)
+    # buckets from before the dual writes may be missing entries
+    o = test_util.override(
+        INBOX_BUCKET_START=since + datetime.timedelta(days=1))
+    try:
+      self.assertEqual(api._bucket_get_entries(self.inbox, 2), None)
+      self.assertEqual(
+          api._bucket_get_entries_since(self.inbox, 2, since_time=since),
+          None)
+    finally:
+      o.reset()
+    o = test_util.override(INBOX_BUCKET_START=None)
+    try:
+      self.assertEqual(api._bucket_get_entries(self.inbox, 2), None)
+    finally:
+      o.reset()
+
+  def test_repair(self):
+    self._post(1)
+    bucket = api._bucket_index(api.utcnow())
+    api._bucket_get(self.inbox, [bucket])[0].delete()
+    rv = api.inbox_check_buckets(api.ROOT, self.inbox)
+    self.assert_(rv['missing'])
+    api.inbox_check_buckets(api.ROOT, self.inbox, repair=True)
+    self.assertEqual(api.inbox_check_buckets(api.ROOT, self.inbox)['missing'],
+                     [])
+
+
+class ApiUnitTestInboxVisibility(ApiUnitTest):
+  girlfriend_nick = 'girlfriend@example.com'
+  boyfriend_nick = 'boyfriend@example.com'
+
+  def setUp(self):
+    super(ApiUnitTestInboxVisibility, self).setUp()
+    self.girlfriend = api.actor_get(api.ROOT, self.girlfriend_nick)
+    self.boyfriend = api.actor_get(api.ROOT, self.boyfriend_nick)
+    # girlfriend keeps her presence to her contacts
+    self.entry_ref = api.post(self.girlfriend, nick=self.girlfriend_nick,
+                              message='just between us')
+    test_util.exhaust_queue_any()
+    self.key = self.entry_ref.keyname()
+
+  def _inbox_refs(self):
+    query = models.InboxEntry.gql('WHERE stream = :1 AND uuid = :2',
+                                  self.entry_ref.stream,
+                                  self.entry_ref.uuid)
+    return query.fetch(100)
+
+  def _invisible(self, api_user):
+    return api._inbox_invisible(api_user, self._inbox_refs())
+
+  def test_stamped_at_fanout(self):
+    for inbox_ref in self._inbox_refs():
+      self.assertEqual(inbox_ref.visibility, 'contacts')
+      self.assertEqual(inbox_ref.owner, self.girlfriend_nick)
+
+  def test_invisible(self):
+    self.assertEqual(self._invisible(None), set([self.key]))
+    self.assertEqual(self._invisible(self.popular), set([self.key]))
+    self.assertEqual(self._invisible(self.boyfriend), set())
+    self.assertEqual(self._invisible(self.girlfriend), set())
+    self.assertEqual(self._invisible(api.ROOT), set())
+
+  def test_contact_owners_fill_races_change(self):
+    nick = self.popular_nick
+    version = api._contact_owners_version(nick)
+    owners = api._contact_owners(nick)
+    self.assertFalse(self.girlfriend_nick in owners)
+
+    # a request that read the contacts before girlfriend added popular fills
+    # the cache only after her change forgot it
+    api.actor_add_contact(self.girlfriend, self.girlfriend_nick, nick)
+    memcache.client.set(api._contact_owners_key(nick, version), list(owners))
+    self.assert_(self.girlfriend_nick in api._contact_owners(nick))
+
+  def test_skips_fetch(self):
+    inbox = api.inbox_get_entries(self.popular,
+                                  'inbox/%s/overview' % self.girlfriend_nick)
+    self.assert_(self.key in inbox)
+    self.assert_(self.key in inbox.invisible)
+
+    fetched = []
+    entry_get_safe = api.entry_get_safe
+    def _entry_get_safe(api_user, entry):
+      fetched.append(entry)
+      return entry_get_safe(api_user, entry)
+    self.mox.stubs.Set(api, 'entry_get_safe', _entry_get_safe)
+
+    entries = api.entry_get_entries(self.popular, inbox)
+    self.assertFalse(self.key in fetched)
+    self.assertFalse(self.key in [x.keyname() for x in entries])
+
+  def test_privacy_change_restamps(self):
+    api.settings_change_privacy(self.girlfriend, self.girlfriend_nick,
+                                models.PRIVACY_PUBLIC)
+    # older stamps are not trusted while the restamp is queued
+    self.assertEqual(self._invisible(self.popular), set())
+
+    test_util.exhaust_queue_any()
+    for inbox_ref in self._inbox_refs():
+      self.assertEqual(inbox_ref.visibility, 'public')
+    self.assertEqual(self._invisible(self.popular), set())
+
+  def test_contact_change(self):
+    self.assertEqual(self._invisible(self.popular), set([self.key]))
+    api.actor_add_contact(self.girlfriend, self.girlfriend_nick,
+                          self.popular_nick)
+    self.assertEqual(self._invisible(self.popular), set())
+
+  def test_tombstone(self):
+    inbox = 'inbox/%s/overview' % self.girlfriend_nick
+    marker = api._inbox_marker(inbox)
+    api.entry_remove(self.girlfriend, self.key)
+    test_util.exhaust_queue_any()
+    for inbox_ref in self._inbox_refs():
+      self.assert_(inbox_ref.deleted)
+    self.assertEqual(self._invisible(self.girlfriend), set([self.key]))
+    self.assert_(api._inbox_marker(inbox) > marker)
+
+  def test_privacy_change_touches_inboxes(self):
+    inbox = 'inbox/%s/overview' % self.boyfriend_nick
+    marker = api._inbox_marker(inbox)
+    api.settings_change_privacy(self.girlfriend, self.girlfriend_nick,
+                                models.PRIVACY_PUBLIC)
+    test_util.exhaust_queue_any()
+    self.assert_(api._inbox_marker(inbox) > marker)
+
+
+class ApiUnitTestEntryPage(ApiUnitTest):
+  per_page = 3
+
+  def setUp(self):
+    super(ApiUnitTestEntryPage, self).setUp()
+    self.inbox = 'inbox/%s/public' % self.popular_nick
+    posted = []
+    for i in range(12):
+      entry_ref = api.post(self.popular, nick=self.popular_nick,
+                           message='page me %d' % i)
+      posted.append(entry_ref.keyname())
+    # leave a long run of deleted entries to page over
+    for keyname in posted[1:10]:
+      api.entry_remove(self.popular, keyname)
+    test_util.exhaust_queue_any()
+
+    self.fetches = []
+    def _fetch(limit, offset):
+      self.fetches.append(limit)
+      return api.inbox_get_entries(self.popular, self.inbox,
+                                   limit=limit, offset=offset)
+    self.fetch = _fetch
+
+  def _page(self, offset=None):
+    if offset:
+      offset = datetime.datetime.fromtimestamp(float(offset))
+    return api.entry_get_page(self.popular, self.inbox, self.per_page,
+                              offset=offset, fetch=self.fetch)
+
+  def test_refills_short_pages(self):
+    expected = api.entry_get_entries(
+        self.popular, api.inbox_get_entries(self.popular, self.inbox,
+                                            limit=100))
+    expected = [x.keyname() for x in expected]
+
+    seen = []
+    entries, more = self._page()
+    while True:
+      self.assert_(len(self.fetches) <= api.PAGE_MAX_FETCHES)
+      if more and len(entries) < self.per_page:
+        # only a page that ran out of batches may come up short
+        self.assertEqual(len(self.fetches), api.PAGE_MAX_FETCHES)
+      seen += [x.keyname() for x in entries]
+      if not more:
+        break
+      self.fetches = []
+      entries, more = self._page(more)
+
+    self.assertEqual(seen, expected)
+
+  def test_same_instant(self):
+    # more entries at one instant than fit on a page
+    instant = datetime.datetime(2030, 1, 1)
+    posted = [api.post(self.popular, nick=self.popular_nick,
+                       message='same time %d' % i) for i in range(6)]
+    test_util.exhaust_queue_any()
+    for entry_ref in posted:
+      entry_ref.created_at = instant
+      entry_ref.put()
+      query = models.InboxEntry.gql('WHERE stream = :1 AND uuid = :2',
+                                    entry_ref.stream, entry_ref.uuid)
+      for inbox_ref in query:
+        inbox_ref.created_at = instant
+        inbox_ref.put()
+
+    entries, more = self._page()
+    self.assertEqual(len(entries), self.per_page)
+    self.assert_(more)
+    # the next page still has a cursor, and it moves on
+    entries, later = self._page(more)
+    self.assert_(later)
+    self.assertNotEqual(later, more)
+
+  def test_ratio_over_fetches(self):
+    self._page()
+    ratio = memcache.client.get('page_ratio/%s' % self.inbox)
+    self.assert_(ratio < 1.0)
+
+    # the next read asks for more than a page up front
+    self.fetches = []
+    self._page()
+    self.assert_(self.fetches[0] > self.per_page + 1)
+
+
 class ApiUnitTestActivation(ApiUnitTest):
   def test_activation_request_email(self):
     actor = api.actor_get(api.ROOT, self.celebrity_nick)
@@ -1833,6 +2479,12 @@ class ApiUnitTestAvatarUpload(ApiUnitTest):
     avatar_base_path = api.avatar_upload(self.popular,
                                          self.popular_nick,
                                          self.avatar_file_content)
+    # only the original is stored in the upload request
+    for size in api.AVATAR_IMAGE_SIZES:
+      keyname = 'image/%s_%s.jpg' % (avatar_base_path, size)
+      self.assertEqual(models.Image.get_by_key_name(keyname), None)
+    test_util.exhaust_queue_any()
+
     all_sizes = {'original': (320, 320)} # original dimension
     all_sizes.update(api.AVATAR_IMAGE_SIZES)
     for size, dimensions in all_sizes.items():
@@ -1842,6 +2494,46 @@ class ApiUnitTestAvatarUpload(ApiUnitTest):
       image = images.Image(image_ref.content)
       self.assertEqual(dimensions, (image.width, image.height))
 
+  def testPending(self):
+    avatar_base_path = api.avatar_upload(self.popular,
+                                         self.popular_nick,
+                                         self.avatar_file_content)
+    api.avatar_set_actor(self.popular, self.popular_nick, avatar_base_path)
+    actor_ref = api.actor_get(api.ROOT, self.popular_nick)
+    self.assertEqual(actor_ref.extra['icon'], avatar_base_path)
+    self.assert_(actor_ref.extra.get('icon_pending'))
+
+    test_util.exhaust_queue_any()
+    actor_ref = api.actor_get(api.ROOT, self.popular_nick)
+    self.assertEqual(actor_ref.extra['icon'], avatar_base_path)
+    self.assertFalse(actor_ref.extra.get('icon_pending'))
+
+    # the sizes exist already when picking it again
+    api.avatar_set_actor(self.popular, self.popular_nick, avatar_base_path)
+    actor_ref = api.actor_get(api.ROOT, self.popular_nick)
+    self.assertFalse(actor_ref.extra.get('icon_pending'))
+
+  def testPendingRace(self):
+    avatar_base_path = api.avatar_upload(self.popular,
+                                         self.popular_nick,
+                                         self.avatar_file_content)
+    avatar_pending = api._avatar_pending
+    looked = []
+    def _racing_pending(path):
+      rv = avatar_pending(path)
+      if not looked:
+        looked.append(path)
+        # the sizes are made before avatar_set_actor gets to its put
+        test_util.exhaust_queue_any()
+      return rv
+    self.mox.stubs.Set(api, '_avatar_pending', _racing_pending)
+
+    api.avatar_set_actor(self.popular, self.popular_nick, avatar_base_path)
+    models.Actor.reset_cache()
+    actor_ref = api.actor_get(api.ROOT, self.popular_nick)
+    self.assertEqual(actor_ref.extra['icon'], avatar_base_path)
+    self.assertFalse(actor_ref.extra.get('icon_pending'))
+
   def testUploadInvalidImage(self):
 
     def _upload_invalid_image():
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import urlparse
 import sys
 
@@ -79,8 +80,12 @@ class FixturesTestCase(test.TestCase):
 
     self.client = client.Client(SERVER_NAME=settings.DOMAIN)
     self.mox = megamox.ExtendedMox()
+    self._rpc_recorders = []
 
   def tearDown(self):
+    for recorder in self._rpc_recorders:
+      recorder.stop()
+
     if profile.PROFILE_ALL_TESTS:
       profile.stop()
 
@@ -99,6 +104,30 @@ class FixturesTestCase(test.TestCase):
   def clear_cache(self):
     memcache.client._data = {}
 
+  def record_rpcs(self):
+    """Starts counting datastore and memcache calls, stop the returned
+    recorder and pass it to assertRpcBudget when done.
+    """
+    recorder = test_util.RpcRecorder().start()
+    self._rpc_recorders.append(recorder)
+    return recorder
+
+  def assertRpcBudget(self, recorder, msg='', **budgets):
+    """Fails if the recorder saw more calls than budgeted, e.g.
+
+      self.assertRpcBudget(recorder, datastore=12, memcache=20)
+
+    the failure lists the call sites responsible for the calls.
+    """
+    recorder.stop()
+    if os.environ.get('RPC_BUDGET_REPORT'):
+      sys.stderr.write('\n%s %s\n%s\n' % (msg or self.id(),
+                                           recorder.counts(),
+                                           recorder.report()))
+    over = recorder.check(budgets)
+    if over:
+      raise AssertionError('rpc budget exceeded %s\n%s' % (msg, over))
+
   def exhaust_queue(self, nick):
     test_util.exhaust_queue(nick)
 
@@ -106,6 +135,10 @@ class FixturesTestCase(test.TestCase):
     test_util.exhaust_queue_any()
 
 class ViewTestCase(FixturesTestCase):
+  # (nick, path) -> budgets for assertRpcBudget, checked by
+  # assertRpcBudgets, a nick of None fetches the page signed out
+  rpc_budgets = {}
+
   def login(self, nick, password=None):
     if not password:
       password = self.passwords[clean.nick(nick)]
@@ -121,6 +154,27 @@ class ViewTestCase(FixturesTestCase):
       self.login(nick, kw.get('password', None))
     return self.client.get(path, *args, **kw)
 
+  def assertRpcBudgets(self):
+    """Fetches each page in rpc_budgets and checks it against its budget,
+    reporting every page that is over budget at once.
+    """
+    failures = []
+    for (nick, path), budgets in sorted(self.rpc_budgets.iteritems()):
+      if nick:
+        self.login(nick)
+      recorder = self.record_rpcs()
+      r = self.client.get(path)
+      try:
+        self.assertRpcBudget(recorder, '%s as %s' % (path, nick or 'nobody'),
+                             **budgets)
+      except AssertionError, e:
+        failures.append(str(e))
+      self.assertEqual(r.status_code, 200, path)
+      if nick:
+        self.logout()
+    if failures:
+      raise AssertionError('\n\n'.join(failures))
+
   def assert_error_contains(self, response, content, code=200):
     self.assertContains(response, content, 1, code);
 
@@ -0,0 +1,235 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import bisect
+import os
+import random
+import sys
+import time
+
+import simplejson
+
+from django.core import mail
+
+from google.appengine.api import apiproxy_stub_map
+
+from common import api
+from common.test import base
+from common.test import util as test_util
+
+
+# actions that run through AddEntryTaskSpec
+ADD_ENTRY_ACTIONS = ('post', 'entry_add_comment')
+
+
+class SocialGraph(object):
+  """A synthetic graph of users built through the public api.
+
+  Followers are drawn from a power law over the users, so the first few
+  users (the hubs) end up followed by most everyone. A share of the users
+  is contacts-only and the first channel_members users join one channel.
+  """
+  channel = '#benchmark@example.com'
+
+  def __init__(self, users=60, follows=5, exponent=1.2, channel_members=30,
+               private_ratio=0.1, seed=1):
+    self.config = {'users': users,
+                   'follows': follows,
+                   'exponent': exponent,
+                   'channel_members': channel_members,
+                   'private_ratio': private_ratio,
+                   'seed': seed,
+                   }
+    self.random = random.Random(seed)
+    self.nicks = []
+    self.private = []
+    self.followers = {}
+
+  def nick(self, i):
+    return 'bench%04d@example.com' % i
+
+  def generate(self):
+    users = self.config['users']
+    for i in range(users):
+      nick = self.nick(i)
+      privacy = api.PRIVACY_PUBLIC
+      # the most followed user stays public, it is the one we post as
+      if i and self.random.random() < self.config['private_ratio']:
+        privacy = api.PRIVACY_CONTACTS
+        self.private.append(nick)
+      api.user_create(api.ROOT, nick=nick, password='benchmark',
+                      first_name='Bench', last_name='Mark', privacy=privacy)
+      self.nicks.append(nick)
+      self.followers[nick] = []
+
+    # rank r is followed with a weight of 1 / (r + 1) ** exponent
+    cumulative = []
+    total = 0.0
+    for r in range(users):
+      total += 1.0 / (r + 1) ** self.config['exponent']
+      cumulative.append(total)
+
+    for owner in self.nicks:
+      follows = min(self.config['follows'], users - 1)
+      targets = set()
+      while len(targets) < follows:
+        r = bisect.bisect(cumulative, self.random.random() * total)
+        target = self.nicks[min(r, users - 1)]
+        if target != owner:
+          targets.add(target)
+      for target in sorted(targets):
+        api.actor_add_contact(api.ROOT, owner, target)
+        self.followers[target].append(owner)
+
+    members = self.nicks[:self.config['channel_members']]
+    if members:
+      api.channel_create(api.ROOT, channel=self.channel, nick=members[0])
+      for nick in members[1:]:
+        api.channel_join(api.ROOT, nick, self.channel)
+
+    # anything the graph queued is not part of the measurements
+    test_util.exhaust_queue_any()
+    mail.outbox = []
+    return self
+
+  def most_followed(self, private=False):
+    candidates = [n for n in self.nicks if (n in self.private) == private]
+    return max(candidates, key=lambda n: len(self.followers[n]))
+
+
+def _stage(params):
+  action = params.get('action')
+  stage = (params.get('progress') or '').split(':', 1)[0] or 'initial'
+  if action in ADD_ENTRY_ACTIONS:
+    return stage
+  return '%s:%s' % (action, stage)
+
+def _add_stats(stats, stage, recorder, seconds, tasks):
+  o = stats.setdefault(stage, {'tasks': 0, 'wall_ms': 0.0})
+  for kind, count in recorder.counts().iteritems():
+    o[kind] = o.get(kind, 0) + count
+  o['tasks'] += tasks
+  o['wall_ms'] += seconds * 1000
+
+def run_stages(f):
+  """Calls f and then runs every task it queued one at a time.
+
+  Returns the result of f and the cost of each stage, the synchronous part
+  of f being the initial stage and every task a hop of its stage.
+  """
+  stats = {}
+  recorder = test_util.RpcRecorder().start()
+  start = time.time()
+  try:
+    rv = f()
+  finally:
+    recorder.stop()
+  _add_stats(stats, 'initial', recorder, time.time() - start, 0)
+
+  queue_stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+  tasks = queue_stub.GetTasks('default')
+  while tasks:
+    task = tasks.pop(0)
+    stage = _stage(test_util.task_params(task))
+    recorder = test_util.RpcRecorder().start()
+    start = time.time()
+    try:
+      test_util.run_task(task)
+    finally:
+      recorder.stop()
+    _add_stats(stats, stage, recorder, time.time() - start, 1)
+    tasks = queue_stub.GetTasks('default')
+  return rv, stats
+
+def total(stats):
+  o = {}
+  for stage in stats.itervalues():
+    for k, v in stage.iteritems():
+      o[k] = o.get(k, 0) + v
+  return o
+
+def write_report(report, path=None):
+  """ appends a report to path as one line of JSON, or writes it to stderr """
+  line = simplejson.dumps(report, sort_keys=True)
+  if not path:
+    sys.stderr.write('\n%s\n' % line)
+    return
+  f = open(path, 'a')
+  try:
+    f.write(line + '\n')
+  finally:
+    f.close()
+
+
+class FanoutBenchmark(base.FixturesTestCase):
+  """Posts and comments through every AddEntryTaskSpec stage on a
+  synthetic graph and reports the cost of each stage as JSON.
+
+  FANOUT_GRAPH takes a JSON object of SocialGraph arguments and
+  FANOUT_BENCHMARK_OUTPUT a file to append the report to, one line per run.
+  """
+  graph = {}
+
+  def setUp(self):
+    super(FanoutBenchmark, self).setUp()
+    config = dict(self.graph)
+    config.update(simplejson.loads(os.environ.get('FANOUT_GRAPH', '{}')))
+    self.social = SocialGraph(**config).generate()
+
+  def _post(self, nick, message):
+    actor_ref = api.actor_get(api.ROOT, nick)
+    return run_stages(
+        lambda: api.post(actor_ref, nick=nick, message=message))
+
+  def _comment(self, nick, entry_ref):
+    actor_ref = api.actor_get(api.ROOT, nick)
+    return run_stages(
+        lambda: api.entry_add_comment(actor_ref,
+                                      nick=nick,
+                                      stream=entry_ref.stream,
+                                      entry=entry_ref.keyname(),
+                                      content='benchmark comment'))
+
+  def test_fanout(self):
+    scenarios = {}
+    hub = self.social.most_followed()
+    entry_ref, scenarios['post'] = self._post(hub, 'benchmark post')
+    followers = self.social.followers[hub]
+    self.assert_(followers)
+    inbox = api.inbox_get_actor_overview(api.ROOT, followers[-1])
+    self.assertEqual(inbox[0], entry_ref.keyname())
+
+    comment_ref, scenarios['comment'] = self._comment(followers[-1],
+                                                      entry_ref)
+
+    if self.social.private:
+      private = self.social.most_followed(private=True)
+      rv, scenarios['private_post'] = self._post(private,
+                                                 'benchmark private post')
+
+    if self.social.config['channel_members']:
+      rv, scenarios['channel_post'] = self._post(
+          hub, '%s benchmark channel post' % self.social.channel.split('@')[0])
+
+    report = {'benchmark': 'fanout',
+              'time': int(time.time()),
+              'graph': self.social.config,
+              'followers': len(followers),
+              'scenarios': {}}
+    for name, stats in scenarios.iteritems():
+      report['scenarios'][name] = {'stages': stats, 'total': total(stats)}
+      self.assert_('initial' in stats, name)
+
+    write_report(report, os.environ.get('FANOUT_BENCHMARK_OUTPUT'))
@@ -0,0 +1,95 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import simplejson
+
+from common import hotkeys
+from common import memcache
+from common import models
+from common.test import base
+from common.test import util as test_util
+
+
+class SpaceSavingTest(base.FixturesTestCase):
+  def test_heavy_hitters_survive(self):
+    sketch = hotkeys.SpaceSaving(5)
+    for i in range(100):
+      sketch.add('hot', 1)
+      sketch.add('cold%d' % i, 1)
+    top = sketch.top(1)
+    self.assertEqual(top[0][0], 'hot')
+    weight, error, count, maximum = top[0][1]
+    self.assertEqual(count, 100)
+    self.assert_(weight - error <= 100 <= weight)
+    self.assertEqual(len(sketch.counters), 5)
+
+  def test_merge(self):
+    a = hotkeys.SpaceSaving(3)
+    b = hotkeys.SpaceSaving(3)
+    a.add('x', 10, 10)
+    b.add('x', 5, 20)
+    b.add('y', 1, 1)
+    a.merge(b)
+    self.assertEqual(a.counters['x'], [15, 0, 2, 20])
+    self.assertEqual(a.counters['y'], [1, 0, 1, 1])
+
+
+  def test_merge_keeps_error_bound(self):
+    a = hotkeys.SpaceSaving(2)
+    b = hotkeys.SpaceSaving(2)
+    for key, weight in (('x', 10), ('y', 4)):
+      a.add(key, weight)
+    for key, weight in (('x', 1), ('z', 6)):
+      b.add(key, weight)
+    a.merge(b)
+    # y may have been up to 1 in b and z up to 4 in a
+    self.assertEqual(a.counters, {'x': [11, 0, 2, 0], 'z': [10, 4, 1, 0]})
+
+class HotKeysTest(base.ViewTestCase):
+  def setUp(self):
+    super(HotKeysTest, self).setUp()
+    hotkeys.install_hooks()
+    hotkeys.flush(force=True)
+    self.override = test_util.override(SLOW_QUERY_MS=0)
+
+  def tearDown(self):
+    self.override.reset()
+    super(HotKeysTest, self).tearDown()
+
+  def test_records_gets_and_queries(self):
+    # a list of keys skips the per request cache of CachingModel
+    for i in range(3):
+      models.Actor.get_by_key_name(['actor/popular@example.com'])
+    models.StreamEntry.gql('WHERE owner = :1 ORDER BY created_at DESC',
+                           'popular@example.com').fetch(5)
+    memcache.client.get('hotkeys/ignored')
+    hotkeys.flush(force=True)
+
+    keys = dict(hotkeys.get(hotkeys.KEYS).top())
+    self.assert_(keys['Actor/actor/popular@example.com'][2] >= 3)
+    self.assertFalse('memcache:hotkeys/ignored' in keys)
+
+    queries = dict(hotkeys.get(hotkeys.QUERIES).top())
+    self.assert_('StreamEntry owner= -created_at' in queries)
+
+  def test_view(self):
+    models.Actor.get_by_key_name(['actor/popular@example.com'])
+    r = self.client.get('/_monitor/hotkeys')
+    self.assertEqual(r.status_code, 200)
+    self.assertContains(r, 'Actor/actor/popular@example.com')
+
+    r = self.client.get('/_monitor/hotkeys', {'format': 'json'})
+    top = simplejson.loads(r.content)
+    self.assert_(top['keys'])
@@ -0,0 +1,134 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from common import api
+from common import imagecache
+from common.test import base
+from common.test import util as test_util
+
+
+class LRUTest(base.FixturesTestCase):
+  def test_evicts_least_recently_used(self):
+    lru = imagecache.LRU(10)
+    lru.set('a', 'aaaa', 4)
+    lru.set('b', 'bbbb', 4)
+    self.assertEqual(lru.get('a'), 'aaaa')
+    lru.set('c', 'cccc', 4)
+    self.assertEqual(lru.get('b'), None)
+    self.assertEqual(lru.get('a'), 'aaaa')
+    self.assertEqual(lru.get('c'), 'cccc')
+    self.assertEqual(lru.bytes, 8)
+
+  def test_too_large(self):
+    lru = imagecache.LRU(10)
+    lru.set('a', 'a' * 11, 11)
+    self.assertEqual(lru.get('a'), None)
+    self.assertEqual(lru.bytes, 0)
+
+
+class ImageServingTest(base.ViewTestCase):
+  path = 'avatar_cached_t'
+  url = '/image/popular@example.com/avatar_cached_t.jpg'
+  content = 'not really a jpeg, but close enough'
+
+  def setUp(self):
+    super(ImageServingTest, self).setUp()
+    imagecache.flush_local()
+    self.popular = api.actor_get(api.ROOT, 'popular@example.com')
+    self.reads = []
+    image_get = api.image_get
+    def _image_get(*args, **kw):
+      self.reads.append(args)
+      return image_get(*args, **kw)
+    self.mox.stubs.Set(api, 'image_get', _image_get)
+
+  def tearDown(self):
+    imagecache.flush_local()
+    super(ImageServingTest, self).tearDown()
+
+  def _set(self, content=None):
+    api.image_set(self.popular, self.popular.nick, path=self.path,
+                  content=content or self.content, format='jpg', size='t')
+
+  def test_etag(self):
+    self._set()
+    r = self.client.get(self.url)
+    self.assertEqual(r.status_code, 200)
+    self.assertEqual(r.content, self.content)
+    self.assertEqual(r['ETag'], imagecache.etag_for(self.content))
+    self.assertEqual(len(self.reads), 1)
+
+    r = self.client.get(self.url, HTTP_IF_NONE_MATCH=r['ETag'])
+    self.assertEqual(r.status_code, 304)
+    self.assertEqual(r.content, '')
+
+    # served from the instance, and then from memcache
+    r = self.client.get(self.url)
+    self.assertEqual(r.content, self.content)
+    imagecache.flush_local()
+    r = self.client.get(self.url)
+    self.assertEqual(r.content, self.content)
+    self.assertEqual(len(self.reads), 1)
+
+  def test_missing(self):
+    r = self.client.get(self.url)
+    self.assertEqual(r.status_code, 404)
+    r = self.client.get(self.url)
+    self.assertEqual(r.status_code, 404)
+    self.assertEqual(len(self.reads), 1)
+
+    self._set()
+    r = self.client.get(self.url)
+    self.assertEqual(r.status_code, 200)
+    self.assertEqual(r.content, self.content)
+
+  def test_unknown_nick(self):
+    url = '/image/nosuchuser@example.com/avatar_cached_t.jpg'
+    r = self.client.get(url)
+    self.assertEqual(r.status_code, 404)
+    r = self.client.get(url)
+    self.assertEqual(r.status_code, 404)
+    self.assertEqual(len(self.reads), 1)
+
+  def test_range(self):
+    o = test_util.override(IMAGE_CACHE_MAX_BYTES=10)
+    try:
+      self._set()
+      r = self.client.get(self.url, HTTP_RANGE='bytes=4-9')
+      self.assertEqual(r.status_code, 206)
+      self.assertEqual(r.content, self.content[4:10])
+      self.assertEqual(r['Content-Range'],
+                       'bytes 4-9/%d' % len(self.content))
+
+      r = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+      self.assertEqual(r.status_code, 206)
+      self.assertEqual(r.content, self.content[-5:])
+
+      r = self.client.get(self.url, HTTP_RANGE='bytes=1000-')
+      self.assertEqual(r.status_code, 416)
+
+      # a range of an older version of the image is answered in full
+      r = self.client.get(self.url, HTTP_RANGE='bytes=4-9',
+                          HTTP_IF_RANGE='"stale"')
+      self.assertEqual(r.status_code, 200)
+      self.assertEqual(r.content, self.content)
+
+      # too large to keep, read again whenever content is sent
+      self.assertEqual(len(self.reads), 3)
+      r = self.client.get(self.url, HTTP_IF_NONE_MATCH=r['ETag'])
+      self.assertEqual(r.status_code, 304)
+      self.assertEqual(len(self.reads), 3)
+    finally:
+      o.reset()
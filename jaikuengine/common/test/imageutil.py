@@ -0,0 +1,64 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from common import imageutil
+from common.test import base
+
+
+# SOI, an APP0 segment and a fill byte
+JPEG_PREFIX = '\xff\xd8\xff\xe0\x00\x04ab\xff'
+
+def _jpeg(sof, width, height):
+  return (JPEG_PREFIX
+          # a huffman table, whose marker is in the SOF range
+          + '\xff\xc4\x00\x03x'
+          + '\xff' + chr(sof) + '\x00\x0b\x08'
+          + chr(height >> 8) + chr(height & 0xff)
+          + chr(width >> 8) + chr(width & 0xff)
+          + '\x01\x01\x11\x00')
+
+
+class ImageHeaderTest(base.FixturesTestCase):
+  def test_jpeg(self):
+    content = open('testdata/test_avatar.jpg').read()
+    self.assertEqual(imageutil.image_header(content),
+                     (imageutil.JPEG, 500, 400))
+    self.assertEqual(imageutil.image_header(buffer(content)),
+                     (imageutil.JPEG, 500, 400))
+    self.assertEqual(imageutil.size_from_jpeg(content), (500, 400))
+
+  def test_jpeg_sof(self):
+    for sof in (0xc0, 0xc1, 0xc2, 0xc3, 0xc9, 0xcb, 0xcd, 0xcf):
+      self.assertEqual(imageutil.image_header(_jpeg(sof, 300, 260)),
+                       (imageutil.JPEG, 300, 260))
+
+  def test_png(self):
+    content = open('testdata/test_avatar.png').read()
+    self.assertEqual(imageutil.image_header(buffer(content)),
+                     (imageutil.PNG, 320, 320))
+    self.assertEqual(imageutil.size_from_jpeg(content), None)
+
+  def test_gif(self):
+    self.assertEqual(imageutil.image_header('GIF89a\x2c\x01\x04\x01\x00'),
+                     (imageutil.GIF, 300, 260))
+
+  def test_malformed(self):
+    for content in ('', 'not an image', '\xff\xd8', JPEG_PREFIX,
+                    _jpeg(0xc0, 300, 260)[:-10],
+                    # image data before any SOF
+                    JPEG_PREFIX + '\xff\xda\x00\x02',
+                    imageutil.PNG_SIGNATURE + '\x00\x00\x00\x0dIHD',
+                    'GIF87a\x01'):
+      self.assertEqual(imageutil.image_header(content), None)
@@ -16,7 +16,9 @@
 from django import test
 from django.conf import settings
 
+from common import memcache
 from common import monitor
+from common.test import base
 from common.test import util as test_util
 
 
@@ -64,3 +66,57 @@ class MonitorTest(test.TestCase):
             'good-name 0/2/8/256\n'
             'party-time 2'))
 
+
+class MonitorCountersTest(base.ViewTestCase):
+  def setUp(self):
+    super(MonitorCountersTest, self).setUp()
+    monitor._pending.clear()
+    self.override = test_util.override(MONITOR_SHARDS=4)
+
+  def test_counters_add_up_over_shards(self):
+    for i in range(10):
+      monitor.incr('things')
+      monitor.incr('notifications-sent', 2, key='im', label='channel')
+      monitor.flush(force=True)
+    monitor.incr('things', 5)
+    # not flushed yet
+    self.assertEqual(monitor.collect()['things'], 10)
+
+    monitor.flush(force=True)
+    counters = monitor.collect()
+    self.assertEqual(counters['things'], 15)
+    self.assertEqual(counters['notifications-sent|channel:im'], 20)
+
+  def test_flush_interval(self):
+    monitor.flush(force=True)
+    monitor.incr('things')
+    o = test_util.override(MONITOR_FLUSH_INTERVAL=3600)
+    try:
+      monitor.flush()
+    finally:
+      o.reset()
+    self.assertFalse('things' in monitor.collect())
+
+  def test_observe(self):
+    monitor.observe('latency', 7, key='view')
+    monitor.observe('latency', 7, key='view')
+    monitor.observe('latency', 100000, key='view')
+    monitor.flush(force=True)
+    exported = monitor.exported()
+    self.assertEqual(exported['latency/view'], ('le', {'10': 2, 'inf': 1}))
+    self.assertEqual(exported['latency/view-count'], 3)
+    self.assertEqual(exported['latency/view-sum'], 100014)
+
+  def test_hit_rate(self):
+    exported = monitor.exported({'lookups|result:hit': 3,
+                                 'lookups|result:miss': 1})
+    self.assertEqual(exported['lookups'], ('result', {'hit': 3, 'miss': 1}))
+    self.assertEqual(exported['lookups-hit-rate'], 0.75)
+
+  def test_view(self):
+    self.client.get('/explore')
+    r = self.client.get('/_monitor')
+    self.assertEqual(r.status_code, 200)
+    self.assertContains(r, 'request-latency-ms/explore.views.explore_recent '
+                           'map:le ')
+    self.assertContains(r, 'datastore-ops-per-request-count ')
@@ -0,0 +1,139 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import StringIO
+import threading
+
+import simplejson
+
+from django import template
+
+from common import api
+from common import profile
+from common.test import base
+from common.test import util as test_util
+
+
+class ProfileTest(base.FixturesTestCase):
+  def setUp(self):
+    super(ProfileTest, self).setUp()
+    self.old_exporter = profile.set_exporter('memory')
+    profile.clear()
+
+  def tearDown(self):
+    profile.set_exporter(self.old_exporter)
+    profile.clear()
+    super(ProfileTest, self).tearDown()
+
+  def test_nesting(self):
+    l = profile.label('nesting')
+    outer = profile.start_span('outer', tag='api')
+    profile.store_call(api, 'inner', tag='read', time_ms=1.0)
+    profile.finish_span(outer)
+    span = l.stop()
+
+    self.assertEqual([x.name for x in span.children], ['outer'])
+    self.assertEqual([x.name for x in outer.children], ['common.api.inner'])
+    self.assertEqual(list(span.rows()),
+                     [('nesting', 'api', 'outer', outer.time_ms),
+                      ('nesting', 'read', 'common.api.inner', 1.0)])
+    # the label itself is not a row
+    self.assertEqual(profile.flattened(), list(span.rows()))
+
+  def test_datastore_calls(self):
+    l = profile.label('datastore')
+    api.actor_get(api.ROOT, 'popular@example.com')
+    span = l.stop()
+    tags = set([tag for label, tag, call, time_ms in span.rows()])
+    self.assert_(tags & set(['read', 'threadlocal_cached_read']), tags)
+
+  def test_memory_is_bounded(self):
+    o = test_util.override(PROFILE_MEMORY_ROWS=3)
+    try:
+      for i in range(5):
+        l = profile.label('bounded')
+        profile.store_call(api, 'call_%d' % i, tag='read')
+        l.stop()
+    finally:
+      o.reset()
+    # only the most recent rows are kept
+    calls = [call for label, tag, call, time_ms in profile.flattened()]
+    self.assertEqual(calls, ['common.api.call_2', 'common.api.call_3',
+                             'common.api.call_4'])
+
+  def test_uninstall(self):
+    actor_get = api.actor_get
+    if profile.install_api_profiling():
+      self.assertNotEqual(api.actor_get, actor_get)
+      profile.uninstall_api_profiling()
+      self.assertEqual(api.actor_get, actor_get)
+
+    render = template.Template.render
+    if profile.install_template_profiling():
+      self.assertNotEqual(template.Template.render, render)
+      profile.uninstall_template_profiling()
+      self.assertEqual(template.Template.render, render)
+
+  def test_threads_are_separate(self):
+    l = profile.label('main')
+
+    def _other():
+      # tracing is off on this thread
+      profile.store_call(api, 'other', tag='read')
+    t = threading.Thread(target=_other)
+    t.start()
+    t.join()
+
+    span = l.stop()
+    self.assertEqual(span.children, [])
+    self.assertEqual(profile.flattened(), [])
+
+  def test_jsonlines(self):
+    out = StringIO.StringIO()
+    profile.set_exporter(profile.JsonLinesExporter(out))
+    l = profile.label('json')
+    profile.store_call(api, 'inner', tag='memcache', time_ms=2.0)
+    l.stop()
+
+    lines = out.getvalue().splitlines()
+    self.assertEqual(len(lines), 1)
+    trace = simplejson.loads(lines[0])
+    self.assertEqual(trace['name'], 'json')
+    self.assertEqual(trace['children'][0]['tag'], 'memcache')
+    self.assertEqual(trace['children'][0]['time_ms'], 2.0)
+
+  def test_csv(self):
+    out = StringIO.StringIO()
+    profile.set_exporter(profile.CsvExporter(out))
+    l = profile.label('csv')
+    profile.store_call(api, 'inner', tag='read', time_ms=2.0)
+    l.stop()
+    self.assertEqual(out.getvalue(), 'csv,read,common.api.inner,2.0\n')
+
+  def test_sampling(self):
+    self.assertFalse(profile.should_sample(0.0))
+    self.assert_(profile.should_sample(1.0))
+
+  def test_time_by_tag(self):
+    root = profile.Span('root', tag='label')
+    outer = profile.Span('outer', tag='template', parent=root)
+    inner = profile.Span('inner', tag='template', parent=outer)
+    call = profile.Span('call', tag='api', parent=inner)
+    for span, time_ms in ((root, 10.0), (outer, 6.0), (inner, 4.0),
+                          (call, 1.0)):
+      span.finish(time_ms)
+    # the nested template is part of the outer one
+    self.assertEqual(profile.time_by_tag(root),
+                     {'label': 10.0, 'template': 6.0, 'api': 1.0})
@@ -0,0 +1,213 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import cPickle as pickle
+import datetime
+import sys
+import time
+
+from google.appengine.api import datastore
+
+from common import api
+from common import models
+from common import properties
+from common.test import base
+from common.test import util as test_util
+
+
+class DictPropertyTest(base.FixturesTestCase):
+  def test_round_trip(self):
+    value = {'title': 'hello', 'icon': 3, 'rating': 0.5, 'on': True,
+             'none': None, 'tags': ['a', u'\xe4'], 'nested': {'x': 1}}
+    data = properties.dumps_dict(value)
+    self.assertEqual(data[0], properties.DICT_JSON)
+    self.assertFalse(properties.is_legacy_dict(data))
+    self.assertEqual(properties.loads_dict(data), value)
+
+  def test_fallback_to_pickle(self):
+    for value in ({'when': datetime.datetime(2009, 1, 1)},
+                  {'args': (1, 2)},
+                  {'bytes': '\xff\xfe'}):
+      data = properties.dumps_dict(value)
+      self.assert_(properties.is_legacy_dict(data))
+      self.assertEqual(properties.loads_dict(data), value)
+
+  def test_reads_legacy(self):
+    value = {'title': 'hello', 'icon': 3}
+    for protocol in (0, 2):
+      self.assertEqual(
+          properties.loads_dict(pickle.dumps(value, protocol)), value)
+
+  def test_pickle_codec(self):
+    o = test_util.override(DICT_PROPERTY_CODEC='pickle')
+    try:
+      data = properties.dumps_dict({'title': 'hello'})
+    finally:
+      o.reset()
+    self.assert_(properties.is_legacy_dict(data))
+
+  def test_model(self):
+    key_name = 'stream/popular@example.com/presence/12345'
+    entry_ref = models.StreamEntry.get_by_key_name(key_name)
+    entity = datastore.Get(entry_ref.key())
+    self.assertFalse(properties.is_legacy_dict(str(entity['extra'])))
+
+    # a legacy entity written before the codec still loads
+    entity['extra'] = datastore.Blob(pickle.dumps({'title': 'legacy'}, -1))
+    datastore.Put(entity)
+    models.StreamEntry.reset_cache()
+    entry_ref = models.StreamEntry.get(entry_ref.key())
+    self.assertEqual(entry_ref.extra, {'title': 'legacy'})
+
+
+class LazyDictPropertyTest(base.FixturesTestCase):
+  key_name = 'stream/popular@example.com/presence/12345'
+
+  def _load(self):
+    models.StreamEntry.reset_cache()
+    return models.StreamEntry.get_by_key_name(self.key_name)
+
+  def test_decodes_on_first_read(self):
+    entry_ref = self._load()
+    self.assert_(isinstance(entry_ref._extra, properties._Encoded))
+    title = entry_ref.extra['title']
+    self.assert_(isinstance(entry_ref._extra, dict))
+    self.assert_(entry_ref.extra is entry_ref._extra)
+    self.assertEqual(entry_ref.extra['title'], title)
+
+  def test_untouched_put_keeps_blob(self):
+    entity = datastore.Get(self._load().key())
+    entry_ref = self._load()
+    entry_ref.put()
+    self.assertEqual(str(datastore.Get(entry_ref.key())['extra']),
+                     str(entity['extra']))
+
+  def test_untouched_put_follows_pickle_codec(self):
+    entry_ref = self._load()
+    entry_ref.extra = dict(entry_ref.extra)
+    entry_ref.put()
+    self.assertFalse(properties.is_legacy_dict(
+        str(datastore.Get(entry_ref.key())['extra'])))
+
+    o = test_util.override(DICT_PROPERTY_CODEC='pickle')
+    try:
+      entry_ref = self._load()
+      extra = dict(entry_ref.extra)
+      entry_ref = self._load()
+      entry_ref.put()
+    finally:
+      o.reset()
+    data = str(datastore.Get(entry_ref.key())['extra'])
+    self.assert_(properties.is_legacy_dict(data))
+    self.assertEqual(properties.loads_dict(data), extra)
+
+  def test_changes_are_written(self):
+    entry_ref = self._load()
+    entry_ref.extra['title'] = 'changed'
+    entry_ref.put()
+    self.assertEqual(self._load().extra['title'], 'changed')
+
+  def test_eager(self):
+    o = test_util.override(DICT_PROPERTY_LAZY=False)
+    try:
+      entry_ref = self._load()
+    finally:
+      o.reset()
+    self.assert_(isinstance(entry_ref._extra, dict))
+
+
+class DictPropertyBenchmark(base.FixturesTestCase):
+  """Encodes and decodes every DictProperty in the fixtures with pickle and
+  the compact codec and reports the sizes and the cpu time spent.
+  """
+  iterations = 100
+  nick = 'popular@example.com'
+  entry_count = 500
+
+  def _time(self, f, values):
+    start = time.clock()
+    for i in range(self.iterations):
+      rv = [f(v) for v in values]
+    return (time.clock() - start) / self.iterations, rv
+
+  def test_fixtures(self):
+    values = []
+    for model, name in ((models.Stream, 'extra'),
+                        (models.StreamEntry, 'extra'),
+                        (models.Subscription, 'extra'),
+                        (models.Presence, 'extra')):
+      values.extend([getattr(x, name) for x in model.all().fetch(1000)])
+    self.assert_(values)
+
+    pickle_s, pickled = self._time(lambda v: pickle.dumps(v, -1), values)
+    unpickle_s, unpickled = self._time(pickle.loads, pickled)
+    dumps_s, encoded = self._time(properties.dumps_dict, values)
+    loads_s, decoded = self._time(properties.loads_dict, encoded)
+    self.assertEqual(unpickled, values)
+    self.assertEqual(decoded, values)
+
+    fallbacks = len([x for x in encoded if properties.is_legacy_dict(x)])
+    report = [('pickle', pickle_s, unpickle_s, sum(map(len, pickled))),
+              ('compact', dumps_s, loads_s, sum(map(len, encoded))),
+              ]
+    sys.stderr.write('\n%d fixture dicts, %d fell back to pickle:\n'
+                     % (len(values), fallbacks))
+    for label, dumps_s, loads_s, size in report:
+      sys.stderr.write('  %-8s %8.2f ms encode %8.2f ms decode %8d bytes\n'
+                       % (label, dumps_s * 1000, loads_s * 1000, size))
+
+  def test_entry_get_entries(self):
+    """ a large inbox read lazily and eagerly, touching only the title """
+    stream_ref = api.stream_get_presence(api.ROOT, self.nick)
+    now = api.utcnow()
+    keys = []
+    for i in range(self.entry_count):
+      entry_ref = models.StreamEntry(
+          stream=stream_ref.key().name(),
+          owner=stream_ref.owner,
+          actor=self.nick,
+          uuid='benchmark%04d' % i,
+          created_at=now - datetime.timedelta(seconds=i),
+          extra={'title': 'benchmark entry number %d' % i,
+                 'location': 'Helsinki, Finland',
+                 'icon': 0,
+                 'comment_count': i % 5,
+                 })
+      entry_ref.put()
+      keys.append(entry_ref.key().name())
+
+    def read():
+      models.StreamEntry.reset_cache()
+      entries = api.entry_get_entries(api.ROOT, keys)
+      return [x.extra['title'] for x in entries[:20]]
+
+    iterations = max(1, self.iterations / 20)
+    report = []
+    for lazy in (False, True):
+      o = test_util.override(DICT_PROPERTY_LAZY=lazy)
+      try:
+        start = time.clock()
+        for i in range(iterations):
+          titles = read()
+        report.append((lazy and 'lazy' or 'eager',
+                       (time.clock() - start) / iterations))
+      finally:
+        o.reset()
+      self.assertEqual(len(titles), 20)
+
+    sys.stderr.write('\nentry_get_entries over %d entries, 20 titles read:\n'
+                     % self.entry_count)
+    for label, seconds in report:
+      sys.stderr.write('  %-8s %8.2f ms\n' % (label, seconds * 1000))
@@ -0,0 +1,191 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import os
+import time
+
+import simplejson
+
+from common import api
+from common import profile
+from common import throttle
+from common.test import base
+from common.test import fanout
+from common.test import util as test_util
+
+
+def percentile(values, p):
+  """ nearest-rank percentile of a list of numbers """
+  values = sorted(values)
+  if not values:
+    return None
+  rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+  return values[rank]
+
+
+class _DiscardExporter(object):
+  def export(self, span):
+    pass
+
+
+class ReadBenchmark(base.ViewTestCase):
+  """Renders the main pages and the read methods of the JSON api against a
+  generated dataset and reports latency percentiles, datastore and memcache
+  calls and the time spent in templates, api calls and memcache per view,
+  as a single JSON line.
+
+  READ_BENCHMARK_DATASET takes a JSON object overriding users, posts and
+  comments, READ_BENCHMARK_ITERATIONS sets how often each view is fetched
+  and READ_BENCHMARK_OUTPUT a file to append the report to.
+  bin/compare_benchmarks.py diffs two reports.
+  """
+  users = 20
+  posts = 2
+  comments = 200
+  iterations = 10
+
+  def setUp(self):
+    super(ReadBenchmark, self).setUp()
+    self.iterations = int(os.environ.get('READ_BENCHMARK_ITERATIONS',
+                                         self.iterations))
+    dataset = simplejson.loads(os.environ.get('READ_BENCHMARK_DATASET', '{}'))
+    for k in ('users', 'posts', 'comments'):
+      setattr(self, k, int(dataset.get(k, getattr(self, k))))
+    # the dataset is setup, not something to throttle
+    self.mox.stubs.Set(throttle, 'throttle', lambda *args, **kw: None)
+    self.social = fanout.SocialGraph(users=self.users,
+                                     channel_members=self.users / 2)
+    self.social.generate()
+    self.hub = self.social.most_followed()
+    self.item = self._generate_entries()
+    self.mox.stubs.UnsetAll()
+
+    # only take the profiling back out again if it wasn't already there
+    self.installed_api = profile.install_api_profiling()
+    self.installed_template = profile.install_template_profiling()
+    self.old_exporter = profile.set_exporter(_DiscardExporter())
+
+  def tearDown(self):
+    profile.set_exporter(self.old_exporter)
+    if self.installed_api:
+      profile.uninstall_api_profiling()
+    if self.installed_template:
+      profile.uninstall_template_profiling()
+    super(ReadBenchmark, self).tearDown()
+
+  def _generate_entries(self):
+    channel = self.social.channel.split('@')[0]
+    for i in range(self.posts):
+      for nick in self.social.nicks:
+        actor_ref = api.actor_get(api.ROOT, nick)
+        api.post(actor_ref, nick=nick, message='benchmark %s %d' % (nick, i))
+        if nick in self.social.nicks[:self.social.config['channel_members']]:
+          api.post(actor_ref, nick=nick,
+                   message='%s benchmark %s %d' % (channel, nick, i))
+      test_util.exhaust_queue_any()
+
+    hub_ref = api.actor_get(api.ROOT, self.hub)
+    item = api.post(hub_ref, nick=self.hub, message='benchmark item')
+    commenters = self.social.nicks
+    for i in range(self.comments):
+      nick = commenters[i % len(commenters)]
+      api.entry_add_comment(api.actor_get(api.ROOT, nick),
+                            nick=nick,
+                            stream=item.stream,
+                            entry=item.keyname(),
+                            content='benchmark comment %d' % i)
+    test_util.exhaust_queue_any()
+    return item
+
+  def pages(self):
+    hub = self.hub.split('@')[0]
+    channel = self.social.channel.split('@')[0][1:]
+    return [('actor_overview', hub, '/user/%s/overview' % hub),
+            ('actor_history', None, '/user/%s' % hub),
+            ('actor_item', None,
+             '/user/%s/presence/%s' % (hub, self.item.uuid)),
+            ('channel_history', None, '/channel/%s' % channel),
+            ('explore_recent', None, '/explore'),
+            ('front_front', None, '/'),
+            ]
+
+  def api_calls(self):
+    since_time = str(api.utcnow() - datetime.timedelta(days=1))
+    calls = {'actor_get': {'nick': self.hub},
+             'actor_get_contacts_avatars_since': {'nick': self.hub,
+                                                  'since_time': since_time},
+             'entry_get_actor_overview': {'nick': self.hub},
+             'entry_get_actor_overview_since': {'nick': self.hub,
+                                                'since_time': since_time},
+             }
+    # the write methods are what the fanout benchmark is for
+    return [('api.%s' % k, None, '/api/json', dict(method=k, **v))
+            for k, v in sorted(calls.iteritems())
+            if k in api.PublicApi.methods]
+
+  def _measure(self, name, nick, path, params=None):
+    if nick:
+      self.login(nick, password='benchmark')
+    times = []
+    tags = {}
+    counts = {}
+    for i in range(self.iterations):
+      recorder = self.record_rpcs()
+      l = profile.label(name)
+      start = time.time()
+      r = self.client.get(path, params or {})
+      times.append((time.time() - start) * 1000)
+      span = l.stop()
+      recorder.stop()
+      self.assertEqual(r.status_code, 200, '%s %s' % (path, r.status_code))
+      for tag, time_ms in profile.time_by_tag(span).iteritems():
+        tags[tag] = tags.get(tag, 0.0) + time_ms
+      for kind, count in recorder.counts().iteritems():
+        counts[kind] = counts.get(kind, 0) + count
+    if nick:
+      self.logout()
+
+    o = {'iterations': self.iterations,
+         'p50_ms': percentile(times, 50),
+         'p90_ms': percentile(times, 90),
+         'p99_ms': percentile(times, 99),
+         'max_ms': max(times),
+         }
+    for kind, count in counts.iteritems():
+      o[kind] = float(count) / self.iterations
+    for tag in ('template', 'api', 'memcache'):
+      o['%s_ms' % tag] = tags.get(tag, 0.0) / self.iterations
+    return o
+
+  def test_reads(self):
+    views = {}
+    for name, nick, path in self.pages():
+      views[name] = self._measure(name, nick, path)
+
+    o = test_util.override(API_DISABLE_VERIFICATION=True)
+    try:
+      for name, nick, path, params in self.api_calls():
+        views[name] = self._measure(name, nick, path, params)
+    finally:
+      o.reset()
+
+    report = {'benchmark': 'read',
+              'time': int(time.time()),
+              'dataset': {'users': self.users,
+                          'posts': self.posts,
+                          'comments': self.comments},
+              'views': views}
+    fanout.write_report(report, os.environ.get('READ_BENCHMARK_OUTPUT'))
@@ -0,0 +1,108 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+from common import sampler
+from common.test import base
+from common.test import util as test_util
+
+
+def _busy(seconds):
+  end = time.time() + seconds
+  while time.time() < end:
+    pass
+
+
+class SamplerTest(base.ViewTestCase):
+  def test_stack_sampler(self):
+    s = sampler.StackSampler(interval=0.001)
+    s.start()
+    _busy(0.05)
+    stacks = s.stop()
+    self.assert_(stacks)
+    self.assert_([x for x in stacks
+                  if x.endswith('common/test/sampler.py:_busy')],
+                 stacks.keys())
+
+  def test_cprofile_sampler(self):
+    s = sampler.CProfileSampler()
+    s.start()
+    _busy(0.01)
+    stacks = s.stop()
+    self.assert_([x for x in stacks
+                  if x.endswith(';common/test/sampler.py:_busy')],
+                 stacks.keys())
+
+  def test_store_merges(self):
+    sampler.store('some.view', {'a;b': 1, 'a;c': 2})
+    sampler.store('some.view', {'a;b': 3})
+    self.assertEqual(sampler.views(), ['some.view'])
+    self.assertEqual(sampler.get('some.view'),
+                     {'requests': 2, 'stacks': {'a;b': 4, 'a;c': 2}})
+    self.assertEqual(sampler.collapsed(sampler.get('some.view')['stacks']),
+                     'a;b 4\na;c 2')
+
+  def test_store_keeps_heaviest(self):
+    self.mox.stubs.Set(sampler, 'MAX_STACKS', 2)
+    sampler.store('some.view', {'a': 1, 'b': 5, 'c': 3})
+    self.assertEqual(sampler.get('some.view')['stacks'], {'b': 5, 'c': 3})
+
+  def test_store_fits_memcache(self):
+    self.mox.stubs.Set(sampler, 'MAX_BYTES', 100)
+    stacks = {}
+    for i in range(10):
+      stacks['frame;' * 4 + str(i)] = i + 1
+    sampler.store('some.view', stacks)
+    kept = sampler.get('some.view')['stacks']
+    self.assert_(sum([len(x) + sampler.STACK_OVERHEAD for x in kept]) <= 100)
+    # the lightest ones went
+    self.assertEqual(sorted(kept.values()), range(11 - len(kept), 11))
+
+  def test_token(self):
+    token = sampler.make_token()
+    self.assert_(sampler.check_token(token))
+    self.assertFalse(sampler.check_token(None))
+    self.assertFalse(sampler.check_token('garbage'))
+    expires, signature = token.split(':')
+    self.assertFalse(sampler.check_token('%d:%s' % (int(expires) + 1,
+                                                    signature)))
+    self.assertFalse(sampler.check_token(
+        sampler.make_token(int(time.time()) - 1)))
+
+  def test_middleware(self):
+    unsampled = self.client.get('/explore')
+
+    o = test_util.override(PROFILER_SAMPLE_RATE=1.0, PROFILER_MODE='cprofile')
+    try:
+      r = self.client.get('/explore')
+    finally:
+      o.reset()
+    # profiling never changes the response
+    self.assertEqual(r.status_code, unsampled.status_code)
+    self.assertTemplateUsed(r, 'explore/templates/recent.html')
+    self.assert_('explore.views.explore_recent' in sampler.views())
+
+    r = self.client.get('/_monitor/profile/explore.views.explore_recent')
+    self.assertContains(r, 'views.py:explore_recent')
+
+  def test_token_header(self):
+    o = test_util.override(PROFILER_MODE='cprofile')
+    try:
+      r = self.client.get('/_monitor/profile/token')
+      self.client.get('/explore', HTTP_X_PROFILE_TOKEN=r.content)
+    finally:
+      o.reset()
+    self.assert_('explore.views.explore_recent' in sampler.views())
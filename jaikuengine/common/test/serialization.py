@@ -0,0 +1,152 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import sys
+import time
+
+import simplejson
+
+from django.conf import settings
+from django.utils import text
+
+from common import api
+from common import models
+from common.test import base
+
+from api import views as api_views
+
+
+def _legacy_to_api(v):
+  """ the reflection based serialization we used before ApiSerializer """
+  if isinstance(v, api.ResultWrapper):
+    o = {}
+    for k, sub in v.kw.iteritems():
+      o[k] = sub is None and {} or _legacy_to_api(sub)
+    return o
+  elif isinstance(v, models.ApiMixinModel):
+    return dict([(prop, _legacy_to_api(getattr(v, prop)))
+                 for prop in v.properties().keys()])
+  elif isinstance(v, type([])):
+    return [_legacy_to_api(x) for x in v]
+  elif isinstance(v, type({})):
+    return dict([(key, _legacy_to_api(value))
+                 for (key, value) in v.iteritems()])
+  elif isinstance(v, datetime.datetime):
+    return str(v)
+  return v
+
+
+class ApiSerializationTest(base.FixturesTestCase):
+  def test_parse_fields(self):
+    self.assertEqual(api_views.parse_fields(None), None)
+    self.assertEqual(api_views.parse_fields(''), None)
+    self.assertEqual(
+        api_views.parse_fields('entries.uuid,entries.extra.title,actor.nick'),
+        {'entries': {'uuid': {}, 'extra': {'title': {}}},
+         'actor': {'nick': {}}})
+    # a shorter path wins over a longer one
+    self.assertEqual(api_views.parse_fields('entries.extra.title,entries'),
+                     {'entries': {}})
+    self.assertEqual(api_views.parse_fields('entries,entries.extra.title'),
+                     {'entries': {}})
+
+  def test_matches_legacy(self):
+    rv = api.entry_get_actor_overview(api.ROOT, 'popular@example.com')
+    self.assertEqual(rv.to_api(), _legacy_to_api(rv))
+
+  def test_fields(self):
+    rv = api.entry_get_actor_overview(api.ROOT, 'popular@example.com')
+    fields = api_views.parse_fields('entries.uuid,entries.extra.title')
+    o = rv.to_api(fields=fields)
+    self.assertEqual(o.keys(), ['entries'])
+    self.assertEqual(len(o['entries']), len(rv))
+    for entry in o['entries']:
+      self.assertEqual(sorted(entry.keys()), ['extra', 'uuid'])
+      # comments have no title
+      self.assert_(set(entry['extra'].keys()) <= set(['title']))
+
+  def test_actor_excludes_private(self):
+    actor_ref = api.actor_get(api.ROOT, 'popular@example.com')
+    o = actor_ref.to_api()
+    self.assertFalse('password' in o)
+    self.assertFalse('normalized_nick' in o)
+    self.assertEqual(o['nick'], 'popular@example.com')
+
+
+class ApiSerializationBenchmark(base.FixturesTestCase):
+  """Serializes a 200 entry overview the old and the new way and reports
+  the payload sizes and the cpu time spent.
+  """
+  nick = 'popular@example.com'
+  entry_count = 200
+  iterations = 10
+
+  def setUp(self):
+    super(ApiSerializationBenchmark, self).setUp()
+    stream_ref = api.stream_get_presence(api.ROOT, self.nick)
+    inboxes = ['inbox/%s/overview' % self.nick]
+    now = api.utcnow()
+    for i in range(self.entry_count):
+      entry_ref = models.StreamEntry(
+          stream=stream_ref.key().name(),
+          owner=stream_ref.owner,
+          actor=self.nick,
+          uuid='benchmark%04d' % i,
+          created_at=now - datetime.timedelta(seconds=i),
+          extra={'title': 'benchmark entry number %d' % i,
+                 'location': 'Helsinki, Finland',
+                 'icon': 0,
+                 'comment_count': i % 5,
+                 })
+      entry_ref.put()
+      api._add_inbox(stream_ref, entry_ref, inboxes, shard='benchmark')
+
+  def _time(self, f):
+    start = time.clock()
+    for i in range(self.iterations):
+      rv = f()
+    return (time.clock() - start) / self.iterations, rv
+
+  def test_overview(self):
+    rv = api.entry_get_actor_overview(api.ROOT, self.nick,
+                                      limit=self.entry_count)
+    self.assertEqual(len(rv), self.entry_count)
+    fields = api_views.parse_fields('entries.uuid,entries.extra.title')
+
+    legacy_ms, legacy = self._time(
+        lambda: simplejson.dumps(_legacy_to_api(rv)))
+    new_ms, new = self._time(
+        lambda: simplejson.dumps(rv.to_api(), separators=(',', ':')))
+    fields_ms, selected = self._time(
+        lambda: simplejson.dumps(rv.to_api(fields=fields),
+                                 separators=(',', ':')))
+    gzip_ms, compressed = self._time(
+        lambda: text.compress_string(
+            simplejson.dumps(rv.to_api(), separators=(',', ':'))))
+
+    self.assertEqual(simplejson.loads(legacy), simplejson.loads(new))
+    self.assert_(len(new) < len(legacy))
+    self.assert_(len(selected) < len(new))
+    self.assert_(len(compressed) < len(new))
+
+    report = [('legacy', legacy_ms, len(legacy)),
+              ('compiled', new_ms, len(new)),
+              ('compiled+fields', fields_ms, len(selected)),
+              ('compiled+gzip', gzip_ms, len(compressed)),
+              ]
+    sys.stderr.write('\n%d entry overview serialization:\n' % len(rv))
+    for label, seconds, size in report:
+      sys.stderr.write('  %-16s %8.2f ms %8d bytes\n'
+                       % (label, seconds * 1000, size))
@@ -130,3 +130,16 @@ class SmsTest(base.FixturesTestCase):
     self.assert_(r)
 
     o.reset()
+
+  def test_global_limit(self):
+    o = test_util.override(THROTTLE_SMS_GLOBAL_MONTH=3)
+    try:
+      connection = sms.SmsConnection()
+      targets = ['+14085551210', '+14085551211']
+      self.assertEqual(connection.apply_global_quota(targets), targets)
+      # only one left this month
+      self.assertEqual(connection.apply_global_quota(targets), targets[:1])
+      self.assertRaises(exception.ApiThrottled,
+                        connection.apply_global_quota, targets)
+    finally:
+      o.reset()
@@ -20,6 +20,7 @@ from django.conf import settings
 from common import api
 from common import clock
 from common import exception
+from common import memcache
 from common import throttle
 from common.test import base
 from common.test import util as test_util
@@ -53,3 +54,48 @@ class ThrottleTest(base.FixturesTestCase):
     self.assertRaises(exception.ApiThrottled, _failPants)
 
     o.reset()
+
+  def test_first_bucket_hit(self):
+    throttle.throttle(self.popular, 'test', minute=5, hour=2)
+    throttle.throttle(self.popular, 'test', minute=5, hour=2)
+    try:
+      throttle.throttle(self.popular, 'test', minute=5, hour=2)
+      self.fail('should have been throttled')
+    except exception.ApiThrottled, e:
+      self.assertEqual(e.message, 'Too many attempts this hour')
+
+  def test_single_round_trip(self):
+    limits = {'minute': 5, 'hour': 10, 'day': 20, 'month': 30}
+    throttle.throttle(self.popular, 'test', **limits)
+
+    calls = []
+    client = memcache.client
+    class _CountingClient(object):
+      def __getattr__(self, name):
+        calls.append(name)
+        return getattr(client, name)
+
+    memcache.client = _CountingClient()
+    try:
+      throttle.throttle(self.popular, 'test', **limits)
+    finally:
+      memcache.client = client
+    self.assertEqual(calls, ['offset_multi'])
+
+  def test_reserve(self):
+    self.assertEqual(throttle.reserve(None, 'test', 3, month=5), 3)
+    self.assertEqual(throttle.reserve(None, 'test', 3, month=5), 2)
+    self.assertEqual(throttle.reserve(None, 'test', 1, month=5), 0)
+    self.assertRaises(exception.ApiThrottled,
+                      throttle.throttle, None, 'test', month=5)
+
+  def test_reserve_gives_back(self):
+    # the minute limit only grants 2, the month keeps the other 8
+    self.assertEqual(
+        throttle.reserve(self.popular, 'test', 10, minute=2, month=5), 2)
+    o = test_util.override_clock(clock, seconds=120)
+    try:
+      self.assertEqual(
+          throttle.reserve(self.popular, 'test', 10, minute=10, month=5), 3)
+    finally:
+      o.reset()
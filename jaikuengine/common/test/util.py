@@ -16,8 +16,10 @@ from __future__ import absolute_import
 import base64
 import datetime
 import logging
+import os
 import re
 import time as py_time
+import traceback
 try:
   # Python 2.6
   from urlparse import parse_qsl
@@ -33,6 +35,7 @@ from django.test import client
 from common import api
 from common import clock
 from common import exception
+from common import memcache
 from common.protocol import pshb
 from common.protocol import sms
 from common.protocol import xmpp
@@ -62,23 +65,29 @@ def exhaust_queue_any():
   queue_stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
   tasks = queue_stub.GetTasks('default')
   while tasks:
-    task = tasks.pop(0)
-    body = base64.b64decode(task['body'])
-    params = dict(parse_qsl(body, keep_blank_values=True))
-    logging.debug('body %s', params)
+    run_task(tasks.pop(0))
+    tasks = queue_stub.GetTasks('default')
 
-    try:
-      l = override(DOMAIN='testserver')
-      test_client = client.Client()
-      rv = test_client.post('/_ah/queue/default',
-                            params)
-      l.reset()
-      queue_stub.DeleteTask('default', task['name'])
-    except Exception:
-      #logging.exception('Woops!')
-      raise
+def task_params(task):
+  """ the POST params of a task from the task queue stub """
+  body = base64.b64decode(task['body'])
+  return dict(parse_qsl(body, keep_blank_values=True))
 
-    tasks = queue_stub.GetTasks('default')
+def run_task(task):
+  """ runs a single task from the task queue stub and removes it """
+  queue_stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+  params = task_params(task)
+  logging.debug('body %s', params)
+
+  l = override(DOMAIN='testserver')
+  try:
+    test_client = client.Client()
+    rv = test_client.post('/_ah/queue/default',
+                          params)
+  finally:
+    l.reset()
+  queue_stub.DeleteTask('default', task['name'])
+  return rv
 
 
 class TestXmppConnection(xmpp.XmppConnection):
@@ -110,6 +119,7 @@ class TestPshbConnection(pshb.PshbConnection):
 class TestSmsConnection(sms.SmsConnection):
   def send_message(self, to_list, message):
     to_list = self.filter_targets(to_list, message)
+    to_list = self.apply_global_quota(to_list)
     logging.debug('SMS SEND -> %s: %s', to_list, message)
     for recp in to_list:
       sms.outbox.append((recp, message))
@@ -166,7 +176,7 @@ class FakeMemcache(object):
     for k, v in mapping.iteritems():
       success = self.add(key_prefix + k, v, time=time)
       if not success:
-        o.append[k]
+        o.append(k)
     return o
   
   def incr(self, key, delta=1):
@@ -183,6 +193,14 @@ class FakeMemcache(object):
     self.set(key, count, time=data_tup[1])
     return count
 
+  def offset_multi(self, mapping, key_prefix='', initial_value=None):
+    out = {}
+    for k, delta in mapping.iteritems():
+      if initial_value is not None and self._get_valid(key_prefix + k) is None:
+        self.set(key_prefix + k, initial_value)
+      out[k] = self.incr(key_prefix + k, delta)
+    return out
+
   def decr(self, key, delta=1):
     return incr(key, delta=-(delta))
   
@@ -199,19 +217,181 @@ class FakeMemcache(object):
     for k in keys:
       success = self.delete(key_prefix + k)
       if success != 2:
-        o.append[k]
+        o.append(k)
     return o
 
   def get(self, key):
     return self._get_valid(key)
 
-  def get_multi(self, keys, key_prefix=''):
+  def get_multi(self, keys, key_prefix='', for_cas=False):
+    # NOTE: for_cas is a no-op, cas_multi only checks the key is still there
     out = {}
     for k in keys:
       v = self._get_valid(key_prefix + k)
       out[k] = v
     return out
 
+  def cas_multi(self, mapping, time=0, key_prefix=''):
+    o = []
+    for k, v in mapping.iteritems():
+      if self._get_valid(key_prefix + k) is None:
+        o.append(k)
+        continue
+      self.set(key_prefix + k, v, time=time)
+    return o
+
+
+# datastore_v3 calls by the kind of budget they count against
+RPC_KINDS = {'Get': 'gets',
+             'RunQuery': 'queries',
+             'Next': 'queries',
+             'Count': 'queries',
+             'Put': 'puts',
+             'Delete': 'puts',
+             }
+
+# frames from these paths are never blamed for a call
+_RPC_IGNORED_PATHS = ('django', 'djangoappengine', 'djangotoolbox',
+                      'dbindexer', 'autoload', 'vendor', 'google',
+                      os.path.join('common', 'test'),
+                      os.path.join('common', 'profile.py'),
+                      os.path.join('common', 'memcache.py'),
+                      os.path.join('common', 'models.py'),
+                      )
+
+_APP_ROOT = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_recorders = []
+_hooked_apiproxy = None
+
+def _call_site():
+  """ the innermost application frame responsible for the current call """
+  for filename, lineno, function, text in reversed(traceback.extract_stack()):
+    path = os.path.relpath(os.path.abspath(filename), _APP_ROOT)
+    if path.startswith('..'):
+      continue
+    if [p for p in _RPC_IGNORED_PATHS if path.startswith(p)]:
+      continue
+    return '%s:%d %s()' % (path, lineno, function)
+  return 'unknown'
+
+def _rpc_hook(service, call, request, response):
+  if not _recorders:
+    return
+  kind = RPC_KINDS.get(call)
+  if not kind:
+    return
+  site = _call_site()
+  for recorder in _recorders:
+    recorder.record(kind, call, site)
+
+def _install_rpc_hook():
+  global _hooked_apiproxy
+  # the testrunner may swap in a fresh apiproxy between tests
+  if _hooked_apiproxy is apiproxy_stub_map.apiproxy:
+    return
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'rpc_recorder', _rpc_hook, 'datastore_v3')
+  _hooked_apiproxy = apiproxy_stub_map.apiproxy
+
+
+class _RecordingMemcache(object):
+  """ wraps memcache.client so that every call counts against a recorder """
+  def __init__(self, client, recorder):
+    self.__dict__['_client'] = client
+    self.__dict__['_recorder'] = recorder
+
+  def __getattr__(self, attr):
+    value = getattr(self._client, attr)
+    if not callable(value):
+      return value
+    def _wrapped(*args, **kw):
+      self._recorder.record('memcache', attr, _call_site())
+      return value(*args, **kw)
+    return _wrapped
+
+  def __setattr__(self, attr, value):
+    setattr(self._client, attr, value)
+
+
+class RpcRecorder(object):
+  """Counts datastore gets, queries and puts and memcache calls made while
+  it is running, remembering where each one came from.
+
+    recorder = RpcRecorder().start()
+    api.entry_get_actor_overview(api.ROOT, 'popular@example.com')
+    recorder.stop()
+    recorder.count('datastore')
+  """
+  def __init__(self):
+    self.calls = []
+    self._memcache = None
+
+  def start(self):
+    _install_rpc_hook()
+    _recorders.append(self)
+    self._memcache = memcache.client
+    memcache.client = _RecordingMemcache(self._memcache, self)
+    return self
+
+  def stop(self):
+    if self in _recorders:
+      _recorders.remove(self)
+    if self._memcache is not None:
+      memcache.client = self._memcache
+      self._memcache = None
+    return self
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.stop()
+
+  def record(self, kind, call, site):
+    self.calls.append((kind, call, site))
+
+  def count(self, kind):
+    """ kind is one of gets, queries, puts, memcache or datastore, the
+    last being the sum of the first three """
+    if kind == 'datastore':
+      return len([c for c in self.calls if c[0] != 'memcache'])
+    return len([c for c in self.calls if c[0] == kind])
+
+  def counts(self):
+    o = {}
+    for kind in ('datastore', 'gets', 'queries', 'puts', 'memcache'):
+      o[kind] = self.count(kind)
+    return o
+
+  def check(self, budgets):
+    """ returns a report of the budgets that were exceeded, or None """
+    over = []
+    for kind, budget in sorted(budgets.iteritems()):
+      used = self.count(kind)
+      if used > budget:
+        over.append('%s: %d > %d' % (kind, used, budget))
+    if not over:
+      return None
+    return '%s\n%s' % (', '.join(over), self.report())
+
+  def report(self):
+    """ the recorded calls grouped by call site, busiest first """
+    sites = {}
+    for kind, call, site in self.calls:
+      sites.setdefault(site, []).append('%s.%s' % (kind, call))
+    rows = sorted(sites.iteritems(), key=lambda x: (-len(x[1]), x[0]))
+    lines = []
+    for site, calls in rows:
+      summary = {}
+      for c in calls:
+        summary[c] = summary.get(c, 0) + 1
+      lines.append('  %4d  %s  (%s)' % (
+          len(calls), site,
+          ', '.join(['%s x%d' % x for x in sorted(summary.iteritems())])))
+    return '\n'.join(lines)
+
 
 class ClockOverride(object):
   old = None
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import unittest
 
 from django import test
@@ -75,10 +76,17 @@ from common.test.api import *
 from common.test.clean import *
 from common.test.db import *
 from common.test.domain import *
+from common.test.hotkeys import *
+from common.test.imagecache import *
+from common.test.imageutil import *
 from common.test.monitor import *
 from common.test.notification import *
 from common.test.patterns import *
+from common.test.profile import *
 from common.test.queue import *
+from common.test.properties import DictPropertyTest, LazyDictPropertyTest
+from common.test.sampler import *
+from common.test.serialization import ApiSerializationTest
 from common.test.sms import *
 from common.test.throttle import *
 from common.test.user import *
@@ -87,6 +95,14 @@ from common.templatetags.test.avatar import *
 from common.templatetags.test.format import *
 from common.templatetags.test.presence import *
 
+# The benchmarks build large datasets, time themselves and print reports,
+# `make benchmark` runs them with RUN_BENCHMARKS set
+if os.environ.get('RUN_BENCHMARKS'):
+  from common.test.fanout import FanoutBenchmark
+  from common.test.properties import DictPropertyBenchmark
+  from common.test.readpath import ReadBenchmark
+  from common.test.serialization import ApiSerializationBenchmark
+
 # This is for legacy compat with older tests
 # TODO(termie): remove me when no longer needed
 from common.test.base import *
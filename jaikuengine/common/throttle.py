@@ -21,6 +21,7 @@ from django.conf import settings
 from common import clock
 from common import exception
 from common import memcache
+from common import monitor
 
 # Wrap utcnow so that it can be mocked in tests. We can't replace the function
 # in the datetime module because it's an extension, not a python module.
@@ -45,26 +46,75 @@ def throttle_key(actor_ref, action, bucket):
 
 def throttle(actor_ref, action, **kw):
   """ enforces throttling of some action per user with defined limits
+
+  All the buckets are counted in a single offset_multi. Counting a bucket
+  that is already at its limit only pushes it further past it, which
+  changes nothing as its expiry stays the same.
   """
   if actor_ref and actor_ref.nick == settings.ROOT_NICK:
     return
 
-  already_throttled = False
-  for k, v in kw.iteritems():
-    if k in BUCKETS:
-      throttled = throttle_status(actor_ref, action, bucket=k, max=v)
-      
-      # if anything is throttled we will raise an error in the end
-      if throttled and not already_throttled:
-        already_throttled = k
-
-      # for any thresholds not yet hit increase the count
-      if not throttled:
-        throttle_inc(actor_ref, action, bucket=k)
-        
-  if already_throttled:
-    raise exception.ApiThrottled(
-        'Too many attempts this %s' % already_throttled)
+  limits = [(k, v) for k, v in kw.iteritems() if k in BUCKETS]
+  counts = _incr_buckets(actor_ref, action, [k for k, v in limits])
+
+  for bucket, max in limits:
+    # if anything is throttled we raise an error for the first one
+    if counts[bucket] is not None and counts[bucket] >= max:
+      monitor.incr('throttle-rejections', key=action, label='action')
+      raise exception.ApiThrottled('Too many attempts this %s' % bucket)
+
+def reserve(actor_ref, action, count, **kw):
+  """ reserves up to count units of some action under the defined limits
+
+  Returns how many were granted, which is less than count once a limit is
+  close. Units that could not be granted are given back to every bucket.
+  """
+  if count <= 0:
+    return 0
+  if actor_ref and actor_ref.nick == settings.ROOT_NICK:
+    return count
+
+  limits = [(k, v) for k, v in kw.iteritems() if k in BUCKETS]
+  counts = _incr_buckets(actor_ref, action, [k for k, v in limits],
+                         delta=count)
+
+  granted = count
+  for bucket, limit in limits:
+    left = limit - (counts[bucket] or 0)
+    granted = min(granted, left > 0 and left or 0)
+
+  if granted < count:
+    memcache.client.offset_multi(
+        dict((throttle_key(actor_ref, action, k), granted - count)
+             for k, v in limits))
+  return granted
+
+def _incr_buckets(actor_ref, action, buckets, delta=1):
+  """ adds delta to each of the buckets in one round trip
+
+  Returns the counts from before the increment, None for buckets that
+  didn't exist yet. Those are created with an add so that they get their
+  expiry, which only happens once per bucket and period.
+  """
+  if not buckets:
+    return {}
+  keys = dict((throttle_key(actor_ref, action, b), b) for b in buckets)
+  rv = memcache.client.offset_multi(dict((k, delta) for k in keys))
+
+  counts = {}
+  for cache_key, bucket in keys.iteritems():
+    count = rv.get(cache_key)
+    if count is None:
+      if memcache.client.add(cache_key, delta, BUCKETS[bucket]()):
+        counts[bucket] = None
+        continue
+      # somebody else created it in the meantime
+      count = memcache.client.incr(cache_key, delta)
+    if count is None:
+      counts[bucket] = None
+    else:
+      counts[bucket] = count - delta
+  return counts
 
 def throttle_status(actor_ref, action, bucket, max):
   """ check whether a throttling threshold has been hit
@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
 import datetime
 import logging
+import time
 
 from django.contrib.sessions.models import Session
 from django.conf import settings
@@ -23,6 +25,8 @@ import oauth.oauth as oauth
 from common import api
 from common import exception
 from common import legacy
+from common import memcache
+from common import monitor
 from common import oauth_util
 from common import util
 
@@ -63,24 +67,93 @@ def get_user_from_request(request):
 
   return None
 
-def purge_expired_user_auth_token_keys():
-  """ Remove expired tokens from the database. """
+SESSION_PURGE_KEY = 'session_purge'
 
-  #TODO: Remove hard coded limit
-  limit = 10
-  try:
-    objs = Session.objects.filter(expire_date__lte=api.utcnow())
-    expired_tokens = objs.count()
-    if expired_tokens:
-      for obj in objs[:limit]:
-        obj.delete()
-      logging.info("Removed %d expired user authentication "
-                   "tokens (%d remaining)",
-                   min(limit, expired_tokens),
-                   max(0, expired_tokens-limit))
-  except Exception, e:
-    logging.exception('Unhandled exception while removing expired tokens')
-  return
+def purge_expired_user_auth_token_keys(budget=None, batch_size=None):
+  """ Remove expired tokens from the database, run by cron.
+
+  Deletes batch_size sessions at a time, found with a keys only query, for
+  at most budget seconds. A run that runs out of time leaves its cursor in
+  memcache and the next run picks up from there. Returns how many sessions
+  were deleted and whether there are more left.
+  """
+  if budget is None:
+    budget = settings.SESSION_PURGE_BUDGET
+  if batch_size is None:
+    batch_size = settings.SESSION_PURGE_BATCH
+  start = time.time()
+
+  # a cursor only works with the query it came from, so a resumed purge
+  # keeps the expiry time it started out with
+  state = memcache.client.get(SESSION_PURGE_KEY)
+  if state:
+    now, cursor = state
+  else:
+    now, cursor = api.utcnow(), None
+
+  deleted = 0
+  more = True
+  while more:
+    query = db.GqlQuery('SELECT __key__ FROM %s WHERE expire_date <= :1'
+                        % Session._meta.db_table,
+                        now)
+    if cursor:
+      query.with_cursor(cursor)
+    keys = query.fetch(batch_size)
+    if keys:
+      db.delete(keys)
+      deleted += len(keys)
+    more = len(keys) == batch_size
+    cursor = query.cursor()
+    if time.time() - start >= budget:
+      break
+
+  if more:
+    memcache.client.set(SESSION_PURGE_KEY, (now, cursor))
+  else:
+    memcache.client.delete(SESSION_PURGE_KEY)
+
+  monitor.incr('sessions-purged', deleted)
+  monitor.incr('session-purge-runs', key=more and 'resumed' or 'done',
+               label='result')
+  monitor.observe('session-purge-ms', (time.time() - start) * 1000)
+  logging.info("Removed %d expired user authentication tokens%s",
+               deleted, more and ' (more remaining)' or '')
+  return deleted, more
+
+def _session_cache_key(token):
+  return 'user_session/%s' % token
+
+def cache_user_auth_token(token, password, expire_date):
+  """ Write a session through to memcache, so that the requests that
+  follow can be authenticated without reading it from the database. """
+  expires = calendar.timegm(expire_date.utctimetuple())
+  timeout = min(settings.SESSION_CACHE_TIMEOUT,
+                expires - calendar.timegm(api.utcnow().utctimetuple()))
+  if timeout <= 0:
+    return
+  memcache.client.set(_session_cache_key(token),
+                      {'password': password, 'expires': expires},
+                      timeout)
+
+def lookup_cached_user_auth_token(token):
+  """ Look up a user authentication token in memcache, None if it isn't
+  there or has expired. """
+  if not token:
+    return None
+  session = memcache.client.get(_session_cache_key(token))
+  if not session:
+    return None
+  if session['expires'] <= calendar.timegm(api.utcnow().utctimetuple()):
+    return None
+  return session['password']
+
+def revoke_user_auth_token(request):
+  """ Log out: forget the session in memcache and in the database. """
+  token = request.COOKIES.get(settings.PASSWORD_COOKIE, None)
+  if token:
+    memcache.client.delete(_session_cache_key(token))
+  request.session.flush()
 
 def lookup_user_auth_token(request):
   """ Look up a user authentication token from the database cache. """
@@ -103,15 +176,16 @@ def generate_user_auth_token(request,
   frequently than was acceptable.
 
   """
-  # Clear cache of expired tokens
-  purge_expired_user_auth_token_keys()
-
   # Set an expiration date to enable us to purge old, inactive
-  # sessions from the database. Cookie expiration dates are what
-  # actually govern how long sessions last.
+  # sessions from the database, see purge_expired_user_auth_token_keys.
+  # Cookie expiration dates are what actually govern how long sessions
+  # last.
   request.session.set_expiry(datetime.timedelta(seconds=timeout))
   request.session['data'] = password.encode("utf-8")
 
+  cache_user_auth_token(request.session.session_key,
+                        password,
+                        request.session.get_expiry_date())
   return request.session.session_key
 
 def authenticate_user_cookie(request, nick, token):
@@ -122,9 +196,20 @@ def authenticate_user_cookie(request, nick, token):
   # user's authenticated via cookie have full access
   user.access_level = api.DELETE_ACCESS
 
-  cached_token = lookup_user_auth_token(request)
-  if not cached_token:
-    return None
+  # the session is cached under the token in the cookie, a changed
+  # password no longer matches and a logout deletes it
+  cached_token = lookup_cached_user_auth_token(token)
+  if cached_token:
+    monitor.incr('session-lookups', key='memcache', label='source')
+  else:
+    monitor.incr('session-lookups', key='datastore', label='source')
+    cached_token = lookup_user_auth_token(request)
+    if not cached_token:
+      return None
+    if token and token == request.session.session_key:
+      cache_user_auth_token(token,
+                            cached_token,
+                            request.session.get_expiry_date())
 
   if user.password != cached_token:
     return None
@@ -286,6 +286,10 @@ def page_offset_nick(request):
   return offset, (offset and True or False)
 
 
+def page_cursor(dt):
+  """ the offset that page_offset reads back as dt, to the microsecond """
+  return '%.6f' % (datetime_to_timestamp(dt) + dt.microsecond / 1000000.0)
+
 def page_entries(request, entries, per_page):
   if len(entries) > per_page > 0:
     more = datetime_to_timestamp(entries[-2].created_at)
@@ -16,6 +16,8 @@ import cgi
 import logging
 import urlparse
 
+import simplejson
+
 from django import http
 from django import template
 from django.conf import settings
@@ -23,7 +25,11 @@ from django.template import loader
 
 from common import api
 from common import exception
+from common import hotkeys
 from common import messages
+from common import monitor
+from common import sampler
+from common import user
 from common import util
 from common import validate
 
@@ -50,6 +56,90 @@ def common_confirm(request):
   return http.HttpResponse(t.render(c))
 
 
+def common_monitor(request):
+  """ the monitoring counters, admin only through app.yaml """
+  monitor.flush(force=True)
+  return http.HttpResponse(monitor.export(monitor.exported()),
+                           content_type='text/plain')
+
+
+def common_cron_purge_sessions(request):
+  """ deletes a batch of expired sessions, run by cron, admin only through
+  app.yaml """
+  deleted, more = user.purge_expired_user_auth_token_keys()
+  return http.HttpResponse('deleted %d%s' % (deleted, more and ', more' or ''),
+                           content_type='text/plain')
+
+
+def common_monitor_fanout(request, uuid):
+  """ how long each stage of adding the entry with uuid took, and the lag
+  from its creation to its inboxes and notifications, admin only through
+  app.yaml """
+  trace = api.fanout_trace_get(api.ROOT, uuid)
+  if not trace:
+    raise http.Http404()
+  return http.HttpResponse(simplejson.dumps(trace, indent=2, sort_keys=True),
+                           content_type='application/json')
+
+
+def common_monitor_inbox(request, inbox):
+  """ the differences between the InboxEntry index of inbox and its
+  buckets, repair=1 adds what the buckets are missing """
+  rv = api.inbox_check_buckets(api.ROOT, inbox,
+                               limit=request.GET.get('limit', 100),
+                               repair=bool(request.GET.get('repair')))
+  return http.HttpResponse(simplejson.dumps(rv, indent=2, sort_keys=True),
+                           content_type='application/json')
+
+
+def common_monitor_hotkeys(request):
+  """ the hottest keys and the slowest query shapes of the last windows
+  windows, format=json for the raw counters """
+  hotkeys.flush(force=True)
+  windows = min(int(request.GET.get('windows', 1) or 1),
+                settings.HOTKEYS_WINDOWS)
+  k = int(request.GET.get('k', 20) or 20)
+  top = dict([(name, hotkeys.get(name, windows).top(k))
+              for name in (hotkeys.KEYS, hotkeys.QUERIES)])
+  if request.GET.get('format') == 'json':
+    return http.HttpResponse(simplejson.dumps(top, indent=2),
+                             content_type='application/json')
+
+  o = []
+  for name, unit in ((hotkeys.KEYS, 'calls'), (hotkeys.QUERIES, 'ms')):
+    o.append('%s, %s (error) calls max-ms:' % (name, unit))
+    for key, (weight, error, count, maximum) in top[name]:
+      o.append('  %8d (%d) %6d %6d  %s'
+               % (weight, error, count, maximum, key))
+  return http.HttpResponse('\n'.join(o), content_type='text/plain')
+
+
+def common_monitor_profiles(request):
+  """ the views we have profiles for and how many requests each covers """
+  o = []
+  for view in sampler.views():
+    profile = sampler.get(view)
+    if profile:
+      o.append('%s %d' % (view, profile['requests']))
+  return http.HttpResponse('\n'.join(o), content_type='text/plain')
+
+
+def common_monitor_profile_token(request):
+  """ a token for the X-Profile-Token header, good for an hour """
+  return http.HttpResponse(sampler.make_token(), content_type='text/plain')
+
+
+def common_monitor_profile(request, view):
+  """ the profile of view as collapsed stacks, clear=1 starts over """
+  profile = sampler.get(view)
+  if not profile:
+    raise http.Http404()
+  if request.GET.get('clear'):
+    sampler.clear(view)
+  return http.HttpResponse(sampler.collapsed(profile['stacks']),
+                           content_type='text/plain')
+
+
 def common_logme(request):
   logging.info("REQUEST: %s", request)
   raise http.Http404()
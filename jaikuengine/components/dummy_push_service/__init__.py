@@ -0,0 +1,41 @@
+"""an in-process push service for tests and the dev server
+
+A real push service lives in components/push_service and provides the same
+three functions: send_message wakes everybody waiting on the inboxes,
+cursor returns a token for the current state of an inbox and wait blocks
+until the inbox moves past a cursor or the timeout runs out.
+
+This one only reaches requests served by the same process.
+"""
+import logging
+import threading
+import time
+
+_condition = threading.Condition()
+_sequence = {}
+
+def send_message(inboxes, message):
+  logging.info("PUSH_SERVICE: send_message(%s, %s)", inboxes, message)
+  _condition.acquire()
+  try:
+    for inbox in inboxes:
+      _sequence[inbox] = _sequence.get(inbox, 0) + 1
+    _condition.notifyAll()
+  finally:
+    _condition.release()
+
+def cursor(inbox):
+  return _sequence.get(inbox, 0)
+
+def wait(inbox, cursor, timeout):
+  deadline = time.time() + timeout
+  _condition.acquire()
+  try:
+    while _sequence.get(inbox, 0) == cursor:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      _condition.wait(remaining)
+    return _sequence.get(inbox, 0)
+  finally:
+    _condition.release()
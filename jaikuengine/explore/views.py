@@ -27,14 +27,13 @@ def explore_recent(request, format="html"):
   per_page = ENTRIES_PER_PAGE
   offset, prev = util.page_offset(request)
 
-  inbox = api.inbox_get_explore(request.user, limit=(per_page + 1),
-                                offset=offset)
-
   # START inbox generation chaos
   # TODO(termie): refacccttttooorrrrr
-  entries = api.entry_get_entries(request.user, inbox)
-  per_page = per_page - (len(inbox) - len(entries))
-  entries, more = util.page_entries(request, entries, per_page)
+  entries, more = api.entry_get_page(
+      request.user, 'inbox/%s/explore' % api.ROOT.nick, per_page,
+      offset=offset,
+      fetch=lambda limit, offset: api.inbox_get_explore(
+          request.user, limit=limit, offset=offset))
 
   stream_keys = [e.stream for e in entries]
 
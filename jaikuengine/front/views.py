@@ -36,17 +36,14 @@ def front_front(request):
     url = request.user.url(request=request)
     return HttpResponseRedirect(url + "/overview")
 
-  # NOTE: grab a bunch of extra so that we don't ever end up with
-  #       less than 5
-  per_page = ENTRIES_PER_PAGE * 2
-
-  inbox = api.inbox_get_explore(request.user, limit=per_page)
+  per_page = ENTRIES_PER_PAGE
 
   # START inbox generation chaos
   # TODO(termie): refacccttttooorrrrr
-  entries = api.entry_get_entries(request.user, inbox)
-  per_page = per_page - (len(inbox) - len(entries))
-  entries, more = util.page_entries(request, entries, per_page)
+  entries, more = api.entry_get_page(
+      request.user, 'inbox/%s/explore' % api.ROOT.nick, per_page,
+      fetch=lambda limit, offset: api.inbox_get_explore(
+          request.user, limit=limit, offset=offset))
 
   stream_keys = [e.stream for e in entries]
   streams = api.stream_get_streams(request.user, stream_keys)
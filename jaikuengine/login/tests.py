@@ -12,12 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+
 from django.conf import settings
+from django.contrib.sessions.models import Session
 from common.tests import ViewTestCase
 from common import api
 from common import clean
 from common import exception
+from common import memcache
+from common import monitor
+from common import user
 from common import util
+from common.test import util as test_util
 
 class LoginTest(ViewTestCase):
 
@@ -109,6 +116,95 @@ class LoginTest(ViewTestCase):
     self.assertTemplateUsed(r, 'login/templates/login.html')
  
 
+class LoginSessionTest(ViewTestCase):
+  def _signed_in(self):
+    r = self.client.get('/login')
+    return r.status_code == 302
+
+  def _token(self):
+    return self.client.cookies[settings.PASSWORD_COOKIE].value
+
+  def test_session_cached(self):
+    self.login('popular')
+    self.assert_(user.lookup_cached_user_auth_token(self._token()))
+
+    def _lookup_user_auth_token(request):
+      self.fail('read the session from the database')
+    self.mox.stubs.Set(user, 'lookup_user_auth_token',
+                       _lookup_user_auth_token)
+    self.assert_(self._signed_in())
+
+  def test_session_evicted(self):
+    self.login('popular')
+    memcache.client = test_util.FakeMemcache()
+    self.assert_(self._signed_in())
+    self.assert_(user.lookup_cached_user_auth_token(self._token()))
+
+  def test_logout_revokes(self):
+    self.login('popular')
+    cookies = dict((k, v.value) for k, v in self.client.cookies.items())
+    self.client.get('/logout')
+
+    # someone holding on to the old cookies
+    for k, v in cookies.items():
+      self.client.cookies[k] = v
+    self.assertFalse(self._signed_in())
+
+  def test_password_change_revokes(self):
+    self.login('popular')
+    api.settings_change_password(api.ROOT, 'popular@example.com',
+                                 'anewpassword')
+    self.assertFalse(self._signed_in())
+
+
+class SessionPurgeTest(ViewTestCase):
+  def setUp(self):
+    super(SessionPurgeTest, self).setUp()
+    expired = api.utcnow() - datetime.timedelta(days=1)
+    for i in range(5):
+      Session(session_key='expired%d' % i, session_data='',
+              expire_date=expired).save()
+    self.login('popular')
+
+  def _sessions(self):
+    return sorted([s.session_key for s in Session.objects.all()])
+
+  def test_login_leaves_expired(self):
+    self.assertEqual(len(self._sessions()), 6)
+
+  def test_purge(self):
+    self.assertEqual(user.purge_expired_user_auth_token_keys(batch_size=2),
+                     (5, False))
+    self.assertEqual(self._sessions(),
+                     [self.client.cookies[settings.SESSION_COOKIE_NAME].value])
+
+  def test_resume(self):
+    # out of time after every batch
+    self.assertEqual(
+        user.purge_expired_user_auth_token_keys(budget=0, batch_size=2),
+        (2, True))
+    self.assertEqual(len(self._sessions()), 4)
+    self.assertEqual(
+        user.purge_expired_user_auth_token_keys(budget=0, batch_size=2),
+        (2, True))
+    self.assertEqual(
+        user.purge_expired_user_auth_token_keys(budget=0, batch_size=2),
+        (1, False))
+    self.assertEqual(len(self._sessions()), 1)
+
+  def test_cron(self):
+    # start from empty counters
+    monitor.flush(force=True)
+    memcache.client = test_util.FakeMemcache()
+
+    r = self.client.get('/_cron/purge_sessions')
+    self.assertContains(r, 'deleted 5')
+    monitor.flush(force=True)
+    counters = monitor.collect()
+    self.assertEqual(counters['sessions-purged'], 5)
+    self.assertEqual(counters['session-purge-runs|result:done'], 1)
+
+
 # Test cases and expected outcomes:
 # 'annoying', 'girlfriend' do not have an emails associated
 # 'hermit' has an unconfirmed email
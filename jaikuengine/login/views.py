@@ -97,6 +97,7 @@ def login_noreally(request):
 
 @decorator.cache_never
 def login_logout(request):
+  user.revoke_user_auth_token(request)
   request.user = None
   redirect_to = '/'
   c = template.RequestContext(request, locals())
@@ -0,0 +1,56 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+from django.conf import settings
+
+from common import hotkeys
+from common import monitor
+
+
+class MonitorMiddleware(object):
+  """Records the latency of every request by view and the datastore calls
+  it made, and flushes the monitoring counters of this instance now and
+  then, along with the hot keys when HOTKEYS_ENABLED.
+  """
+
+  def __init__(self):
+    monitor.install_datastore_hook()
+    if settings.HOTKEYS_ENABLED:
+      hotkeys.install_hooks()
+
+  def process_request(self, request):
+    request.monitor_start = time.time()
+    request.monitor_view = None
+    monitor.start_request()
+
+  def process_view(self, request, callback, callback_args, callback_kwargs):
+    request.monitor_view = '%s.%s' % (
+        callback.__module__, getattr(callback, '__name__', 'unknown'))
+
+  def process_response(self, request, response):
+    start = getattr(request, 'monitor_start', None)
+    if start is None:
+      return response
+
+    view = request.monitor_view or 'none'
+    monitor.observe('request-latency-ms', (time.time() - start) * 1000,
+                    key=view)
+    monitor.observe('datastore-ops-per-request', monitor.finish_request())
+    monitor.flush()
+    if settings.HOTKEYS_ENABLED:
+      hotkeys.flush()
+    return response
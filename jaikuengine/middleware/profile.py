@@ -23,6 +23,7 @@ from django.conf import settings
 
 from common import profile as common_profile
 from common import exception
+from common import sampler
 
 try:
   import cProfile as profile
@@ -35,26 +36,43 @@ except ImportError:
   import StringIO
 
 class ProfileMiddleware(object):
-  prof_label = None
+  """Profiling hooks for the dev server plus sampled tracing and profiling
+  in production, which never change the response.
+
+  State is kept on the request, the middleware instance is shared between
+  threads.
+  """
 
   def process_request(self, request):
-    if not settings.DEBUG:
+    request.prof_label = None
+    request.prof_sampler = None
+    request.prof_view = None
+    if settings.DEBUG:
       return
 
+    if common_profile.should_sample(settings.PROFILE_SAMPLE_RATE):
+      request.prof_label = common_profile.label(request.path)
+
+    if sampler.should_profile(request):
+      request.prof_sampler = sampler.get_sampler()
+      request.prof_sampler.start()
+
   def process_view(self, request, callback, callback_args, callback_kwargs):
+    request.prof_view = '%s.%s' % (
+        callback.__module__, getattr(callback, '__name__', 'unknown'))
     if not settings.DEBUG:
       return
 
     # hotshot data
     if '_prof_heavy' in request.REQUEST:
-      self.profiler = profile.Profile()
+      request.profiler = profile.Profile()
       args = (request,) + callback_args
-      return self.profiler.runcall(callback, *args, **callback_kwargs)
+      return request.profiler.runcall(callback, *args, **callback_kwargs)
 
     # output data for use in the profiling code
     if ('_prof_db' in request.REQUEST 
         or request.META.get('HTTP_X_PROFILE', '') == 'db'):
-        self.prof_label = common_profile.label(request.path)
+        request.prof_label = common_profile.label(request.path)
 
     # output data to be included on the page
     if '_prof_quick' in request.REQUEST:
@@ -63,20 +81,29 @@ class ProfileMiddleware(object):
       except:
         exception.log_exception()
         
-      self.prof_label = common_profile.label(request.path)
+      request.prof_label = common_profile.label(request.path)
 
   def process_response(self, request, response):
+    prof_label = getattr(request, 'prof_label', None)
     if not settings.DEBUG:
+      if prof_label:
+        prof_label.stop()
+      prof_sampler = getattr(request, 'prof_sampler', None)
+      if prof_sampler:
+        try:
+          sampler.store(request.prof_view or 'none', prof_sampler.stop())
+        except Exception:
+          exception.log_exception()
       return response
 
     if '_prof_heavy' in request.REQUEST:
-      self.profiler.create_stats()
+      request.profiler.create_stats()
 
       out = StringIO.StringIO()
       old_stdout = sys.stdout 
       sys.stdout = out
 
-      stats = pstats.Stats(self.profiler)
+      stats = pstats.Stats(request.profiler)
       stats.sort_stats('time', 'calls')
 
       stats.print_stats()
@@ -88,26 +115,16 @@ class ProfileMiddleware(object):
       new_response['Content-type'] = 'text/plain'
       return new_response
 
-    # NOTE: this will not work in any environment other than the dev server
-    #       as this is not shared-state-safe, only one request is allowed
-    #       at a time for this data to be accurate
     if ('_prof_db' in request.REQUEST 
         or request.META.get('HTTP_X_PROFILE', '') == 'db'):
-      self.prof_label.stop()
-      csv = common_profile.csv()
+      span = prof_label.stop()
       common_profile.clear()
-      return http.HttpResponse(csv)
+      return http.HttpResponse(common_profile.csv(spans=[span]))
 
     if '_prof_quick' in request.REQUEST:
-      self.prof_label.stop()
-      html = common_profile.html()
+      span = prof_label.stop()
       common_profile.clear()
-      response.write(html)
+      response.write(common_profile.html(spans=[span]))
       return response
-    
-    
-
 
     return response
-  
-
@@ -14,6 +14,7 @@
 
 from djangoappengine.settings_base import *
 
+import datetime
 import re
 import os
 import os.path
@@ -80,6 +81,9 @@ MIDDLEWARE_CLASSES = (
     # This loads the index definitions, so it has to come first
     'autoload.middleware.AutoloadMiddleware',
 
+    # Comes early so that the request latency includes the other middleware
+    'middleware.monitor.MonitorMiddleware',
+
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
 
@@ -229,6 +233,16 @@ PASSWORD_COOKIE = 'password'
 COOKIE_DOMAIN = '.%s' % DOMAIN
 COOKIE_PATH = '/'
 
+# How long a login session is kept in memcache, after which the next
+# request reads it from the database again; it is never kept past its
+# expiry, see common/user.py
+SESSION_CACHE_TIMEOUT = 60 * 60
+
+# Expired sessions are deleted by cron, SESSION_PURGE_BATCH at a time for
+# up to SESSION_PURGE_BUDGET seconds a run, see cron.yaml
+SESSION_PURGE_BATCH = 100
+SESSION_PURGE_BUDGET = 20
+
 #
 # Blog
 #
@@ -268,6 +282,11 @@ ROOT_TOKEN_SECRET = 'ROOT_TOKEN_SECRET'
 ROOT_CONSUMER_KEY = 'ROOT_CONSUMER_KEY'
 ROOT_CONSUMER_SECRET = 'ROOT_CONSUMER_SECRET'
 
+# Compress JSON API responses of at least API_GZIP_MIN_LENGTH bytes for
+# clients that send Accept-Encoding: gzip
+API_GZIP_ENABLED = False
+API_GZIP_MIN_LENGTH = 1024
+
 # Allow support for legacy API authentication
 API_ALLOW_LEGACY_AUTH = False
 LEGACY_SECRET_KEY = 'I AM ALSO SECRET'
@@ -327,6 +346,17 @@ IM_PLAIN_TEXT_ONLY = False
 # Truncate entry title in comments. None or 140+ means no truncation.
 IM_MAX_LENGTH_OF_ENTRY_TITLES_FOR_COMMENTS = 40
 
+#
+# Push
+#
+
+# Wake up clients long-polling /api/push as soon as an entry lands in the
+# overview they are watching, the transport is the push_service component
+PUSH_ENABLED = False
+
+# The longest we hold a long-poll request open, in seconds
+PUSH_MAX_WAIT = 25
+
 #
 # Task Queue
 #
@@ -376,6 +406,76 @@ COMMENT_QUICKLINKS_ACCESSKEYS_ENABLED = False
 
 PROFILE_DB = False
 
+# Fraction of requests to trace outside of DEBUG, see common/profile.py
+PROFILE_SAMPLE_RATE = 0.0
+
+# Where finished traces go: 'memory' keeps the last PROFILE_MEMORY_ROWS rows
+# for the profiling pages and the test runner, 'csv' and 'jsonlines' write
+# them to the log
+PROFILE_EXPORTER = 'memory'
+PROFILE_MEMORY_ROWS = 10000
+
+# Fraction of requests to profile as a whole outside of DEBUG, with either
+# a 'stack' sampler looking at the stack every PROFILER_INTERVAL seconds or
+# with 'cprofile', see common/sampler.py and /_monitor/profile
+PROFILER_SAMPLE_RATE = 0.0
+PROFILER_MODE = 'stack'
+PROFILER_INTERVAL = 0.005
+
+# How DictProperty values such as extra are written: 'json' for the compact
+# versioned codec, 'pickle' for the legacy format, see common/properties.py;
+# both are always read. DICT_PROPERTY_LAZY leaves them undecoded until used
+DICT_PROPERTY_CODEC = 'json'
+DICT_PROPERTY_LAZY = True
+
+# Monitoring counters are kept per instance and added to memcache at most
+# every MONITOR_FLUSH_INTERVAL seconds, into one of MONITOR_SHARDS copies of
+# each counter, see common/monitor.py and /_monitor
+MONITOR_FLUSH_INTERVAL = 10
+MONITOR_SHARDS = 4
+
+# The HOTKEYS_CAPACITY most used datastore and memcache keys and the slowest
+# query shapes of every HOTKEYS_WINDOW seconds, the last HOTKEYS_WINDOWS of
+# which are shown on /_monitor/hotkeys; queries slower than SLOW_QUERY_MS are
+# logged, see common/hotkeys.py; off by default as it hooks every RPC
+HOTKEYS_ENABLED = False
+HOTKEYS_CAPACITY = 100
+HOTKEYS_WINDOW = 300
+HOTKEYS_WINDOWS = 12
+SLOW_QUERY_MS = 500
+
+# Where inboxes are kept: 'index' queries the InboxEntry index, 'dual' also
+# adds every entry to the time-bucketed InboxBucket of each inbox and
+# 'bucket' reads those, falling back to the index for anything they can't
+# answer. Set INBOX_BUCKET_START along with 'dual', see common/api.py
+# inbox_check_buckets for comparing the two
+INBOX_BACKEND = 'index'
+
+# Inboxes that get nearly every entry and so would be written to by every
+# fanout at once, kept in the index only
+INBOX_BUCKET_EXCLUDE = ('inbox/%s/explore' % ROOT_NICK,)
+
+# When every new entry began going to the buckets, that is when 'dual' was
+# switched on, as a UTC datetime.datetime. Reads only trust the buckets that
+# begin at or after it and go to the index for anything older; None trusts
+# none of them
+INBOX_BUCKET_START = None
+
+# A page of followers that takes longer than this to fan an entry out to is
+# logged along with the followers it covered
+FANOUT_SLOW_PAGE_MS = 5000
+
+# How long the stage timings of an entry stay around for /_monitor/fanout
+FANOUT_TRACE_TIMEOUT = 60 * 60 * 24
+
+# Images are served from an LRU of IMAGE_LRU_BYTES in each instance and
+# from memcache when they are no larger than IMAGE_CACHE_MAX_BYTES, the
+# ETags of all of them are kept in memcache and paths that don't exist are
+# remembered for IMAGE_NEGATIVE_TIMEOUT seconds, see common/imagecache.py
+IMAGE_LRU_BYTES = 4 * 1024 * 1024
+IMAGE_CACHE_MAX_BYTES = 64 * 1024
+IMAGE_NEGATIVE_TIMEOUT = 60
+
 # Limit of avatar photo size in kilobytes
 MAX_AVATAR_PHOTO_KB = 200
 
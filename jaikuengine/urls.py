@@ -138,6 +138,14 @@ if settings.BLOG_ENABLED:
 urlpatterns += patterns('common.views',
     (r'^error$', 'common_error'),
     (r'^confirm$', 'common_confirm'),
+    (r'^_monitor$', 'common_monitor'),
+    (r'^_monitor/hotkeys$', 'common_monitor_hotkeys'),
+    (r'^_monitor/inbox/(?P<inbox>.+)$', 'common_monitor_inbox'),
+    (r'^_monitor/fanout/(?P<uuid>[^/]+)$', 'common_monitor_fanout'),
+    (r'^_monitor/profile$', 'common_monitor_profiles'),
+    (r'^_monitor/profile/token$', 'common_monitor_profile_token'),
+    (r'^_monitor/profile/(?P<view>[\w.]+)$', 'common_monitor_profile'),
+    (r'^_cron/purge_sessions$', 'common_cron_purge_sessions'),
     (r'^(?P<path>.*)/$', 'common_noslash'),
 )
 